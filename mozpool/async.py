@@ -2,16 +2,32 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+from __future__ import absolute_import
+
+import uuid
 import logging
 import threading
-import time
+import collections
+import urlparse
 import requests as requests_mod
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.exceptions import NewConnectionError
+from mozpool import clock, metrics
 
 logger = logging.getLogger('async')
 
+operation_seconds = metrics.histogram('mozpool_async_operation_seconds',
+        'Time taken by asynchronous operations', ('operation',))
+operations = metrics.counter('mozpool_async_operations_total',
+        'Asynchronous operations, by result: ok, error (an exception), or late '
+        '(finished after max_time)', ('operation', 'result'))
+
 class TimeoutError(Exception):
     pass
 
+class JobStoreFull(Exception):
+    pass
+
 class AsyncOperation(object):
     """
     Abstract base class for operations that occur asynchronously, on another
@@ -35,17 +51,25 @@ class AsyncOperation(object):
 
         This method will never block.
         """
-        callback_before = time.time() + self.max_time
+        started = clock.time()
+        callback_before = started + self.max_time
+        name = self.func.__name__
         def try_operation():
             res = False
             try:
                 res = self.func(self.obj, *args, **kwargs)
             except:
                 logger.error("exception ignored in async operation:", exc_info=True)
+                operations.labels(name, 'error').inc()
                 return
+            finally:
+                operation_seconds.labels(name).observe(clock.time() - started)
 
-            if time.time() < callback_before:
+            if clock.time() < callback_before:
+                operations.labels(name, 'ok').inc()
                 callback(res)
+            else:
+                operations.labels(name, 'late').inc()
         threading.Thread(target=try_operation).start()
 
     def run(self, *args, **kwargs):
@@ -84,9 +108,128 @@ def async_operation(max_time):
         return property(fget=lambda obj : AsyncOperation(obj, func, max_time))
     return wrap
 
+class HTTPClient(object):
+    """
+    An HTTP client that keeps a pooled, keep-alive session for each destination
+    (host and port), so that repeated notifications to the same server reuse
+    connections.  At most `pool_size` connections are kept open to each
+    destination; further concurrent requests use a new connection, which is
+    closed afterward.
+
+    Requests that fail to connect are retried up to `retries` times, waiting
+    `backoff` seconds before the first retry and doubling the wait each time.
+    Other failures, including read timeouts and connections dropped after the
+    request was sent, are not retried, as the request may already have been
+    acted on.
+
+    Per-destination counts of requests and errors, and request latencies, are
+    available from `get_stats`.
+
+    An instance of this object is available at mozpool.async.http
+    """
+
+    def __init__(self, pool_size=10, retries=2, backoff=0.5):
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._stats = {}
+
+    def _destination(self, url):
+        return urlparse.urlparse(url).netloc
+
+    def _session(self, destination):
+        with self._lock:
+            session = self._sessions.get(destination)
+            if not session:
+                session = requests_mod.Session()
+                adapter = HTTPAdapter(pool_connections=1,
+                        pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[destination] = session
+            return session
+
+    def _record(self, destination, elapsed, error):
+        with self._lock:
+            stats = self._stats.setdefault(destination, {'requests': 0,
+                    'errors': 0, 'retries': 0, 'total_time': 0.0, 'max_time': 0.0})
+            stats['requests'] += 1
+            stats['total_time'] += elapsed
+            stats['max_time'] = max(stats['max_time'], elapsed)
+            if error:
+                stats['errors'] += 1
+
+    def _connect_failed(self, exc):
+        # true if the request was never sent, so it is safe to retry
+        if isinstance(exc, requests_mod.exceptions.ConnectTimeout):
+            return True
+        reason = getattr(exc.args[0], 'reason', None) if exc.args else None
+        return isinstance(reason, NewConnectionError)
+
+    def _record_retry(self, destination):
+        with self._lock:
+            self._stats[destination]['retries'] += 1
+
+    def request(self, method, url, **kwargs):
+        """
+        Make an HTTP request, as for `requests.Session.request`.  Responses
+        with 5xx status codes count as errors, but are returned as usual.
+        """
+        destination = self._destination(url)
+        session = self._session(destination)
+        wait = self.backoff
+        attempt = 0
+        while True:
+            started = clock.time()
+            try:
+                response = getattr(session, method)(url, **kwargs)
+            except requests_mod.exceptions.ConnectionError as e:
+                self._record(destination, clock.time() - started, True)
+                if attempt >= self.retries or not self._connect_failed(e):
+                    raise
+                attempt += 1
+                self._record_retry(destination)
+                logger.warning("could not connect to %s; retrying in %.1fs" %
+                               (destination, wait))
+                clock.sleep(wait)
+                wait *= 2
+                continue
+            except Exception:
+                self._record(destination, clock.time() - started, True)
+                raise
+            self._record(destination, clock.time() - started,
+                         response.status_code >= 500)
+            return response
+
+    def get(self, url, **kwargs):
+        return self.request('get', url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('post', url, data=data, **kwargs)
+
+    def get_stats(self):
+        """
+        Return a dictionary keyed by destination, with values giving the
+        number of 'requests' (including failed attempts), 'errors', and
+        'retries', and the 'mean_time' and 'max_time' taken, in seconds.
+        """
+        with self._lock:
+            return dict((destination, {'requests': stats['requests'],
+                                       'errors': stats['errors'],
+                                       'retries': stats['retries'],
+                                       'mean_time': stats['total_time'] / stats['requests'],
+                                       'max_time': stats['max_time']})
+                        for destination, stats in self._stats.iteritems())
+
+http = HTTPClient()
+
+
 class AsyncRequests(object):
     """
-    An async wrapper for requests.get and requests.post.
+    An async wrapper for GET and POST requests, made with the pooled sessions
+    of mozpool.async.http.
 
     Note that exceptions are not propagated asynchronously; any requests errors
     will be logged, but the callback will simply not occur.  All operations
@@ -97,10 +240,90 @@ class AsyncRequests(object):
 
     @async_operation(30)
     def get(self, url, **kwargs):
-        return requests_mod.get(url, timeout=30, **kwargs)
+        return http.get(url, timeout=30, **kwargs)
 
     @async_operation(30)
     def post(self, url, data=None, **kwargs):
-        return requests_mod.post(url, data=data, timeout=30, **kwargs)
+        return http.post(url, data=data, timeout=30, **kwargs)
 
 requests = AsyncRequests()
+
+
+class JobStore(object):
+    """
+    A bounded, in-memory store of asynchronous operations started on behalf of
+    API clients, allowing clients to start an operation and collect its result
+    later instead of holding a connection open while it runs.
+
+    Each job is identified by a random string, and is represented as a
+    dictionary with keys 'id', 'operation', 'state' (one of 'running',
+    'complete', or 'timeout'), and 'result' (None until complete).  Finished
+    jobs are kept for `ttl` seconds.  At most `max_jobs` jobs are stored; to
+    make room for a new job, the oldest finished jobs are discarded, but
+    running jobs are not, so if the store is full of running jobs, no new jobs
+    can be started.
+
+    An instance of this object is available at mozpool.async.jobs
+    """
+
+    def __init__(self, max_jobs=1000, ttl=600):
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self._jobs = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def start(self, name, operation, *args, **kwargs):
+        """
+        Start the given AsyncOperation with the given arguments, recording it
+        under NAME, and return the new job's id.  Raises JobStoreFull if there
+        are already `max_jobs` running jobs.
+        """
+        now = clock.time()
+        job_id = uuid.uuid4().hex
+        job = {'id': job_id, 'operation': name, 'state': 'running', 'result': None,
+               '_finish_by': now + operation.max_time, '_expires': None}
+        with self._lock:
+            self._expire(now)
+            if len(self._jobs) >= self.max_jobs:
+                # discard the oldest jobs that are finished or past their
+                # deadline, but never one that is still running
+                finished = [ j['id'] for j in self._jobs.itervalues()
+                             if j['state'] != 'running' or now > j['_finish_by'] ]
+                for old_id in finished[:len(self._jobs) - self.max_jobs + 1]:
+                    del self._jobs[old_id]
+            if len(self._jobs) >= self.max_jobs:
+                raise JobStoreFull("%d jobs are already running" % len(self._jobs))
+            self._jobs[job_id] = job
+
+        def done(result):
+            with self._lock:
+                job['state'] = 'complete'
+                job['result'] = result
+                job['_expires'] = clock.time() + self.ttl
+        operation.start(done, *args, **kwargs)
+        return job_id
+
+    def get(self, job_id):
+        """
+        Get the job with the given id, or None if no such job exists (or it
+        has expired).  Jobs whose operations failed or did not finish in
+        time are reported with state 'timeout'.
+        """
+        now = clock.time()
+        with self._lock:
+            self._expire(now)
+            job = self._jobs.get(job_id)
+            if not job:
+                return None
+            if job['state'] == 'running' and now > job['_finish_by']:
+                job['state'] = 'timeout'
+                job['_expires'] = now + self.ttl
+            return dict((k, v) for k, v in job.iteritems() if not k.startswith('_'))
+
+    def _expire(self, now):
+        # jobs that never finished expire `ttl` seconds after their deadline
+        for job_id in [ j['id'] for j in self._jobs.itervalues()
+                        if (j['_expires'] or j['_finish_by'] + self.ttl) < now ]:
+            del self._jobs[job_id]
+
+jobs = JobStore()
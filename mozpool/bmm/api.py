@@ -2,7 +2,9 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from mozpool.async import async_operation
+import Queue
+import threading
+from mozpool.async import async_operation, TimeoutError
 from mozpool.bmm import relay
 from mozpool.bmm import pxe
 from mozpool.bmm import sut
@@ -27,9 +29,82 @@ class API(object):
     too long.
     """
 
+    # operations that talk to a relay board, and thus must be serialized per
+    # board
+    RELAY_OPERATIONS = ('powercycle', 'poweroff')
+
     def __init__(self, db):
         self.db = db
 
+    def bulk(self, operation, device_names, max_parallel=10):
+        """
+        Synchronously run the named operation (e.g., 'ping') on each of
+        DEVICE_NAMES, with at most MAX_PARALLEL operations in progress at once.
+
+        Relay operations are grouped by relay board and run one after another
+        for each board, since relay boards only handle one connection at a
+        time; other operations are run independently for each device.
+
+        Returns a dictionary mapping device name to the result of the
+        operation for that device.  Operations that fail or time out have
+        result False.
+        """
+        op = getattr(self, operation)
+        groups = self._bulk_groups(operation, device_names)
+
+        work = Queue.Queue()
+        for group in groups.itervalues():
+            work.put(group)
+        results = {}
+
+        def worker():
+            while True:
+                try:
+                    group = work.get_nowait()
+                except Queue.Empty:
+                    return
+                for name in group:
+                    try:
+                        results[name] = op.run(name)
+                    except TimeoutError:
+                        results[name] = False
+
+        threads = [ threading.Thread(target=worker)
+                    for _ in range(min(max_parallel, len(groups))) ]
+        for thd in threads:
+            thd.start()
+        for thd in threads:
+            thd.join()
+        return results
+
+    def bulk_max_time(self, operation, device_names, max_parallel=10):
+        """
+        Return the longest time, in seconds, that `bulk` can take with these
+        arguments, given that each operation is limited to its max_time.
+        """
+        groups = self._bulk_groups(operation, device_names)
+        if not groups:
+            return 0
+        # each worker takes the next group when it finishes one, so no worker
+        # finishes later than an even share of the work plus the largest group
+        largest = max(len(group) for group in groups.itervalues())
+        per_device = getattr(self, operation).max_time
+        return (len(device_names) / float(min(max_parallel, len(groups)))
+                + largest) * per_device
+
+    def _bulk_groups(self, operation, device_names):
+        # group the devices into lists that must be operated on in sequence
+        groups = {}
+        if operation in self.RELAY_OPERATIONS:
+            bmm_info = self.db.devices.list_bmm_info(device_names)
+            for name in device_names:
+                board = bmm_info.get(name, {}).get('relay_board')
+                groups.setdefault(board, []).append(name)
+        else:
+            for name in device_names:
+                groups[name] = [name]
+        return groups
+
     @async_operation(max_time=11)
     def test_two_way_comms(self, relay_name):
         """
@@ -5,7 +5,9 @@
 import datetime
 import web
 import templeton
+from mozpool import async, config
 from mozpool.web.handlers import deviceredirect, relayredirect, Handler
+from mozpool.web.handlers import ServiceUnavailableJSON
 from mozpool.bmm import api
 
 # URLs go here. "/api/" will be automatically prepended to each.
@@ -18,12 +20,26 @@ urls = (
   "/device/([^/]+)/bootconfig/?", "device_bootconfig",
   "/device/([^/]+)/set-comments/?", "device_set_comments",
   "/device/([^/]+)/set-environment/?", "device_set_environment",
+  "/bmm/bulk/([^/]+)/?", "bulk_operation",
   "/environment/list/?", "environment_list",
   "/bmm/pxe_config/list/?", "pxe_config_list",
   "/bmm/pxe_config/([^/]+)/details/?", "pxe_config_details",
   "/relay/([^/]+)/test/?", "test_two_way_comms",
 )
 
+def start_job(name, operation, *args):
+    """
+    Start OPERATION as a job, returning a JSON-able dictionary containing the
+    job id and the URL at which its result can be found.  If too many jobs are
+    running already, this responds with 503 Service Unavailable.
+    """
+    try:
+        job_id = async.jobs.start(name, operation, *args)
+    except async.JobStoreFull, e:
+        raise ServiceUnavailableJSON({'error': str(e)})
+    return { 'job' : job_id,
+             'url' : 'http://%s/api/job/%s/' % (config.get('server', 'fqdn'), job_id) }
+
 class test_two_way_comms(Handler):
     @relayredirect
     @templeton.handlers.json_response
@@ -32,6 +48,13 @@ class test_two_way_comms(Handler):
         # starts a comm check and return the results
         return { 'success' : a.test_two_way_comms.run(relay_name)}
 
+    @relayredirect
+    @templeton.handlers.json_response
+    def POST(self, relay_name):
+        a = api.API(self.db)
+        # start a comm check and return a job handle for the results
+        return start_job('test_two_way_comms', a.test_two_way_comms, relay_name)
+
 class power_cycle(Handler):
     @deviceredirect
     @templeton.handlers.json_response
@@ -68,6 +91,13 @@ class ping(Handler):
         # perform a synchronous ping
         return { 'success' : a.ping.run(device_name) }
 
+    @deviceredirect
+    @templeton.handlers.json_response
+    def POST(self, device_name):
+        a = api.API(self.db)
+        # start a ping and return a job handle for the result
+        return start_job('ping', a.ping, device_name)
+
 class clear_pxe(Handler):
     @deviceredirect
     @templeton.handlers.json_response
@@ -76,6 +106,83 @@ class clear_pxe(Handler):
         a.clear_pxe.run(device_name)
         return {}
 
+class bulk_operation(Handler):
+    """
+    Perform an operation on many devices in one call, as a job, since a
+    power-cycle of every device on a relay board can take minutes.  Devices
+    that are not managed by this imaging server are not operated on; their
+    results indicate the correct imaging server instead.
+    """
+
+    # maximum number of concurrent BMM operations for one call
+    MAX_PARALLEL = 10
+
+    OPERATIONS = ('power-cycle', 'power-off', 'ping', 'clear-pxe', 'set-environment')
+
+    # operations that map directly to an API operation
+    API_OPERATIONS = {'power-cycle': 'powercycle', 'power-off': 'poweroff',
+                      'ping': 'ping'}
+
+    @templeton.handlers.json_response
+    def POST(self, operation):
+        args, body = templeton.handlers.get_request_parms()
+        if operation not in self.OPERATIONS:
+            raise web.notfound()
+        try:
+            device_names = list(body['devices'])
+            environment = None
+            if operation == 'set-environment':
+                environment = body['environment']
+        except (KeyError, TypeError):
+            raise web.badrequest()
+
+        results = {}
+        local_devices = []
+        fqdn = config.get('server', 'fqdn')
+        bmm_info = self.db.devices.list_bmm_info(device_names)
+        for name in device_names:
+            if name not in bmm_info:
+                results[name] = {'success': False, 'error': 'not found'}
+            elif bmm_info[name]['imaging_server'] != fqdn:
+                results[name] = {'success': False, 'error': 'wrong imaging server',
+                                 'imaging_server': bmm_info[name]['imaging_server']}
+            else:
+                local_devices.append(name)
+
+        a = api.API(self.db)
+        # allow a second for the database work, plus the BMM operations
+        max_time = 1
+        if operation in ('clear-pxe', 'power-cycle'):
+            max_time += a.bulk_max_time('clear_pxe', local_devices, self.MAX_PARALLEL)
+        if operation in self.API_OPERATIONS:
+            max_time += a.bulk_max_time(self.API_OPERATIONS[operation],
+                                        local_devices, self.MAX_PARALLEL)
+        op = async.AsyncOperation(self, bulk_operation.bulk, max_time)
+        return start_job('bulk %s' % operation, op,
+                         a, operation, local_devices, environment, results)
+
+    def bulk(self, a, operation, local_devices, environment, results):
+        """
+        Run the operation on LOCAL_DEVICES, adding their results to RESULTS,
+        and return RESULTS.
+        """
+        if operation == 'set-environment':
+            for name in local_devices:
+                self.db.devices.set_environment(name, environment)
+                results[name] = {'success': True}
+        elif operation == 'clear-pxe':
+            # clear_pxe returns nothing on success
+            for name, res in a.bulk('clear_pxe', local_devices, self.MAX_PARALLEL).iteritems():
+                results[name] = {'success': res is not False}
+        else:
+            if operation == 'power-cycle':
+                # as for a single power-cycle, boot from internal storage
+                a.bulk('clear_pxe', local_devices, self.MAX_PARALLEL)
+            api_op = self.API_OPERATIONS[operation]
+            for name, res in a.bulk(api_op, local_devices, self.MAX_PARALLEL).iteritems():
+                results[name] = {'success': bool(res)}
+        return results
+
 class device_log(Handler):
     @templeton.handlers.json_response
     def GET(self, device_name):
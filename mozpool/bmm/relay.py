@@ -22,11 +22,10 @@ that, regardless of network conditions.
 """
 
 from __future__ import with_statement
-import time
 import socket
 import logging
 import errno
-from mozpool import util
+from mozpool import util, clock
 from contextlib import contextmanager
 
 __all__ = ['get_status',
@@ -90,14 +89,14 @@ def serialize_by_relay_board(relay_board_name):
         yield
     finally:
         # sleep long enough for the relay board to recover after the TCP connection
-        time.sleep(ONE_SECOND)
+        clock.sleep(ONE_SECOND)
         locks.release(relay_board_name)
 
 class TimeoutError(Exception):
     pass
 
 def set_timeout(sock, before):
-    remaining = before - time.time()
+    remaining = before - clock.time()
     if remaining <= 0:
         raise TimeoutError
     sock.settimeout(remaining)
@@ -151,7 +150,7 @@ def test_two_way_comms(relay_board_name, timeout):
     Test the two way communications between the ProXR microcontroller and the Digi Connect network module.
     This simply sends a NOOP command to the controler which expects an OK(85) reply.  False on errors.
     """
-    before = time.time() + timeout
+    before = clock.time() + timeout
     with connected_socket(relay_board_name, before) as sock:
         timed_write(sock, START_COMMAND + TEST_2_WAY_COMMS, before)
         res = timed_read(sock, before)
@@ -164,7 +163,7 @@ def get_status(relay_board_name, bank, relay, timeout):
     within TIMEOUT seconds.  Returns None on error, and otherwise a boolean
     (True meaning "on").
     """
-    before = time.time() + timeout
+    before = clock.time() + timeout
 
     assert(bank >= 1 and bank <= 4)
     assert(relay >= 1 and relay <= 8)
@@ -185,7 +184,7 @@ def set_status(relay_board_name, bank, relay, status, timeout):
 
     Return True on success, or False on error.
     """
-    before = time.time() + timeout
+    before = clock.time() + timeout
     assert(bank >= 1 and bank <= 4)
     assert(relay >= 1 and relay <= 8)
 
@@ -210,7 +209,7 @@ def powercycle(relay_board_name, bank, relay, timeout):
 
     Return True if successful, False otherwise.
     """
-    before = time.time() + timeout
+    before = clock.time() + timeout
     assert(bank >= 1 and bank <= 4)
     assert(relay >= 1 and relay <= 8)
 
@@ -234,7 +233,7 @@ def powercycle(relay_board_name, bank, relay, timeout):
 
             # if we just turned the device off, give it a chance to rest
             if status is False:
-                time.sleep(ONE_SECOND)
+                clock.sleep(ONE_SECOND)
         logger.info("power-cycle on %s bank %s relay %s successful" % (relay_board_name, bank, relay))
         return True
 
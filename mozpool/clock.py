@@ -0,0 +1,159 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+The clock used to measure time, wait, and schedule state timeouts.
+
+Code that needs the current time should call the functions in this module
+rather than `time.time`, `time.sleep`, or `datetime.datetime.now`, so that
+tests and simulations can substitute a `SimulatedClock`.  The clock in use is
+available at mozpool.clock.current.
+"""
+
+from __future__ import absolute_import
+
+import time as _time
+import datetime
+import threading
+import contextlib
+
+class Clock(object):
+    """
+    The real (wall-clock) time.
+    """
+
+    def time(self):
+        """Return the current time, in seconds since the epoch."""
+        return _time.time()
+
+    def now(self):
+        """Return the current local time as a datetime."""
+        return datetime.datetime.now()
+
+    def utcnow(self):
+        """Return the current UTC time as a datetime."""
+        return datetime.datetime.utcnow()
+
+    def sleep(self, seconds):
+        _time.sleep(seconds)
+
+    def wait(self, event, timeout):
+        """
+        Wait until the given `threading.Event` is set or TIMEOUT seconds have
+        elapsed, returning true if the event is set.
+        """
+        event.wait(timeout)
+        return event.is_set()
+
+
+class SimulatedClock(Clock):
+    """
+    A clock that only moves when told to: by `advance` or `set`, or by
+    sleeping or waiting, which return immediately after moving the clock
+    forward to the time requested.  A state machine driven with this clock
+    can pass through hours of timeouts in milliseconds.
+
+    Threads sleeping at the same time share the clock: each sleeper has a
+    deadline, and the sleeper with the earliest deadline moves the clock to
+    that deadline and wakes, while the others wait their turn.  So two
+    threads sleeping concurrently for ten seconds each take ten seconds of
+    simulated time, not twenty.  While the clock is held (see `hold`), only
+    `advance` and `set` move it.
+
+    The clock starts at START (in seconds since the epoch), or at the current
+    real time.
+    """
+
+    def __init__(self, start=None):
+        self._cond = threading.Condition()
+        self._now = _time.time() if start is None else start
+        self._deadlines = []
+        self._holds = 0
+
+    def time(self):
+        return self._now
+
+    def now(self):
+        return datetime.datetime.fromtimestamp(self._now)
+
+    def utcnow(self):
+        return datetime.datetime.utcfromtimestamp(self._now)
+
+    def advance(self, seconds):
+        """Move the clock forward by SECONDS."""
+        if seconds < 0:
+            raise ValueError("cannot move a clock backward")
+        with self._cond:
+            self._now += seconds
+            self._cond.notify_all()
+
+    def set(self, when):
+        """Move the clock forward to WHEN, in seconds since the epoch."""
+        with self._cond:
+            if when < self._now:
+                raise ValueError("cannot move a clock backward")
+            self._now = when
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def hold(self):
+        """
+        A context manager which keeps sleepers from moving the clock until it
+        exits, so that several threads can start sleeping at the same time.
+        """
+        with self._cond:
+            self._holds += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._holds -= 1
+                self._cond.notify_all()
+
+    def pending(self):
+        """Return the sorted deadlines of the threads now sleeping."""
+        with self._cond:
+            return sorted(self._deadlines)
+
+    def sleep(self, seconds):
+        with self._cond:
+            deadline = self._now + seconds
+            self._deadlines.append(deadline)
+            try:
+                while self._now < deadline:
+                    if not self._holds and deadline <= min(self._deadlines):
+                        self._now = deadline
+                        break
+                    self._cond.wait()
+            finally:
+                self._deadlines.remove(deadline)
+                # the next sleeper may now be the earliest
+                self._cond.notify_all()
+
+    def wait(self, event, timeout):
+        if not event.is_set():
+            if timeout is None:
+                # nothing but the event can end this wait
+                event.wait()
+            else:
+                self.sleep(timeout)
+        return event.is_set()
+
+
+current = Clock()
+
+def time():
+    return current.time()
+
+def now():
+    return current.now()
+
+def utcnow():
+    return current.utcnow()
+
+def sleep(seconds):
+    current.sleep(seconds)
+
+def wait(event, timeout):
+    return current.wait(event, timeout)
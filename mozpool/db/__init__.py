@@ -5,13 +5,16 @@
 from  mozpool import config
 from . import pool, inventorysync, imaging_servers, requests, devices
 from . import device_requests, pxe_configs, environments, images, relay_boards
+from . import availability, state_transitions
 
 class DB(object):
 
     def __init__(self, db_url):
-        # make the pool and make its 'execute' method easy to find
+        # make the pool and make its 'execute' and 'transaction' methods easy
+        # to find
         self.pool = pool.DBPool(db_url)
         self.execute = self.pool.execute
+        self.transaction = self.pool.transaction
 
         # instantiate each Methods class.  This provides a nice scoped facade
         # where simply-named methods are scoped by topic, e.g., self.images.get
@@ -25,6 +28,8 @@ class DB(object):
         self.pxe_configs = pxe_configs.Methods(self)
         self.inventorysync = inventorysync.Methods(self)
         self.relay_boards = relay_boards.Methods(self)
+        self.availability = availability.Methods(self)
+        self.state_transitions = state_transitions.Methods(self)
 
 def setup(db_url=None):
     if not db_url:
@@ -0,0 +1,203 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import hashlib
+import json
+import threading
+from mozpool import util, clock
+from mozpool.db import base
+
+def boot_config_key(boot_config):
+    """
+    Return a hash of the canonical form of the given JSON boot_config string,
+    such that equivalent boot configs have the same key.
+    """
+    canonical = json.dumps(util.from_json(boot_config or '{}'), sort_keys=True)
+    return hashlib.md5(canonical).hexdigest()
+
+
+class Methods(base.MethodsBase):
+    """
+    An in-memory index of available devices (as defined by
+    `devices.list_available`), keyed by environment, image, and boot_config
+    key, so that finding a device for a request does not require a join and a
+    JSON parse of every candidate's boot config.
+
+    The index is kept up to date by the device and device_request methods as
+    devices change state and are assigned to or released from requests.
+    Changes made by other processes are picked up by reloading the entire
+    index from the database every REFRESH_INTERVAL seconds.  Entries may be
+    briefly stale, so callers must still rely on `device_requests.add` to
+    claim a device.
+
+    Listeners registered with `add_listener` are called, with no arguments,
+    whenever a device is added to the index.
+    """
+
+    REFRESH_INTERVAL = 30
+
+    def __init__(self, db):
+        base.MethodsBase.__init__(self, db)
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        # name -> (environment, image, boot_config key)
+        self._devices = {}
+        # (environment, image, boot_config key) -> set of names
+        self._by_key = {}
+        # environment -> set of names
+        self._by_env = {}
+        # name -> hardware type ID
+        self._hardware_types = {}
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """
+        Call `callback` whenever a device becomes available.  The callback
+        should return quickly, as it may be called with database operations
+        in progress.
+        """
+        self._listeners.append(callback)
+
+    def _notify(self):
+        for callback in self._listeners:
+            callback()
+
+    def _add(self, device):
+        key = (device['environment'], device['image'],
+               boot_config_key(device['boot_config']))
+        self._devices[device['name']] = key
+        self._hardware_types[device['name']] = device['hardware_type_id']
+        self._by_key.setdefault(key, set()).add(device['name'])
+        self._by_env.setdefault(key[0], set()).add(device['name'])
+
+    def _remove(self, device_name):
+        key = self._devices.pop(device_name, None)
+        if not key:
+            return
+        del self._hardware_types[device_name]
+        for index, index_key in (self._by_key, key), (self._by_env, key[0]):
+            names = index[index_key]
+            names.discard(device_name)
+            if not names:
+                del index[index_key]
+
+    def refresh(self):
+        """
+        Reload the entire index from the database.
+        """
+        devices = self.db.devices.list_available()
+        with self._lock:
+            previous = self._devices
+            self._devices, self._by_key, self._by_env = {}, {}, {}
+            self._hardware_types = {}
+            for device in devices:
+                self._add(device)
+            self._loaded_at = clock.time()
+            added = set(self._devices) - set(previous)
+        if added:
+            self._notify()
+
+    def invalidate(self):
+        """
+        Force a reload of the index on the next lookup.
+        """
+        with self._lock:
+            self._loaded_at = None
+
+    def update_device(self, device_name):
+        """
+        Re-check the availability of the given device in the database, adding
+        it to or removing it from the index as necessary.
+        """
+        devices = self.db.devices.list_available(device_name=device_name)
+        with self._lock:
+            self._remove(device_name)
+            for device in devices:
+                self._add(device)
+        if devices:
+            self._notify()
+
+    def discard(self, device_name):
+        """
+        Remove the given device from the index, as it is no longer available.
+        """
+        with self._lock:
+            self._remove(device_name)
+
+    def _maybe_refresh(self):
+        loaded_at = self._loaded_at
+        if loaded_at is None or clock.time() - loaded_at > self.REFRESH_INTERVAL:
+            self.refresh()
+
+    def details(self, device_names):
+        """
+        Return a dictionary mapping each of the given device names to a
+        dictionary with keys 'environment', 'image', 'boot_config_key' (as
+        returned from `boot_config_key`), and 'hardware_type_id'.  Devices not
+        in the index are omitted.
+        """
+        rv = {}
+        with self._lock:
+            for name in device_names:
+                if name in self._devices:
+                    environment, image, bc_key = self._devices[name]
+                    rv[name] = {'environment': environment,
+                                'image': image,
+                                'boot_config_key': bc_key,
+                                'hardware_type_id': self._hardware_types[name]}
+        return rv
+
+    def counts(self):
+        """
+        Return a dictionary mapping environment to the number of available
+        devices in that environment.
+        """
+        self._maybe_refresh()
+        with self._lock:
+            return dict((env, len(names)) for env, names in self._by_env.iteritems())
+
+    def find(self, environment='any', device_name='any', image=None,
+             boot_config=None, prefer_image=False, exclude_environments=()):
+        """
+        Return a list of the names of available devices in the given
+        environment, optionally limited to a particular device.  Pass 'any'
+        for a wildcard.  A particular device missing from the index is looked
+        up in the database.  Devices in any of `exclude_environments` are never
+        returned.  If `prefer_image` is true and some of the available
+        devices already have the given image and boot_config installed, then
+        only those devices are returned.
+        """
+        self._maybe_refresh()
+
+        if device_name != 'any':
+            with self._lock:
+                key = self._devices.get(device_name)
+            if not key:
+                # another server may have made the device available since the
+                # index was loaded, so check the database before giving up
+                self.update_device(device_name)
+                with self._lock:
+                    key = self._devices.get(device_name)
+            if (key and environment in ('any', key[0])
+                    and key[0] not in exclude_environments):
+                return [device_name]
+            return []
+
+        with self._lock:
+            if environment == 'any':
+                environments = self._by_env.keys()
+            else:
+                environments = [environment]
+            environments = [ env for env in environments
+                             if env not in exclude_environments ]
+
+            if prefer_image:
+                bc_key = boot_config_key(boot_config)
+                names = [name for env in environments
+                         for name in self._by_key.get((env, image, bc_key), ())]
+                if names:
+                    return names
+
+            return [name for env in environments
+                    for name in self._by_env.get(env, ())]
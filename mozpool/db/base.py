@@ -2,10 +2,10 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import datetime
 import json
 import sqlalchemy
 from sqlalchemy.sql import select
+from mozpool import clock
 from mozpool.db import exceptions
 
 class MethodsBase(object):
@@ -52,6 +52,19 @@ class StateMachineMethodsMixin(object):
     state_machine_table = None
     state_machine_id_column = None
 
+    # To record state transitions, also set the machine type, and override
+    # _get_transition_attributes.
+    state_machine_type = None
+
+    def _get_transition_attributes(self, id):
+        """
+        Get a dictionary of the attributes to record with a transition of this
+        machine, with keys 'machine_id' and 'imaging_server_id', and optionally
+        'hardware_type_id' and 'image_id'.  The values are scalar subqueries,
+        so that the statement recording the transition looks them up.
+        """
+        raise NotImplementedError
+
     def get_machine_state(self, id):
         """
         Get the state of this object, or raise NotFound
@@ -70,6 +83,16 @@ class StateMachineMethodsMixin(object):
                             where(self.state_machine_id_column==id).
                             values(state=state, state_timeout=timeout))
 
+    def record_transition(self, id, from_state, to_state):
+        """
+        Record a transition of this machine from FROM_STATE to TO_STATE, with
+        the machine's current attributes, in a single statement.  If the
+        machine is not found, the statement fails with an IntegrityError.
+        """
+        attributes = self._get_transition_attributes(id)
+        self.db.state_transitions.add(self.state_machine_type,
+                from_state=from_state, to_state=to_state, key=id, **attributes)
+
     def get_counters(self, id):
         """
         Get the counters for this machine, or raise NotFound
@@ -92,7 +115,7 @@ class StateMachineMethodsMixin(object):
         Get a list of all machine ids whose timeout is in the past, and which
         belong to this imaging server.
         """
-        now = datetime.datetime.now()
+        now = clock.now()
         tbl = self.state_machine_table
         res = self.db.execute(select(
                 [self.state_machine_id_column],
@@ -101,6 +124,18 @@ class StateMachineMethodsMixin(object):
         timed_out = [r[0] for r in res.fetchall()]
         return timed_out
 
+    def count_by_state(self, imaging_server_id):
+        """
+        Get a dictionary mapping each state to the number of machines in that
+        state which belong to this imaging server.
+        """
+        tbl = self.state_machine_table
+        res = self.db.execute(select(
+                [tbl.c.state, sqlalchemy.func.count()],
+                tbl.c.imaging_server_id == imaging_server_id).
+                group_by(tbl.c.state))
+        return dict(res.fetchall())
+
 
 class ObjectLogsMethodsMixin(object):
 
@@ -114,7 +149,7 @@ class ObjectLogsMethodsMixin(object):
         raise NotImplementedError
 
     def log_message(self, object_name, message, source="webapp",
-            _now=datetime.datetime.now):
+            _now=clock.now):
         """
         Add a log message for this object.
         """
@@ -146,7 +181,7 @@ class ObjectLogsMethodsMixin(object):
                     self.logs_table.c.message])
         q = q.order_by(sqlalchemy.desc(self.logs_table.c.ts))
         if timeperiod:
-            from_time = datetime.datetime.now() - timeperiod
+            from_time = clock.now() - timeperiod
             q = q.where(self.logs_table.c.ts>=from_time)
         if limit:
             q = q.limit(limit)
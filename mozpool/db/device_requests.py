@@ -15,6 +15,8 @@ class Methods(base.MethodsBase):
         success, or False on failure (usually because the device is already
         tied to a request)
         """
+        # either way, the device is no longer available
+        self.db.availability.discard(device_name)
         res = self.db.execute(select(
                 [model.devices.c.id],
                 model.devices.c.name==device_name))
@@ -34,8 +36,15 @@ class Methods(base.MethodsBase):
         Clear the association between the given request and its device.  This
         will silently succeed if the request has no associated device.
         """
+        res = self.db.execute(select([model.devices.c.name],
+                from_obj=[model.device_requests.join(model.devices)]).where(
+                model.device_requests.c.request_id==request_id))
+        device_name = self.singleton(res, missing_ok=True)
+        if device_name is None:
+            return
         self.db.execute(model.device_requests.delete().where(
                 model.device_requests.c.request_id==request_id))
+        self.db.availability.update_device(device_name)
 
     def get_by_device(self, device_name):
         """
@@ -3,6 +3,7 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import types
+import sqlalchemy
 from sqlalchemy.sql import and_, select
 from mozpool.db import model, base, exceptions
 
@@ -12,6 +13,7 @@ class Methods(base.MethodsBase,
 
     state_machine_table = model.devices
     state_machine_id_column = model.devices.c.name
+    state_machine_type = 'device'
 
     logs_table = model.device_logs
     foreign_key_col = model.device_logs.c.device_id
@@ -21,6 +23,18 @@ class Methods(base.MethodsBase,
                             model.devices.c.name==object_name))
         return self.singleton(res)
 
+    def _get_transition_attributes(self, device_name):
+        # while a device is being imaged, the image of interest is the one
+        # being installed
+        devices = model.devices
+        def attribute(column):
+            return select([column], devices.c.name==device_name).as_scalar()
+        return {'machine_id': attribute(devices.c.id),
+                'imaging_server_id': attribute(devices.c.imaging_server_id),
+                'hardware_type_id': attribute(devices.c.hardware_type_id),
+                'image_id': attribute(sqlalchemy.func.coalesce(
+                        devices.c.next_image_id, devices.c.image_id))}
+
     def list(self, detail=False):
         """
         Get the list of all devices known to the system.
@@ -52,20 +66,26 @@ class Methods(base.MethodsBase,
             res = self.db.execute(select([model.devices.c.name]))
             return self.column(res)
 
-    def list_available(self, device_name='any', environment='any'):
+    def list_available(self, device_name='any', environment='any',
+                       imaging_server_id=None):
         """
         Get available devices with any other necessary characteristics.  Pass
-        'any' for a wildcard.  It's up to the caller to decide if some of
+        'any' for a wildcard, and an imaging server ID to limit the results to
+        the devices managed by that server.  It's up to the caller to decide if some of
         these devices are better than others (e.g. image already installed).
         "Available" is defined as in the ready state and not attached to an
         existing request.
 
-        This returns a list of dictionaries with keys 'name', 'image', and
-        'boot_config'.
+        This returns a list of dictionaries with keys 'name', 'environment',
+        'hardware_type_id', 'image', and 'boot_config'.
+
+        See also the `availability` methods, which keep an in-memory index of
+        the same information.
         """
         f = model.devices.outerjoin(model.device_requests).outerjoin(
             model.images, model.devices.c.image_id==model.images.c.id)
-        q = select([model.devices.c.name, model.devices.c.boot_config,
+        q = select([model.devices.c.name, model.devices.c.environment,
+                    model.devices.c.hardware_type_id, model.devices.c.boot_config,
                     model.images.c.name.label('image')], from_obj=[f])
         # make sure it's free
         q = q.where(model.devices.c.state=="ready")
@@ -77,8 +97,18 @@ class Methods(base.MethodsBase,
             q = q.where(model.devices.c.name == device_name)
         if environment != 'any':
             q = q.where(model.devices.c.environment == environment)
+        if imaging_server_id is not None:
+            q = q.where(model.devices.c.imaging_server_id == imaging_server_id)
         return self.dict_list(self.db.execute(q))
 
+    def set_machine_state(self, id, state, timeout):
+        base.StateMachineMethodsMixin.set_machine_state(self, id, state, timeout)
+        # keep the availability index up to date
+        if state == 'ready':
+            self.db.availability.update_device(id)
+        else:
+            self.db.availability.discard(id)
+
     def list_states(self):
         """
         Get the state of all devices.  Returns a dictionary with device names
@@ -175,6 +205,28 @@ class Methods(base.MethodsBase,
         assert bank.startswith("bank") and relay.startswith("relay")
         return hostname, int(bank[4:]), int(relay[5:])
 
+    def list_bmm_info(self, device_names):
+        """
+        Get the imaging server and relay board for each of the named devices,
+        in a single query.  Returns a dictionary keyed by device name, with
+        values that are dictionaries with keys 'imaging_server' and
+        'relay_board'.  The relay board is the hostname from the device's
+        relay info, or None if no relay is configured.  Devices that do not
+        exist are omitted.
+        """
+        if not device_names:
+            return {}
+        res = self.db.execute(select(
+                [model.devices.c.name, model.devices.c.relay_info,
+                 model.imaging_servers.c.fqdn],
+                from_obj=[model.devices.join(model.imaging_servers)],
+                whereclause=model.devices.c.name.in_(device_names)))
+        rv = {}
+        for row in res.fetchall():
+            relay_board = row[1].rsplit(":", 2)[0] if row[1] else None
+            rv[row[0]] = {'imaging_server': row[2], 'relay_board': relay_board}
+        return rv
+
     def _get_image(self, image_id_col, boot_config_col, device_name):
         res = self.db.execute(select(
             [boot_config_col.label('boot_config'), model.images.c.name.label('image')],
@@ -218,8 +270,9 @@ class Methods(base.MethodsBase,
 
         Raises NotFound if there is no such image
         """
-        return self._set_image(model.devices.c.image_id, model.devices.c.boot_config,
+        self._set_image(model.devices.c.image_id, model.devices.c.boot_config,
                 device_name, image_name, boot_config)
+        self.db.availability.update_device(device_name)
 
     def get_next_image(self, device_name):
         """
@@ -249,3 +302,4 @@ class Methods(base.MethodsBase,
         self.db.execute(model.devices.update().
                     where(model.devices.c.name==device_name).
                     values(environment=environment))
+        self.db.availability.update_device(device_name)
@@ -49,3 +49,23 @@ class Methods(base.MethodsBase):
         res = self.db.execute(select([model.images.c.can_reuse],
                                             model.images.c.name==image_name))
         return self.singleton(res)
+
+    def list_hardware_types(self):
+        """
+        Get the hardware types that each image can be installed on, as a
+        dictionary mapping image name to a dictionary with keys 'can_reuse' and
+        'hardware_type_ids' (a list of the IDs of the hardware types with a
+        PXE config for the image).  Hidden images are included.
+        """
+        images = model.images
+        ipc = model.image_pxe_configs
+        res = self.db.execute(select(
+                [images.c.name, images.c.can_reuse, ipc.c.hardware_type_id],
+                from_obj=[images.outerjoin(ipc, ipc.c.image_id==images.c.id)]))
+        rv = {}
+        for name, can_reuse, hardware_type_id in res.fetchall():
+            info = rv.setdefault(name, {'can_reuse': bool(can_reuse),
+                                        'hardware_type_ids': []})
+            if hardware_type_id is not None:
+                info['hardware_type_ids'].append(hardware_type_id)
+        return rv
@@ -2,13 +2,16 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import datetime
 import sqlalchemy
-from sqlalchemy.sql import and_
+from sqlalchemy.sql import and_, bindparam
+from mozpool import clock
 from mozpool.db import model, base
 
 class Methods(base.MethodsBase):
 
+    # maximum number of rows in each executemany batch
+    BATCH_SIZE = 500
+
     def dump_devices(self):
         """
         Dump device data.  This returns a list of dictionaries with keys id, name,
@@ -39,7 +42,7 @@ class Methods(base.MethodsBase):
             values.pop('hardware_type'), values.pop('hardware_model'))
         # set up the state machine in the 'new' state, with an immediate timeout
         values['state'] = 'new'
-        values['state_timeout'] = _now or datetime.datetime.now()
+        values['state_timeout'] = _now or clock.now()
         values['state_counters'] = '{}'
 
         self.db.execute(model.devices.insert(), [ values ])
@@ -51,6 +54,7 @@ class Methods(base.MethodsBase):
         # deletes - they'll get flushed when their parititon is dropped.
         self.db.devices.delete_all_logs(id)
         self.db.execute(model.devices.delete(whereclause=(model.devices.c.id==id)))
+        self.db.availability.invalidate()
 
     def update_device(self, id, values):
         """Update an existing device with id ID into the DB.  VALUES should be in
@@ -89,7 +93,7 @@ class Methods(base.MethodsBase):
         # convert imaging_server to its ID, and add a default state and counters
         values['imaging_server_id'] = self._find_imaging_server_id(values.pop('imaging_server'))
         values['state'] = 'ready'
-        values['state_timeout'] = _now or datetime.datetime.now()
+        values['state_timeout'] = _now or clock.now()
         values['state_counters'] = '{}'
 
         self.db.execute(model.relay_boards.insert(), [ values ])
@@ -110,8 +114,103 @@ class Methods(base.MethodsBase):
 
         self.db.execute(model.relay_boards.update(whereclause=(model.relay_boards.c.id==id)), **values)
 
+    def apply(self, device_tasks, relay_board_tasks=(), _now=None):
+        """Apply the tasks generated by inventorysync's merge_devices and
+        merge_relay_boards in a single transaction, so that either all of them
+        take effect or, if any fails, none do.  Imaging servers and hardware
+        types are looked up (and added, if necessary) once, and rows are
+        inserted, updated, and deleted in batches."""
+        device_tasks = list(device_tasks)
+        relay_board_tasks = list(relay_board_tasks)
+        now = _now or clock.now()
+
+        with self.db.transaction() as conn:
+            server_ids = self._find_imaging_server_ids(conn,
+                    set(t[-1]['imaging_server'] for t in device_tasks + relay_board_tasks
+                        if t[0] != 'delete' and 'imaging_server' in t[-1]))
+            hardware_type_ids = self._find_hardware_type_ids(conn,
+                    set((t[-1]['hardware_type'], t[-1]['hardware_model'])
+                        for t in device_tasks
+                        if t[0] != 'delete' and 'hardware_type' in t[-1]))
+
+            def convert(values, defaults):
+                values = values.copy()
+                values.pop('id', None)
+                if 'imaging_server' in values:
+                    values['imaging_server_id'] = server_ids[values.pop('imaging_server')]
+                if 'hardware_type' in values or 'hardware_model' in values:
+                    values['hardware_type_id'] = hardware_type_ids[
+                            (values.pop('hardware_type'), values.pop('hardware_model'))]
+                values.update(defaults)
+                return values
+
+            new_state = dict(state_timeout=now, state_counters='{}')
+            for table, tasks, initial_state, logs_table in [
+                    (model.devices, device_tasks, 'new', model.device_logs),
+                    (model.relay_boards, relay_board_tasks, 'ready', None)]:
+                deletes = [ dict(_id=t[1]) for t in tasks if t[0] == 'delete' ]
+                inserts = [ convert(t[1], dict(new_state, state=initial_state))
+                            for t in tasks if t[0] == 'insert' ]
+                # executemany requires the same columns in every row, so group
+                # the updates by the columns they change
+                updates = {}
+                for t in tasks:
+                    if t[0] == 'update':
+                        values = convert(t[2], {})
+                        values['_id'] = t[1]
+                        updates.setdefault(tuple(sorted(values)), []).append(values)
+                unknown = [ t[0] for t in tasks if t[0] not in ('insert', 'update', 'delete') ]
+                if unknown:
+                    raise RuntimeError('%s is not a task' % unknown[0])
+
+                # foreign keys don't automatically delete log entries, so do it
+                # manually, as for delete_device
+                if logs_table is not None:
+                    self._executemany(conn, logs_table.delete().where(
+                        logs_table.c.device_id==bindparam('_id')), deletes)
+                self._executemany(conn, table.delete().where(
+                    table.c.id==bindparam('_id')), deletes)
+                self._executemany(conn, table.insert(), inserts)
+                for rows in updates.itervalues():
+                    self._executemany(conn, table.update().where(
+                        table.c.id==bindparam('_id')), rows)
+
+        if device_tasks:
+            self.db.availability.invalidate()
+
     # utility methods
 
+    def _executemany(self, conn, stmt, rows):
+        for i in xrange(0, len(rows), self.BATCH_SIZE):
+            conn.execute(stmt, rows[i:i+self.BATCH_SIZE])
+
+    def _find_imaging_server_ids(self, conn, names):
+        # look up all of the servers at once, adding any that are missing
+        tbl = model.imaging_servers
+        def lookup():
+            res = conn.execute(sqlalchemy.select([ tbl.c.fqdn, tbl.c.id ]))
+            return dict((fqdn, id) for fqdn, id in res.fetchall() if fqdn in names)
+        ids = lookup()
+        missing = [ dict(fqdn=name) for name in names if name not in ids ]
+        if missing:
+            conn.execute(tbl.insert(), missing)
+            ids = lookup()
+        return ids
+
+    def _find_hardware_type_ids(self, conn, types):
+        tbl = model.hardware_types
+        def lookup():
+            res = conn.execute(sqlalchemy.select([ tbl.c.type, tbl.c.model, tbl.c.id ]))
+            return dict(((hw_type, hw_model), id) for hw_type, hw_model, id in res.fetchall()
+                        if (hw_type, hw_model) in types)
+        ids = lookup()
+        missing = [ dict(type=hw_type, model=hw_model) for hw_type, hw_model in types
+                    if (hw_type, hw_model) not in ids ]
+        if missing:
+            conn.execute(tbl.insert(), missing)
+            ids = lookup()
+        return ids
+
     def _find_imaging_server_id(self, name):
         # try inserting, ignoring failures (most likely due to duplicate row)
         try:
@@ -56,6 +56,7 @@ requests = sa.Table('requests', metadata,
     sa.Column('state_counters', sa.Text, nullable=False),
     sa.Column('state_timeout', sa.DateTime, nullable=True),
     sa.Column('environment', sa.String(32)),
+    sa.Column('priority', sa.String(32), nullable=False, default='normal'),
 )
 
 device_requests = sa.Table('device_requests', metadata,
@@ -139,3 +140,19 @@ relay_boards = sa.Table('relay_boards', metadata,
     sa.Column('state_counters', sa.Text, nullable=False),
     sa.Column('state_timeout', sa.DateTime, nullable=True),
 )
+
+state_transitions = sa.Table('state_transitions', metadata,
+    sa.Column('id', sa.Integer(unsigned=True), primary_key=True, nullable=False),
+    sa.Column('ts', sa.DateTime, nullable=False),
+    # 'device' or 'request', and the id in the corresponding table
+    sa.Column('machine_type', sa.String(32), nullable=False),
+    sa.Column('machine_id', sa.Integer(unsigned=True), nullable=False),
+    sa.Column('from_state', sa.String(32), nullable=False),
+    sa.Column('to_state', sa.String(32), nullable=False),
+    # seconds spent in from_state, or NULL if not known
+    sa.Column('duration', sa.Float, nullable=True),
+    # attributes of the machine at the time of the transition
+    sa.Column('imaging_server_id', sa.Integer(unsigned=True), nullable=False),
+    sa.Column('hardware_type_id', sa.Integer(unsigned=True), nullable=True),
+    sa.Column('image_id', sa.Integer(unsigned=True), nullable=True),
+)
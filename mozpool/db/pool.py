@@ -2,12 +2,25 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import re
+import sys
+import time
 import socket
+import threading
 import sqlalchemy
 import logging
+from contextlib import contextmanager
+from mozpool import config, metrics
+from mozpool.db import base
 
 logger = logging.getLogger('db.pool')
 
+queries = metrics.counter('mozpool_db_queries_total', 'SQL statements executed')
+query_seconds = metrics.histogram('mozpool_db_query_seconds',
+        'Time taken to execute SQL statements')
+slow_queries = metrics.counter('mozpool_db_slow_queries_total',
+        'SQL statements slower than the slow_query_threshold')
+
 # checkout listener, to make sure each connection is still
 # good when it's checked out
 
@@ -32,16 +45,128 @@ def _pymysql_connect_listener(dbapi_con, connection_record):
 
 # NOTE: the mysqldb driver sets SO_KEEPALIVE itself; no need to do so here
 
+# query instrumentation
+
+_whitespace_re = re.compile(r'\s+')
+_in_list_re = re.compile(
+        r'\bIN \(\s*(?:\?|%s|:\w+)(?:\s*,\s*(?:\?|%s|:\w+))*\s*\)', re.I)
+
+def fingerprint(statement):
+    """
+    Return a normalized form of the SQL STATEMENT, so that statements differing
+    only in whitespace or in the number of values in an IN list are counted
+    together.
+    """
+    statement = _whitespace_re.sub(' ', statement).strip()
+    return _in_list_re.sub('IN (...)', statement)
+
+def _caller():
+    """
+    Describe the code that executed the current statement: for a method of a
+    `Methods` class, the topic and method name, such as
+    'devices.list_available'; otherwise, the module and function name.
+    """
+    frame = sys._getframe(2)
+    while frame:
+        module = frame.f_globals.get('__name__', '')
+        if not (module == __name__ or module == 'contextlib'
+                or module.startswith('sqlalchemy.')):
+            self = frame.f_locals.get('self')
+            if isinstance(self, base.MethodsBase):
+                module = type(self).__module__
+            return '%s.%s' % (module.rsplit('.', 1)[-1], frame.f_code.co_name)
+        frame = frame.f_back
+    return None
+
+class QueryStats(object):
+    """
+    Counts of, and the (wall-clock) time spent in, SQL statements, in total
+    (`count` and `time`) and keyed by statement fingerprint (`by_statement`)
+    and by caller (`by_caller`; only statements with a known caller).  Each
+    value in the latter dictionaries is a dictionary with keys 'count' and
+    'time'.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._paused = 0
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.count = 0
+            self.time = 0.0
+            self.by_statement = {}
+            self.by_caller = {}
+
+    def record(self, statement, caller, elapsed):
+        if self._paused:
+            return
+        with self._lock:
+            self.count += 1
+            self.time += elapsed
+            for key, stats in (statement, self.by_statement), (caller, self.by_caller):
+                if key is None:
+                    continue
+                entry = stats.get(key)
+                if entry is None:
+                    entry = stats[key] = {'count': 0, 'time': 0.0}
+                entry['count'] += 1
+                entry['time'] += elapsed
+
+    @contextmanager
+    def paused(self):
+        """
+        Do not record statements executed within this context, for example
+        by a test harness.
+        """
+        self._paused += 1
+        try:
+            yield
+        finally:
+            self._paused -= 1
+
+    def format(self):
+        """
+        Describe the recorded statements by caller and by statement, most
+        frequent first, as a multi-line string.
+        """
+        lines = ['%d queries in %.3fs' % (self.count, self.time)]
+        for title, stats in ('by caller', self.by_caller), ('by statement', self.by_statement):
+            lines.append(title + ':')
+            for key, entry in sorted(stats.iteritems(), key=lambda kv: -kv[1]['count']):
+                lines.append('  %5d %8.3fs  %s' % (entry['count'], entry['time'], key))
+        return '\n'.join(lines)
+
 class DBPool(object):
+    """
+    A pool of connections to the database.
+
+    Every SQL statement executed through the pool is recorded in `stats`, a
+    `QueryStats` instance, and in any active `count_queries` contexts.  The
+    caller of each statement is only determined within a `count_queries`
+    context, so `stats.by_caller` only covers those statements.
+    Statements taking longer than the `slow_query_threshold` option in the
+    `database` section of the config (in seconds) are logged, with their
+    parameters.
+    """
 
     def __init__(self, db_url):
         self.db_url = db_url
+        self.stats = QueryStats()
+        threshold = config.get('database', 'slow_query_threshold')
+        self.slow_query_threshold = float(threshold) if threshold else None
+        self._local = threading.local()
 
         # optimistically recycle connections after 10m
         engine = self.engine = sqlalchemy.create_engine(db_url, pool_recycle=600)
         # and pessimistically check connections before using them
         sqlalchemy.event.listen(engine.pool, 'checkout', _checkout_listener)
 
+        # and count and time every statement
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', self._before_execute)
+        sqlalchemy.event.listen(engine, 'after_cursor_execute', self._after_execute)
+
         # set sqlite to WAL mode to avoid weird concurrency issues
         if engine.dialect.name == 'sqlite':
             try:
@@ -55,6 +180,52 @@ class DBPool(object):
             if listener:
                 sqlalchemy.event.listen(engine.pool, 'connect', listener)
 
+    def _before_execute(self, conn, cursor, statement, parameters, context,
+                        executemany):
+        # durations are measured in real time, whatever the current clock
+        if context is not None:
+            context._mozpool_started = time.time()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        started = getattr(context, '_mozpool_started', None)
+        elapsed = time.time() - started if started is not None else 0.0
+        statement = fingerprint(statement)
+        # walking the stack for every statement is too costly, so the caller
+        # is only found for a count_queries context or a slow query
+        counters = getattr(self._local, 'counters', ())
+        caller = _caller() if counters else None
+        self.stats.record(statement, caller, elapsed)
+        for stats in counters:
+            stats.record(statement, caller, elapsed)
+        queries.inc()
+        query_seconds.observe(elapsed)
+
+        if self.slow_query_threshold is not None and elapsed > self.slow_query_threshold:
+            slow_queries.inc()
+            if caller is None:
+                caller = _caller()
+            params = repr(parameters)
+            if len(params) > 1000:
+                params = params[:1000] + '...'
+            logger.warning("slow query (%.3fs) from %s: %s; parameters: %s"
+                           % (elapsed, caller, statement, params))
+
+    @contextmanager
+    def count_queries(self):
+        """
+        Context manager to count the statements executed by this thread within
+        the context.  This yields a `QueryStats` instance, which is updated as
+        statements are executed.  Contexts can be nested.
+        """
+        stats = QueryStats()
+        counters = self._local.__dict__.setdefault('counters', [])
+        counters.append(stats)
+        try:
+            yield stats
+        finally:
+            counters.remove(stats)
+
     def execute(self, statement, *args, **kwargs):
         """
         Execute the given sqlalchemy statement.
@@ -64,3 +235,21 @@ class DBPool(object):
         """
         conn = self.engine.connect()
         return conn.execute(statement, *args, **kwargs)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Context manager for a database transaction.  This yields a connection
+        with `execute` method; statements executed on it are committed
+        together when the block exits, or rolled back together if it raises
+        an exception.
+
+        This method is best accessed as an attribute of the DB object:
+        `with self.db.transaction() as conn: ..`
+        """
+        conn = self.engine.connect()
+        try:
+            with conn.begin():
+                yield conn
+        finally:
+            conn.close()
@@ -6,8 +6,8 @@ import datetime
 import json
 import sqlalchemy
 from sqlalchemy.sql import select, not_
-from mozpool.db import model, base, exceptions
-from mozpool import config
+from mozpool.db import model, base, exceptions, availability
+from mozpool import config, clock
 
 class Methods(base.MethodsBase,
         base.ObjectLogsMethodsMixin,
@@ -15,6 +15,7 @@ class Methods(base.MethodsBase,
 
     state_machine_table = model.requests
     state_machine_id_column = model.requests.c.id
+    state_machine_type = 'request'
 
     logs_table = model.request_logs
     foreign_key_col = model.request_logs.c.request_id
@@ -23,38 +24,67 @@ class Methods(base.MethodsBase,
         # requests are referred to by id, so name == id
         return object_name
 
+    def _get_transition_attributes(self, request_id):
+        requests = model.requests
+        def attribute(column):
+            return select([column], requests.c.id==request_id).as_scalar()
+        return {'machine_id': attribute(requests.c.id),
+                'imaging_server_id': attribute(requests.c.imaging_server_id),
+                'image_id': attribute(requests.c.image_id)}
+
     def add(self, requested_device, environment, assignee, duration, image_id,
-            boot_config, _now=datetime.datetime.utcnow):
+            boot_config, priority='normal', _now=clock.utcnow):
         """
         Add a new request with the given parameters.  The state is set to
-        'new'.
+        'new'.  The priority is one of the priority classes in
+        `mozpool.mozpool.requestmachine.PRIORITIES`.
 
         Returns the ID of the new request.
         """
+        request = self._make_request(requested_device, environment, assignee,
+                duration, image_id, boot_config, priority, _now)
+        res = self.db.execute(model.requests.insert(), request)
+        return res.lastrowid
+
+    def add_many(self, count, requested_device, environment, assignee,
+            duration, image_id, boot_config, priority='normal',
+            _now=clock.utcnow):
+        """
+        Add COUNT new requests with identical parameters, as for `add`, in a
+        single transaction.
+
+        Returns a list of the IDs of the new requests.
+        """
+        request = self._make_request(requested_device, environment, assignee,
+                duration, image_id, boot_config, priority, _now)
+        with self.db.transaction() as conn:
+            return [ conn.execute(model.requests.insert(), request).lastrowid
+                     for _ in xrange(count) ]
+
+    def _make_request(self, requested_device, environment, assignee, duration,
+            image_id, boot_config, priority, _now):
         server_id = self.db.execute(select(
                 [model.imaging_servers.c.id],
                 model.imaging_servers.c.fqdn==config.get('server', 'fqdn'))
                                 ).fetchall()[0][0]
-        request = {'imaging_server_id': server_id,
-                    'requested_device': requested_device,
-                    'environment': environment,
-                    'assignee': assignee,
-                    'expires': _now() + datetime.timedelta(seconds=duration),
-                    'image_id': image_id,
-                    'boot_config': json.dumps(boot_config),
-                    'state': 'new',
-                    'state_counters': '{}'}
-
-        res = self.db.execute(model.requests.insert(), request)
-        return res.lastrowid
-
-    def renew(self, request_id, duration, _now=datetime.datetime.utcnow):
+        return {'imaging_server_id': server_id,
+                'requested_device': requested_device,
+                'environment': environment,
+                'assignee': assignee,
+                'expires': _now() + datetime.timedelta(seconds=duration),
+                'image_id': image_id,
+                'boot_config': json.dumps(boot_config),
+                'priority': priority,
+                'state': 'new',
+                'state_counters': '{}'}
+
+    def renew(self, request_id, duration, _now=clock.utcnow):
         q = model.requests.update()
         q = q.where(model.requests.c.id==request_id)
         self.db.execute(q,
             dict(expires=_now() + datetime.timedelta(seconds=duration)))
 
-    def list_expired(self, imaging_server_id, _now=datetime.datetime.utcnow):
+    def list_expired(self, imaging_server_id, _now=clock.utcnow):
         """
         Get a list of all requests whose 'expires' timestamp is in the past,
         are not in the 'closed' state or failed, and which belong to this
@@ -68,6 +98,30 @@ class Methods(base.MethodsBase,
                 & (model.requests.c.imaging_server_id == imaging_server_id)))
         return self.column(res)
 
+    def list_demand(self, limit):
+        """
+        Count the most recent LIMIT requests for reusable images by
+        environment, image, and boot_config.  Returns a list of dictionaries
+        with keys 'environment', 'image', 'boot_config', and 'count', most
+        popular first.  Boot configs are compared by value, not by their JSON
+        representation.
+        """
+        res = self.db.execute(select(
+                [model.requests.c.environment, model.images.c.name,
+                 model.requests.c.boot_config],
+                model.images.c.can_reuse,
+                from_obj=[model.requests.join(model.images)]).order_by(
+                model.requests.c.id.desc()).limit(limit))
+        demand = {}
+        for environment, image, boot_config in res.fetchall():
+            key = (environment, image, availability.boot_config_key(boot_config))
+            entry = demand.setdefault(key, {'environment': environment,
+                    'image': image, 'boot_config': boot_config, 'count': 0})
+            entry['count'] += 1
+        return sorted(demand.itervalues(),
+                      key=lambda e: (-e['count'], e['image'], e['environment'],
+                                     e['boot_config']))
+
     def get_imaging_server(self, request_id):
         """
         Get the name of the imaging server associated with this request.
@@ -84,7 +138,7 @@ class Methods(base.MethodsBase,
 
         Returns a list of dictionaries, each with keys id, imaging_server,
         assignee, boot_config, state, expires, requested_device, environment,
-        assigned_device, and device_state.  The last two are set to the empty
+        priority, assigned_device, and device_state.  The last two are set to the empty
         string if no device is assigned.
         """
         requests = model.requests
@@ -93,7 +147,7 @@ class Methods(base.MethodsBase,
             model.imaging_servers.c.fqdn.label('imaging_server'),
             requests.c.assignee, requests.c.boot_config, requests.c.state,
             requests.c.expires, requests.c.requested_device,
-            requests.c.environment],
+            requests.c.environment, requests.c.priority],
             from_obj=[requests.join(model.imaging_servers)])
         if not include_closed:
             stmt = stmt.where(requests.c.state!='closed')
@@ -136,6 +190,7 @@ class Methods(base.MethodsBase,
           - environment
           - image
           - boot_config
+          - priority
           - assigned_device -- device name or empty string
 
         Raises NotFound if no such request exists.
@@ -145,7 +200,8 @@ class Methods(base.MethodsBase,
                                 model.requests.c.expires,
                                 model.requests.c.environment,
                                 model.images.c.name.label('image'),
-                                model.requests.c.boot_config],
+                                model.requests.c.boot_config,
+                                model.requests.c.priority],
                                 model.requests.c.id==request_id,
                                 from_obj=[model.requests.join(model.images)]))
         row = res.fetchone()
@@ -159,6 +215,7 @@ class Methods(base.MethodsBase,
                 'environment': row[3],
                 'image': row[4],
                 'boot_config': row[5],
+                'priority': row[6],
                 'assigned_device': ''}
 
         assigned_device = self.db.requests.get_assigned_device(request_id)
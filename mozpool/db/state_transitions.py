@@ -0,0 +1,123 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+import threading
+import collections
+from sqlalchemy.sql import select
+from mozpool import clock, util
+from mozpool.db import model, base
+
+# the attributes by which state durations can be grouped
+GROUP_BY = ('hardware_type', 'image', 'imaging_server')
+
+# the period summarized by get_stats, unless another is given
+DEFAULT_TIMEPERIOD = datetime.timedelta(days=1)
+
+# the number of machines whose last transition is remembered, to measure the
+# time spent in the next state
+REMEMBERED_MACHINES = 10000
+
+class Methods(base.MethodsBase):
+
+    def __init__(self, db):
+        base.MethodsBase.__init__(self, db)
+        self._lock = threading.Lock()
+        # (machine_type, key) -> (ts, to_state) of the last transition
+        self._last = collections.OrderedDict()
+
+    def add(self, machine_type, machine_id, from_state, to_state,
+            imaging_server_id, hardware_type_id=None, image_id=None, key=None,
+            _now=clock.now):
+        """
+        Record a transition of the given machine from FROM_STATE to TO_STATE,
+        along with the machine's attributes, which may be values or scalar
+        subqueries.  This executes a single statement.
+
+        The time spent in FROM_STATE is measured from the machine's previous
+        transition, if that transition was recorded by this process and
+        entered FROM_STATE; otherwise it is not known, and recorded as NULL.
+        Machines are identified by KEY, or by MACHINE_ID if KEY is not given,
+        and the last transitions of only `REMEMBERED_MACHINES` machines are
+        kept.
+        """
+        now = _now()
+        machine = (machine_type, machine_id if key is None else key)
+        with self._lock:
+            last = self._last.pop(machine, None)
+        duration = None
+        if last and last[1] == from_state:
+            duration = (now - last[0]).total_seconds()
+        self.db.execute(model.state_transitions.insert().values(
+            ts=now,
+            machine_type=machine_type,
+            machine_id=machine_id,
+            from_state=from_state,
+            to_state=to_state,
+            duration=duration,
+            imaging_server_id=imaging_server_id,
+            hardware_type_id=hardware_type_id,
+            image_id=image_id))
+        with self._lock:
+            self._last[machine] = (now, to_state)
+            while len(self._last) > REMEMBERED_MACHINES:
+                self._last.popitem(last=False)
+
+    def get_stats(self, machine_type, timeperiod=DEFAULT_TIMEPERIOD, states=None,
+                  group_by=GROUP_BY):
+        """
+        Summarize the time machines of the given type spent in each state,
+        over the transitions in the past TIMEPERIOD (a timedelta, by default
+        `DEFAULT_TIMEPERIOD`).  Each duration in the period is loaded to
+        compute the percentiles, so keep the period short.  If STATES is
+        given, only those states are summarized.
+
+        The durations are grouped by state and by the attributes named in
+        GROUP_BY, a subset of `GROUP_BY`, taking the attributes' values at the
+        time each state was left.  Raises ValueError for an unknown attribute.
+
+        Returns a list of dictionaries, sorted by state and attributes, with
+        key 'state'; 'hardware_type' and 'hardware_model', 'image', and
+        'imaging_server', as grouped; and the keys 'count', 'p50', 'p90',
+        'p99', and 'max' (see `mozpool.util.percentiles`), giving durations in
+        seconds.
+        """
+        tbl = model.state_transitions
+        hw = model.hardware_types
+        columns = [tbl.c.from_state.label('state')]
+        from_obj = tbl
+        for attribute in group_by:
+            if attribute == 'hardware_type':
+                columns += [hw.c.type.label('hardware_type'),
+                            hw.c.model.label('hardware_model')]
+                from_obj = from_obj.outerjoin(hw, hw.c.id == tbl.c.hardware_type_id)
+            elif attribute == 'image':
+                columns.append(model.images.c.name.label('image'))
+                from_obj = from_obj.outerjoin(model.images,
+                        model.images.c.id == tbl.c.image_id)
+            elif attribute == 'imaging_server':
+                columns.append(model.imaging_servers.c.fqdn.label('imaging_server'))
+                from_obj = from_obj.outerjoin(model.imaging_servers,
+                        model.imaging_servers.c.id == tbl.c.imaging_server_id)
+            else:
+                raise ValueError("cannot group by %r" % (attribute,))
+
+        q = select(columns + [tbl.c.duration], from_obj=[from_obj])
+        q = q.where((tbl.c.machine_type == machine_type)
+                    & (tbl.c.duration != None)
+                    & (tbl.c.ts >= clock.now() - timeperiod))
+        if states:
+            q = q.where(tbl.c.from_state.in_(states))
+
+        durations = {}
+        for row in self.db.execute(q):
+            durations.setdefault(tuple(row)[:-1], []).append(row.duration)
+
+        names = [c.name for c in columns]
+        stats = []
+        for key in sorted(durations):
+            summary = dict(zip(names, key))
+            summary.update(util.percentiles(durations[key]))
+            stats.append(summary)
+        return stats
@@ -0,0 +1,131 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import json
+import logging
+import collections
+import threading
+import Queue
+from mozpool import config, async
+
+logger = logging.getLogger('eventbus')
+
+class EventBus(object):
+    """
+    Delivers events to device and request state machines, whether they are
+    managed by this process or by another imaging server.
+
+    Events for a machine managed by this server are handed directly to the
+    driver registered for that type of object, on one of a small pool of
+    dispatcher threads, so that the sender never blocks and never re-enters a
+    state machine while holding its lock.  Events for the same machine are
+    delivered one at a time, in the order they were sent; events for
+    different machines are delivered independently, so a slow event handler
+    delays only its own machine.  All other events are POSTed to the managing
+    server's event API, as before.  A driver must be registered for local
+    delivery to occur.
+
+    An instance of this object is available at mozpool.eventbus.bus
+    """
+
+    # number of dispatcher threads
+    pool_size = 4
+
+    def __init__(self):
+        self._drivers = {}
+        # pending events for each machine, keyed by (object_type, name); a
+        # machine's key is in the ready queue, or being dispatched, exactly
+        # when it has pending events
+        self._pending = {}
+        self._ready = Queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def register(self, object_type, driver):
+        """
+        Deliver local events for OBJECT_TYPE ('device' or 'request') to the
+        given driver.
+        """
+        self._drivers[object_type] = driver
+
+    def unregister(self, object_type):
+        self._drivers.pop(object_type, None)
+
+    def is_local(self, object_type, imaging_server):
+        return (object_type in self._drivers and
+                imaging_server == config.get('server', 'fqdn'))
+
+    def send(self, object_type, imaging_server, name, event, body, callback):
+        """
+        Send EVENT with the given (JSON-able) body to the machine NAME of
+        OBJECT_TYPE, managed by IMAGING_SERVER.  The callback is invoked with
+        an HTTP-style status code once the event has been delivered (200) or
+        has failed (anything else); for remote delivery, it may not be called
+        at all.  This method never blocks.
+        """
+        if self.is_local(object_type, imaging_server):
+            self._start_dispatchers()
+            key = (object_type, name)
+            with self._lock:
+                if key in self._pending:
+                    self._pending[key].append((event, body, callback))
+                    return
+                self._pending[key] = collections.deque([(event, body, callback)])
+            self._ready.put(key)
+            return
+
+        url = 'http://%s/api/%s/%s/event/%s/' % (imaging_server, object_type,
+                                                 name, event)
+        def posted(result):
+            callback(result.status_code)
+        async.requests.post.start(posted, url, data=json.dumps(body))
+
+    def _start_dispatchers(self):
+        with self._lock:
+            while len(self._threads) < self.pool_size:
+                thread = threading.Thread(target=self._dispatch,
+                        name='EventBus-%d' % len(self._threads))
+                thread.setDaemon(1)
+                thread.start()
+                self._threads.append(thread)
+
+    def _dispatch(self):
+        while True:
+            key = self._ready.get()
+            # leave the event in place until it is delivered, so that further
+            # events for this machine wait behind it
+            with self._lock:
+                event, body, callback = self._pending[key][0]
+            object_type, name = key
+            self.deliver(object_type, name, event, body, callback)
+            with self._lock:
+                events = self._pending[key]
+                events.popleft()
+                if not events:
+                    del self._pending[key]
+                    continue
+            # go to the back of the line, behind other machines' events
+            self._ready.put(key)
+
+    def deliver(self, object_type, name, event, body, callback):
+        """
+        Deliver a single event to the local driver synchronously.
+        """
+        try:
+            # copy the body, as a JSON round-trip would
+            self._drivers[object_type].handle_event(name, event, dict(body))
+        except Exception:
+            logger.error("failed to deliver %s event %s to %s" %
+                         (object_type, event, name), exc_info=True)
+            status_code = 500
+        else:
+            status_code = 200
+        try:
+            callback(status_code)
+        except Exception:
+            logger.error("exception in event callback", exc_info=True)
+
+bus = EventBus()
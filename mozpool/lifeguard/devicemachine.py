@@ -2,9 +2,8 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import json
 import datetime
-from mozpool import config, statemachine, statedriver, async
+from mozpool import config, statemachine, statedriver, eventbus, clock
 from mozpool.bmm import api
 from mozpool.db import exceptions
 import mozpool.lifeguard
@@ -26,9 +25,12 @@ class DeviceStateMachine(statemachine.StateMachine):
         if timeout_duration is None:
             state_timeout = None
         else:
-            state_timeout = datetime.datetime.now() + datetime.timedelta(seconds=timeout_duration)
+            state_timeout = clock.now() + datetime.timedelta(seconds=timeout_duration)
         self.db.devices.set_machine_state(self.device_name, new_state, state_timeout)
 
+    def write_transition(self, old_state, new_state):
+        self.db.devices.record_transition(self.device_name, old_state, new_state)
+
     def read_counters(self):
         return self.db.devices.get_counters(self.device_name)
 
@@ -213,13 +215,11 @@ class ImagingResultMixin(object):
         # tell mozpool we're finished.  This is a notification, so we really
         # don't care if it succeeds or not
         self.logger.info("sending imaging result '%s' to Mozpool" % imaging_result)
-        mozpool_url = 'http://%s/api/request/%d/event/lifeguard_finished/' % (
-                imaging_svr, req_id)
-        def posted(result):
-            if result.status_code != 200:
-                self.logger.warn("got %d from Mozpool" % result.status_code)
-        async.requests.post.start(posted, mozpool_url,
-                data=json.dumps({'imaging_result': imaging_result}))
+        def posted(status_code):
+            if status_code != 200:
+                self.logger.warn("got %d from Mozpool" % status_code)
+        eventbus.bus.send('request', imaging_svr, req_id, 'lifeguard_finished',
+                {'imaging_result': imaging_result}, posted)
 
 
 ####
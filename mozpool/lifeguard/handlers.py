@@ -7,7 +7,8 @@ import web
 import datetime
 import time
 import mozpool.lifeguard
-from mozpool.web.handlers import deviceredirect, InMemCacheMixin, Handler
+from mozpool.lifeguard import devicemachine
+from mozpool.web.handlers import deviceredirect, InMemCacheMixin, StateWaitMixin, Handler
 
 # URLs go here. "/api/" will be automatically prepended to each.
 urls = (
@@ -15,6 +16,7 @@ urls = (
   "/device/([^/]+)/state-change/([^/]+)/to/([^/]+)/?", "state_change",
   "/device/([^/]+)/status/?", "device_status",
   "/device/([^/]+)/state/?", "device_state",
+  "/device/([^/]+)/wait/?", "device_wait",
 )
 
 # device handlers
@@ -71,3 +73,14 @@ class device_state(Handler, InMemCacheMixin):
             state = self.db.devices.get_machine_state(device_name)
         return { 'state' : state }
 
+
+class device_wait(Handler, StateWaitMixin):
+    machine_cls = devicemachine.DeviceStateMachine
+
+    def read_state(self, device_name):
+        return self.db.devices.get_machine_state(device_name)
+
+    @deviceredirect
+    @templeton.handlers.json_response
+    def GET(self, device_name):
+        return self.wait_for_state_change(device_name)
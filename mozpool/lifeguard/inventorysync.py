@@ -3,12 +3,24 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import os
 import re
+import sys
+import json
+import time
+import hashlib
+import logging
 import argparse
+import threading
+import collections
 import requests
+from requests.adapters import HTTPAdapter
+from multiprocessing.pool import ThreadPool
 from mozpool.db import setup
 from mozpool import config
 
+logger = logging.getLogger('lifeguard.inventorysync')
+
 # systems are represented as a dict with keys:
 #  - id (only for dicts from the database)
 #  - name
@@ -20,120 +32,427 @@ from mozpool import config
 #  - hardware_type (default value used for now)
 #  - hardware_model (default value used for now)
 
-_servermodel_cache = {}
-def get_servermodel(url, username, password, pk):
+class JSONStreamParser(object):
     """
-    Look up a server model by its primary key, as available in the bulk view
-    used by get_devices.  The result is a dictionary with keys 'model' and
-    'vendor'.
+    An incremental parser for a JSON object arriving as a sequence of string
+    chunks.  Only as much of the input as is needed to parse the next value is
+    held in memory.
     """
-    if pk not in _servermodel_cache:
-        path = '/en-US/core/api/v1_core/servermodel/%d/' % pk
-        r = requests.get(url + path, auth=(username, password))
-        if r.status_code != requests.codes.ok:
-            raise RuntimeError('got status code %s from inventory' % r.status_code)
-        _servermodel_cache[pk] = r.json()
-    return _servermodel_cache[pk]
 
-
-_systemstatus_cache = {}
-def get_systemstatus(url, username, password, pk):
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self):
+        # discard what has been consumed and read another chunk; returns False
+        # at the end of the input
+        if self._eof:
+            return False
+        try:
+            chunk = self._chunks.next()
+        except StopIteration:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _next_char(self):
+        "Consume and return the next non-whitespace character"
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in ' \t\r\n':
+                self._pos += 1
+            if self._pos < len(self._buf):
+                self._pos += 1
+                return self._buf[self._pos - 1]
+            if not self._fill():
+                raise ValueError('unexpected end of JSON input')
+
+    def _expect(self, chars):
+        c = self._next_char()
+        if c not in chars:
+            raise ValueError('expected one of %r in JSON input; got %r' % (chars, c))
+        return c
+
+    def _peek(self):
+        c = self._next_char()
+        self._pos -= 1
+        return c
+
+    def value(self):
+        "Parse and return the next complete JSON value"
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except ValueError:
+                if not self._fill():
+                    raise
+                continue
+            # a number at the end of the buffer may be incomplete
+            if end == len(self._buf) and self._fill():
+                continue
+            self._pos = end
+            return value
+
+    def items(self):
+        """
+        Consume an object, yielding its (key, value) pairs one at a time.
+        """
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self.value()
+            self._expect(':')
+            yield key, self
+            if self._expect(',}') == '}':
+                return
+
+    def iter_member(self, name):
+        """
+        Parse a top-level object, yielding the (key, value) pairs of its member
+        NAME, which must be an object.  Other members are parsed and discarded.
+        """
+        for key, parser in self.items():
+            if key == name:
+                for item_key, item_parser in parser.items():
+                    yield item_key, item_parser.value()
+            else:
+                parser.value()
+
+
+class InventoryClient(object):
     """
-    Look up a system status by its primary key, as available in the bulk view
-    used by get_devices.  The result is the string status.
+    A client for the inventory API.  Requests are made over a single pooled,
+    keep-alive session, and the server models and system statuses referenced
+    by a bulk export can be fetched concurrently with `prefetch`.
+
+    Server models and system statuses rarely change, so lookups are cached
+    for `cache_ttl` seconds.  If `cache_file` is given, the cache is loaded
+    from that file and `save_cache` writes it back, so that the cache persists
+    between runs.
     """
-    if pk not in _systemstatus_cache:
-        path = '/en-US/core/api/v1_core/systemstatus/%d/' % pk
-        r = requests.get(url + path, auth=(username, password))
+
+    DEFAULT_CACHE_TTL = 24 * 3600
+
+    # maximum number of concurrent requests to inventory
+    CONCURRENCY = 8
+
+    # size of the chunks in which the bulk export is read
+    CHUNK_SIZE = 64 * 1024
+
+    _paths = {
+        'servermodel': '/en-US/core/api/v1_core/servermodel/%d/',
+        'systemstatus': '/en-US/core/api/v1_core/systemstatus/%d/',
+    }
+
+    def __init__(self, url, username, password, cache_file=None,
+                 cache_ttl=DEFAULT_CACHE_TTL):
+        self.url = url
+        self.cache_file = cache_file
+        self.cache_ttl = cache_ttl
+        self.session = requests.Session()
+        self.session.auth = (username, password)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.CONCURRENCY)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # kind -> { pk: (fetched_at, value) }
+        self._cache = dict((kind, {}) for kind in self._paths)
+        self._lock = threading.Lock()
+        if cache_file:
+            self._load_cache()
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_file) as f:
+                loaded = json.load(f)
+        except (IOError, ValueError):
+            return
+        for kind in self._paths:
+            self._cache[kind] = dict((int(pk), tuple(entry))
+                                     for pk, entry in loaded.get(kind, {}).iteritems())
+
+    def save_cache(self):
+        """
+        Write the cache to `cache_file`, if one was given.  The file is
+        replaced atomically, so concurrent runs do not see partial contents.
+        """
+        if not self.cache_file:
+            return
+        with self._lock:
+            data = json.dumps(self._cache)
+        tmp = self.cache_file + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.rename(tmp, self.cache_file)
+
+    def get(self, path):
+        """
+        GET the given path from inventory, returning the decoded JSON body.
+        """
+        r = self.session.get(self.url + path)
         if r.status_code != requests.codes.ok:
             raise RuntimeError('got status code %s from inventory' % r.status_code)
-        _systemstatus_cache[pk] = r.json()['status']
-    return _systemstatus_cache[pk]
-
+        return r.json()
+
+    def iter_export(self, filter):
+        """
+        Yield (hostname, system) pairs from a bulk export of the hosts matching
+        FILTER.  The export is parsed as it is downloaded, so the whole export
+        is never held in memory.
+        """
+        # bulk_export can't paginate, unfortunately
+        r = self.session.get(self.url + '/en-US/bulk_action/export/?q=' + filter,
+                             stream=True)
+        try:
+            if r.status_code != requests.codes.ok:
+                raise RuntimeError('got status code %s from inventory' % r.status_code)
+            parser = JSONStreamParser(r.iter_content(self.CHUNK_SIZE))
+            for item in parser.iter_member('systems'):
+                yield item
+        finally:
+            r.close()
+
+    def _cached(self, kind, pk):
+        with self._lock:
+            entry = self._cache[kind].get(pk)
+        if entry and time.time() - entry[0] < self.cache_ttl:
+            return entry
+        return None
+
+    def _lookup(self, kind, pk):
+        entry = self._cached(kind, pk)
+        if entry:
+            return entry[1]
+        value = self.get(self._paths[kind] % pk)
+        with self._lock:
+            self._cache[kind][pk] = (time.time(), value)
+        return value
+
+    def prefetch(self, kind, pks):
+        """
+        Fetch any of the given objects of KIND ('servermodel' or
+        'systemstatus') that are not cached, concurrently.
+        """
+        missing = [ pk for pk in set(pks) if not self._cached(kind, pk) ]
+        if not missing:
+            return
+        pool = ThreadPool(min(self.CONCURRENCY, len(missing)))
+        try:
+            pool.map(lambda pk : self._lookup(kind, pk), missing)
+        finally:
+            pool.close()
+
+    def get_servermodel(self, pk):
+        """
+        Look up a server model by its primary key, as available in the bulk
+        export.  The result is a dictionary with keys 'model' and 'vendor'.
+        """
+        return self._lookup('servermodel', pk)
+
+    def get_systemstatus(self, pk):
+        """
+        Look up a system status by its primary key, as available in the bulk
+        export.  The result is the string status.
+        """
+        return self._lookup('systemstatus', pk)['status']
+
+
+def _make_device(client, hostname, o, ignore_devices_on_servers_re, verbose):
+    # convert a system from the bulk export into a device, or None if it
+    # should be skipped
+    if client.get_systemstatus(o['system_status']) == "decommissioned":
+        if verbose: print hostname, 'SKIPPED - decommissioned'
+        return None
 
-def get_devices(url, filter, username, password, ignore_devices_on_servers_re=None, verbose=False):
+    required_keys = 'system.relay.0', 'system.imaging_server.0'
+    kv = dict([ (k, vv['value']) for k, vv in o['keyvalue_set'].iteritems() ])
+    missing = [ k for k in required_keys if k not in kv ]
+    if missing:
+        if verbose: print hostname, 'SKIPPED - missing k/v value(s)', ' '.join(missing)
+        return None
+
+    name = hostname.split('.', 1)[0]
+
+    try:
+        mac_address = o['staticreg_set']['nic0']['hwadapter_set']['hw0']['mac']
+    except KeyError:
+        if verbose: print hostname, 'SKIPPED - no MAC address (looking for SREG "nic0" with adapter "hw0")'
+        return None
+    mac_address = mac_address.replace(':', '').lower()
+
+    if ignore_devices_on_servers_re and \
+       re.match(ignore_devices_on_servers_re, kv['system.imaging_server.0']):
+        if verbose: print hostname, 'SKIPPED - ignored imaging server'
+        return None
+
+    # look up the server_model
+    servermodel = client.get_servermodel(o['server_model'])
+    type, model = servermodel['vendor'], servermodel['model']
+    if verbose: print hostname, 'downloaded.'
+    return dict(
+        name=name,
+        fqdn=hostname,
+        inventory_id=o['pk'],
+        mac_address=mac_address,
+        imaging_server=kv['system.imaging_server.0'],
+        relay_info=kv['system.relay.0'],
+        hardware_type=type,
+        hardware_model=model)
+
+# number of systems whose server models and statuses are looked up together
+BATCH_SIZE = 500
+
+def iter_systems(url, filter, username, password, ignore_devices_on_servers_re=None,
+                 verbose=False, cache_file=None, since=None):
     """
-    Return a list of hosts from inventory.  FILTER is an inventory-style filter
-    for the desired hosts; for a regular expression prefix it with '/'.  Any
-    hosts without 'system.relay.0' or the other required inventory keys are
-    ignored.  Any hosts without an sreg are ignored.  Any hosts with imaging
-    servers matching ignore_devices_on_servers_re are ignored.
+    Yield (system, device) pairs for the systems in inventory matching
+    FILTER, as they are downloaded, where the system is the raw bulk export
+    object and the device is the corresponding device dictionary, or None if
+    the system should not be a device (see `iter_devices`).  If SINCE is
+    given, systems with an 'updated_on' timestamp earlier than SINCE are
+    omitted without being looked up.
     """
-    # bulk_export can't paginate, unfortunately
-    path = '/en-US/bulk_action/export/?q=' + filter
-    rv = []
-    r = requests.get(url + path, auth=(username, password))
-    if r.status_code != requests.codes.ok:
-        raise RuntimeError('got status code %s from inventory' % r.status_code)
-
-    required_keys = 'system.relay.0', 'system.imaging_server.0'
-    for hostname, o in r.json()['systems'].iteritems():
-        if get_systemstatus(url, username, password, o['system_status']) == "decommissioned":
-            if verbose: print hostname, 'SKIPPED - decommissioned'
-            continue
-
-        kv = dict([ (k, vv['value']) for k, vv in o['keyvalue_set'].iteritems() ])
-        missing = [ k for k in required_keys if k not in kv ]
-        if missing:
-            if verbose: print hostname, 'SKIPPED - missing k/v value(s)', ' '.join(missing)
-            continue
-
-        name = hostname.split('.', 1)[0]
-
-        try:
-            mac_address = o['staticreg_set']['nic0']['hwadapter_set']['hw0']['mac']
-        except KeyError:
-            if verbose: print hostname, 'SKIPPED - no MAC address (looking for SREG "nic0" with adapter "hw0")'
+    client = InventoryClient(url, username, password, cache_file=cache_file)
+
+    def process(batch):
+        # look up all of the batch's statuses and models at once
+        client.prefetch('systemstatus', [ o['system_status'] for _, o in batch ])
+        client.prefetch('servermodel', [ o['server_model'] for _, o in batch ])
+        for hostname, o in batch:
+            yield o, _make_device(client, hostname, o,
+                                  ignore_devices_on_servers_re, verbose)
+
+    batch = []
+    for hostname, o in client.iter_export(filter):
+        if since and o.get('updated_on') and o['updated_on'] < since:
             continue
-        mac_address = mac_address.replace(':', '').lower()
-
-        if ignore_devices_on_servers_re and \
-           re.match(ignore_devices_on_servers_re, kv['system.imaging_server.0']):
-            if verbose: print hostname, 'SKIPPED - ignored imaging server'
-            continue
-
-        # look up the server_model
-        servermodel = get_servermodel(url, username, password, o['server_model'])
-        type, model = servermodel['vendor'], servermodel['model']
-        rv.append(dict(
-            name=name,
-            fqdn=hostname,
-            inventory_id=o['pk'],
-            mac_address=mac_address,
-            imaging_server=kv['system.imaging_server.0'],
-            relay_info=kv['system.relay.0'],
-            hardware_type=type,
-            hardware_model=model))
-
-        if verbose: print hostname, 'downloaded.'
+        batch.append((hostname, o))
+        if len(batch) >= BATCH_SIZE:
+            for item in process(batch):
+                yield item
+            batch = []
+    for item in process(batch):
+        yield item
+
+    client.save_cache()
+
+def iter_devices(url, filter, username, password, ignore_devices_on_servers_re=None,
+                 verbose=False, cache_file=None):
+    """
+    Yield hosts from inventory, as they are downloaded.  FILTER is an
+    inventory-style filter for the desired hosts; for a regular expression
+    prefix it with '/'.  Any hosts without 'system.relay.0' or the other
+    required inventory keys are ignored.  Any hosts without an sreg are
+    ignored.  Any hosts with imaging servers matching
+    ignore_devices_on_servers_re are ignored.  Server models and system
+    statuses are cached in CACHE_FILE, if given (see `InventoryClient`).
+    """
+    for _, device in iter_systems(url, filter, username, password,
+                                  ignore_devices_on_servers_re, verbose=verbose,
+                                  cache_file=cache_file):
+        if device:
+            yield device
 
-    return rv
+def get_devices(*args, **kwargs):
+    """
+    Return a list of hosts from inventory; see `iter_devices`.
+    """
+    return list(iter_devices(*args, **kwargs))
 
 def merge_devices(from_db, from_inv):
     """
     Merge a list of hosts in the DB with those in inventory.  This yields a
     list of instructions of the form ('insert', dict), ('delete', id, dict), or
     ('update', id, dict).
+
+    FROM_INV can be any iterable, such as the generator from `iter_devices`,
+    and is only read once; inserts and updates are yielded as it is read, and
+    deletes once it is exhausted.  If it contains duplicate inventory IDs, the
+    first is used.
     """
 
-    # first, key everything by inventory ID
+    # key the DB rows by inventory ID
     from_db = dict([ (r['inventory_id'], r) for r in from_db ])
-    from_inv = dict([ (r['inventory_id'], r) for r in from_inv ])
 
-    # get the insert and deletes out of the way
-    for invid in set(from_db) - set(from_inv):
+    seen = set()
+    for inv_row in from_inv:
+        invid = inv_row['inventory_id']
+        if invid in seen:
+            continue
+        seen.add(invid)
+        if invid not in from_db:
+            yield ('insert', inv_row)
+            continue
+        db_row = from_db[invid].copy()
+        id = db_row.pop('id')
+        if db_row != inv_row:
+            yield ('update', id, inv_row)
+
+    for invid in set(from_db) - seen:
         yield ('delete', from_db[invid]['id'], from_db[invid])
-    for invid in set(from_inv) - set(from_db):
-        yield ('insert', from_inv[invid])
 
-    # now figure out any updates that are required
-    for invid in set(from_inv) & set(from_db):
+def merge_changed_devices(from_db, changes):
+    """
+    Merge the systems changed in inventory with the hosts in the DB, for an
+    incremental sync.  CHANGES is an iterable of (inventory_id, device) pairs,
+    where device is None if the system should no longer be a device.  This
+    yields instructions in the same form as `merge_devices`, but hosts that
+    do not appear in CHANGES are left alone.
+    """
+
+    # key the DB rows by inventory ID
+    from_db = dict([ (r['inventory_id'], r) for r in from_db ])
+
+    seen = set()
+    for invid, inv_row in changes:
+        if invid in seen:
+            continue
+        seen.add(invid)
+        if invid not in from_db:
+            if inv_row:
+                yield ('insert', inv_row)
+            continue
+        if not inv_row:
+            yield ('delete', from_db[invid]['id'], from_db[invid])
+            continue
         db_row = from_db[invid].copy()
         id = db_row.pop('id')
-        inv_row = from_inv[invid]
         if db_row != inv_row:
             yield ('update', id, inv_row)
 
+def apply_device_tasks(from_db, tasks):
+    """
+    Return the list of hosts that will be in the DB once TASKS have been
+    applied to the hosts FROM_DB.
+    """
+    devices = dict([ (r['id'], r) for r in from_db ])
+    result = []
+    for task in tasks:
+        if task[0] == 'insert':
+            result.append(task[1])
+        elif task[0] == 'delete':
+            devices.pop(task[1], None)
+        elif task[0] == 'update':
+            devices[task[1]] = task[2]
+    return devices.values() + result
+
+def _add_relay_board(relay_boards, device):
+    # add the relay board for DEVICE to RELAY_BOARDS, an ordered dictionary
+    # keyed by fqdn, checking that it has only one imaging server
+    fqdn = device['relay_info'].split(':', 1)[0]
+    name = fqdn.split('.', 1)[0]
+    imaging_server = device['imaging_server']
+    if not fqdn in relay_boards:
+        relay_boards[fqdn] = dict(name=name,fqdn=fqdn,imaging_server=imaging_server)
+    elif relay_boards[fqdn]['imaging_server'] != imaging_server:
+        raise RuntimeError("relay '%s' is associated with multiple imaging servers (%r)" % (fqdn, [imaging_server, relay_boards[fqdn]['imaging_server']]))
+
 def get_relay_boards(from_inv):
     """
     Returns a list of dictionaries containing relay_boards derived from a
@@ -141,18 +460,10 @@ def get_relay_boards(from_inv):
     each unique relay board can only have one imaging_system assosiated to it,
     we check for this and raise an AssertionError otherwise.
     """
-    relay_list = []
-    test_dict = {}
+    relay_boards = collections.OrderedDict()
     for device in from_inv:
-        fqdn = device['relay_info'].split(':', 1)[0]
-        name = fqdn.split('.', 1)[0]
-        imaging_server = device['imaging_server']
-        if not fqdn in test_dict:
-            test_dict[fqdn] = imaging_server
-            relay_list.append(dict(name=name,fqdn=fqdn,imaging_server=imaging_server))
-        elif test_dict[fqdn] != imaging_server:
-            raise RuntimeError("relay '%s' is associated with multiple imaging servers (%r)" % (fqdn, [imaging_server, test_dict[fqdn]]))
-    return relay_list
+        _add_relay_board(relay_boards, device)
+    return relay_boards.values()
 
 def merge_relay_boards(relay_boards_from_db, relay_boards_from_inv):
     """
@@ -179,64 +490,209 @@ def merge_relay_boards(relay_boards_from_db, relay_boards_from_inv):
         if db_row != relay_boards_inv_row:
             yield ('update', id, relay_boards_inv_row)
 
-def sync(db, verbose=False, ship_it=False):
+# by default, an incremental sync does a full sync once a day
+DEFAULT_FULL_SYNC_INTERVAL = 24 * 3600
+
+def _load_state(state_file):
+    try:
+        with open(state_file) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def _save_state(state_file, state):
+    # replace the file atomically, as for the inventory cache
+    tmp = state_file + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.rename(tmp, state_file)
+
+def db_fingerprint(from_db, relay_boards_from_db):
+    """
+    Return a fingerprint of the device and relay board rows in the DB, as
+    returned from `dump_devices` and `dump_relays`, that changes if any of
+    them change.
+    """
+    h = hashlib.sha1()
+    for rows in from_db, relay_boards_from_db:
+        for row in sorted(json.dumps(r, sort_keys=True) for r in rows):
+            h.update(row)
+        h.update('\n')
+    return h.hexdigest()
+
+def make_plan(db, verbose=False, incremental=False):
+    """
+    Compare the DB with inventory and return a plan of the changes to make,
+    which can be saved as JSON and later applied with `apply_plan`.  The plan
+    is a dictionary with keys
+
+      - devices -- device tasks from `merge_devices`
+      - relay_boards -- relay board tasks from `merge_relay_boards`
+      - fingerprint -- `db_fingerprint` of the DB the plan was made from
+      - db_count, inventory_count -- numbers of devices, for `check_plan`
+      - full_sync -- false for an incremental plan
+      - high_water_mark -- newest change seen in inventory
+    """
     ignore_devices_on_servers_re = None
     if config.has_option('inventory', 'ignore_devices_on_servers_re'):
         ignore_devices_on_servers_re = config.get('inventory', 'ignore_devices_on_servers_re')
-    from_inv = get_devices(
-            config.get('inventory', 'url'),
-            config.get('inventory', 'filter'),
-            config.get('inventory', 'username'),
-            config.get('inventory', 'password'),
-            ignore_devices_on_servers_re,
-            verbose=verbose)
-    # dump the db second, since otherwise the mysql server can go away while
-    # get_devices is still running, which is no fun
+    cache_file = None
+    if config.has_option('inventory', 'cache_file'):
+        cache_file = config.get('inventory', 'cache_file')
+
+    # An incremental sync only looks at the systems changed since the newest
+    # change seen by the last sync (the high-water mark), so it cannot see
+    # systems removed from inventory; a full sync is done instead if there is
+    # no high-water mark, or the last full sync was too long ago.
+    # Without an incremental filter, inventory cannot export only the changed
+    # systems, so the whole export would be downloaded anyway; that is only
+    # done if explicitly configured.
+    has_incremental_filter = config.has_option('inventory', 'incremental_filter')
+    if (incremental and not has_incremental_filter and
+            config.get('inventory', 'incremental_full_download') != 'true'):
+        raise RuntimeError("an incremental sync requires [inventory] incremental_filter "
+                           "(or incremental_full_download = true to download the "
+                           "whole export and skip unchanged systems)")
+    state = {}
+    if config.has_option('inventory', 'state_file'):
+        state = _load_state(config.get('inventory', 'state_file'))
+    full_sync_interval = DEFAULT_FULL_SYNC_INTERVAL
+    if config.has_option('inventory', 'full_sync_interval'):
+        full_sync_interval = int(config.get('inventory', 'full_sync_interval'))
+    since = None
+    if (incremental and state.get('high_water_mark') and
+            time.time() - state.get('last_full_sync', 0) < full_sync_interval):
+        since = state['high_water_mark']
+    filter = config.get('inventory', 'filter')
+    if since and has_incremental_filter:
+        filter = config.get('inventory', 'incremental_filter').format(since=since)
+    elif since:
+        logger.warning("no [inventory] incremental_filter is configured; downloading "
+                       "the whole inventory export to find the systems changed "
+                       "since %s" % since)
+    if verbose:
+        print "incremental sync since %s" % since if since else "full sync"
+
+    # dump the db first, as the inventory is merged while it is downloaded.
+    # The DB pool checks connections when they are checked out, so the mysql
+    # server going away during the download is not a problem.
     from_db = db.inventorysync.dump_devices()
 
-    ## get a list of relay_boards derived from the inventory dump
-    relay_boards_from_inv = get_relay_boards(from_inv)
-    ## get existing relay_board list from DB
-    relay_boards_from_db = db.inventorysync.dump_relays()
+    # stream the devices from inventory into the merge, keeping only a count,
+    # the newest change, and the relay boards they refer to
+    relay_boards = collections.OrderedDict()
+    inv_count = [0]
+    high_water_mark = [state.get('high_water_mark')]
+    def from_inv():
+        for system, device in iter_systems(
+                config.get('inventory', 'url'),
+                filter,
+                config.get('inventory', 'username'),
+                config.get('inventory', 'password'),
+                ignore_devices_on_servers_re,
+                verbose=verbose,
+                cache_file=cache_file,
+                since=since):
+            if system.get('updated_on') > high_water_mark[0]:
+                high_water_mark[0] = system['updated_on']
+            if since:
+                yield system['pk'], device
+            elif device:
+                inv_count[0] += 1
+                _add_relay_board(relay_boards, device)
+                yield device
 
     # get the list of changes that need to be made
-    tasks = list(merge_devices(from_db, from_inv))
+    if since:
+        tasks = list(merge_changed_devices(from_db, from_inv()))
+        # relay boards are derived from all of the devices, changed or not
+        for device in apply_device_tasks(from_db, tasks):
+            _add_relay_board(relay_boards, device)
+    else:
+        tasks = list(merge_devices(from_db, from_inv()))
+
+    ## get the list of relay_boards derived from the inventory dump
+    relay_boards_from_inv = relay_boards.values()
+    ## get existing relay_board list from DB
+    relay_boards_from_db = db.inventorysync.dump_relays()
 
-    # If there are too many changes, bail out and await human interaction.
-    # "Too many" means more than 5 and more than a tenth of the larger of the
-    # set of devices currently in inventory and the set in the DB.  This is a
-    # failsafe to keep the inventory sync from unexpectedly erasing all
-    # devices.
-    if len(tasks) > max(5, len(from_db) / 10, len(from_inv) / 10) and not ship_it:
-        raise RuntimeError("%d changes: pass --ship-it to make these changes" % len(tasks))
+    relay_board_tasks = list(merge_relay_boards(relay_boards_from_db, relay_boards_from_inv))
 
-    # start merging devices
-    for task in tasks:
-        if task[0] == 'insert':
-            if verbose: print "insert device", task[1]['fqdn']
-            db.inventorysync.insert_device(task[1])
-        elif task[0] == 'delete':
-            if verbose: print "delete device", task[2]
-            db.inventorysync.delete_device(task[1])
-        elif task[0] == 'update':
-            if verbose: print "update device", task[2]
-            db.inventorysync.update_device(task[1], task[2])
-        else:
-            raise RuntimeError('%s is not a task' % task[0])
+    return dict(
+        devices=tasks,
+        relay_boards=relay_board_tasks,
+        fingerprint=db_fingerprint(from_db, relay_boards_from_db),
+        db_count=len(from_db),
+        inventory_count=inv_count[0],
+        full_sync=not since,
+        high_water_mark=high_water_mark[0])
 
-    # start merging relay_boards
-    for task in merge_relay_boards(relay_boards_from_db, relay_boards_from_inv):
-        if task[0] == 'insert':
-            if verbose: print "insert relay_board", task[1]['fqdn']
-            db.inventorysync.insert_relay_board(task[1])
-        elif task[0] == 'delete':
-            if verbose: print "delete relay_board", task[2]
-            db.inventorysync.delete_relay_board(task[1])
-        elif task[0] == 'update':
-            if verbose: print "update relay_board", task[2]
-            db.inventorysync.update_relay_board(task[1], task[2])
-        else:
-            raise RuntimeError('%s is not a task' % task[0])
+def check_plan(plan):
+    """
+    If there are too many changes in the plan, bail out and await human
+    interaction.  "Too many" means more than 5 and more than a tenth of the
+    larger of the set of devices currently in inventory and the set in the DB.
+    This is a failsafe to keep the inventory sync from unexpectedly erasing
+    all devices.
+    """
+    count = len(plan['devices'])
+    if count > max(5, plan['db_count'] / 10, plan['inventory_count'] / 10):
+        raise RuntimeError("%d changes: pass --ship-it to make these changes, "
+                           "or --plan to review them" % count)
+
+def save_plan(plan, filename):
+    with open(filename, 'w') as f:
+        json.dump(plan, f, indent=2, sort_keys=True)
+
+def load_plan(filename):
+    with open(filename) as f:
+        plan = json.load(f)
+    # JSON has no tuples
+    for kind in 'devices', 'relay_boards':
+        plan[kind] = [ tuple(task) for task in plan[kind] ]
+    return plan
+
+def apply_plan(db, plan, verbose=False, check_fingerprint=False):
+    """
+    Apply the changes in PLAN to the DB in a single transaction, and record
+    the sync in the [inventory] state_file, if any.  If CHECK_FINGERPRINT is
+    true, first verify that the DB has not changed since the plan was made.
+    """
+    if check_fingerprint:
+        fingerprint = db_fingerprint(db.inventorysync.dump_devices(),
+                                     db.inventorysync.dump_relays())
+        if fingerprint != plan['fingerprint']:
+            raise RuntimeError("the DB has changed since this plan was made; "
+                               "make a new plan")
+
+    tasks, relay_board_tasks = plan['devices'], plan['relay_boards']
+    if verbose:
+        for kind, task_list in ('device', tasks), ('relay_board', relay_board_tasks):
+            for task in task_list:
+                if task[0] == 'insert':
+                    print "insert", kind, task[1]['fqdn']
+                else:
+                    print task[0], kind, task[2]
+
+    # apply all of the changes in a single transaction
+    db.inventorysync.apply(tasks, relay_board_tasks)
+
+    if config.has_option('inventory', 'state_file'):
+        state_file = config.get('inventory', 'state_file')
+        state = _load_state(state_file)
+        # never move the high-water mark backward, in case a later sync has
+        # already been run
+        state['high_water_mark'] = max(state.get('high_water_mark'),
+                                       plan['high_water_mark'])
+        if plan['full_sync']:
+            state['last_full_sync'] = time.time()
+        _save_state(state_file, state)
+
+def sync(db, verbose=False, ship_it=False, incremental=False):
+    plan = make_plan(db, verbose=verbose, incremental=incremental)
+    if not ship_it:
+        check_plan(plan)
+    apply_plan(db, plan, verbose=verbose)
 
 def main():
     parser = argparse.ArgumentParser(description='Sync BMM with inventory.')
@@ -246,7 +702,30 @@ def main():
     parser.add_argument('--ship-it', action='store_true',
                         default=False,
                         help="Make large changes; don't use this flag in a crontask!")
+    parser.add_argument('--incremental', action='store_true',
+                        default=False,
+                        help='only sync systems changed since the last sync, with a '
+                             'periodic full sync (requires [inventory] state_file and '
+                             'incremental_filter)')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--plan', metavar='FILE',
+                       help='write the changes to FILE for review, instead of making them')
+    group.add_argument('--apply', metavar='FILE',
+                       help='make the changes in FILE, written by --plan, without '
+                            'consulting inventory, if the DB has not changed since')
     args = parser.parse_args()
 
+    logging.basicConfig(stream=sys.stderr, level=logging.WARNING,
+                        format='%(levelname)s - %(message)s')
     db = setup()
-    sync(db, verbose=args.verbose, ship_it=args.ship_it)
+    if args.plan:
+        plan = make_plan(db, verbose=args.verbose, incremental=args.incremental)
+        save_plan(plan, args.plan)
+        print "%d device changes and %d relay board changes written to %s" % (
+                len(plan['devices']), len(plan['relay_boards']), args.plan)
+    elif args.apply:
+        apply_plan(db, load_plan(args.apply), verbose=args.verbose,
+                   check_fingerprint=True)
+    else:
+        sync(db, verbose=args.verbose, ship_it=args.ship_it,
+             incremental=args.incremental)
@@ -0,0 +1,241 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Operational metrics: counters, gauges, and histograms, rendered in the
+Prometheus text exposition format at /api/metrics.
+
+Metrics are created at import time by the modules that update them, with the
+`counter`, `gauge`, and `histogram` functions, which register them in the
+registry at mozpool.metrics.registry.  A metric with label names has a
+separate value for each combination of label values; select one with
+`labels`, e.g., `transitions.labels('device', 'ready').inc()`.
+
+Updating a metric takes a dictionary lookup and a lock, so it is cheap enough
+for hot paths.  Values are only formatted when the metrics are rendered.
+"""
+
+from __future__ import absolute_import
+
+import bisect
+import threading
+
+# default histogram buckets, suitable for durations in seconds
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+def _escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (n, _escape(v)) for n, v in zip(names, values))
+
+
+class _Metric(object):
+    """
+    Base class for metrics.  Subclasses define `type`, `_new_child`, and
+    `_samples`.
+    """
+
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = {}
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+
+    def labels(self, *values):
+        """
+        Return the value for the given label values, one for each label name,
+        creating it if necessary.
+        """
+        try:
+            return self._children[values]
+        except KeyError:
+            if len(values) != len(self.labelnames):
+                raise ValueError("%s has labels %s" % (self.name, self.labelnames))
+            with self._lock:
+                return self._children.setdefault(values, self._new_child())
+
+    def clear(self):
+        """Forget the values for all label values."""
+        with self._lock:
+            self._children = {} if self.labelnames else {(): self._new_child()}
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help.replace('\n', ' ')),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        for values, child in sorted(self._children.items()):
+            for suffix, extra, value in child._samples():
+                labels = _format_labels(self.labelnames + extra[0], values + extra[1])
+                lines.append('%s%s%s %s' % (self.name, suffix, labels, _format_value(value)))
+        return '\n'.join(lines)
+
+
+class _Value(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def _samples(self):
+        return [('', ((), ()), self.value)]
+
+
+class Counter(_Metric):
+    "A value that only increases, such as a number of events."
+
+    type = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._children[()].inc(amount)
+
+    @property
+    def value(self):
+        return self._children[()].value
+
+
+class Gauge(_Metric):
+    "A value that can go up and down, such as a number of devices."
+
+    type = 'gauge'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._children[()].inc(amount)
+
+    def dec(self, amount=1):
+        self._children[()].dec(amount)
+
+    def set(self, value):
+        self._children[()].set(value)
+
+    @property
+    def value(self):
+        return self._children[()].value
+
+
+class _Buckets(object):
+
+    def __init__(self, bounds):
+        self._lock = threading.Lock()
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def _samples(self):
+        with self._lock:
+            counts, count, sum = list(self.counts), self.count, self.sum
+        samples = []
+        cumulative = 0
+        for bound, n in zip(self.bounds + (float('inf'),), counts):
+            cumulative += n
+            samples.append(('_bucket', (('le',), (_format_value(bound),)), cumulative))
+        samples.append(('_sum', ((), ()), sum))
+        samples.append(('_count', ((), ()), count))
+        return samples
+
+
+class Histogram(_Metric):
+    """
+    The distribution of observed values, such as durations, counted in
+    buckets with the given upper bounds.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        _Metric.__init__(self, name, help, labelnames)
+
+    def _new_child(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value):
+        self._children[()].observe(value)
+
+
+class Registry(object):
+    """
+    A collection of metrics, by name.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def register(self, metric):
+        """
+        Add METRIC to the registry and return it.  If a metric of the same
+        name and type is already registered, that metric is returned instead,
+        so that a module can be reloaded.
+        """
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric):
+                    raise ValueError("metric %s is already registered" % metric.name)
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        "Return all metrics in the text exposition format."
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        return ''.join(metric.render() + '\n' for _, metric in metrics)
+
+
+registry = Registry()
+
+def counter(name, help, labelnames=()):
+    return registry.register(Counter(name, help, labelnames))
+
+def gauge(name, help, labelnames=()):
+    return registry.register(Gauge(name, help, labelnames))
+
+def histogram(name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return registry.register(Histogram(name, help, labelnames, buckets))
@@ -4,21 +4,30 @@
 
 from __future__ import absolute_import
 
+import datetime
 import templeton
 import web
 
 import mozpool.mozpool
 from mozpool import config
-from mozpool.db import exceptions
+from mozpool.db import exceptions, state_transitions
+from mozpool.mozpool import requestmachine
 from mozpool.web.handlers import Handler, requestredirect, nocontent, ConflictJSON
+from mozpool.web.handlers import StateWaitMixin
 
 urls = (
     "/device/list/?", "device_list",
+    "/device/state-durations/?", "device_state_durations",
     "/device/([^/]+)/request/?", "device_request",
 
     "/request/list/?", "request_list",
+    "/request/bulk/?", "request_bulk",
+    "/request/queue/?", "request_queue",
+    "/request/stats/?", "request_stats",
+    "/request/state-durations/?", "request_state_durations",
     "/request/([^/]+)/details/?", "request_details",
     "/request/([^/]+)/status/?", "request_status",
+    "/request/([^/]+)/wait/?", "request_wait",
     "/request/([^/]+)/log/?", "request_log",
     "/request/([^/]+)/renew/?", "request_renew",
     "/request/([^/]+)/return/?", "request_return",
@@ -33,40 +42,118 @@ class device_list(Handler):
         args, _ = templeton.handlers.get_request_parms()
         return {'devices': self.db.devices.list(detail='details' in args)}
 
-class device_request(Handler):
+class StateDurationsMixin(object):
+    """
+    Summarize the time machines of type `machine_type` spent in each state,
+    over the last day or the given 'timeperiod' (in seconds), for the given
+    'state's (which may be repeated) or all states, grouped by a
+    comma-separated list of attributes in 'group_by'.
+    """
+
+    machine_type = None
+    DEFAULT_TIMEPERIOD = 86400
+
     @templeton.handlers.json_response
-    def POST(self, device_name):
-        args, body = templeton.handlers.get_request_parms()
+    def GET(self):
+        args, _ = templeton.handlers.get_request_parms()
         try:
-            assignee = body['assignee']
-            duration = int(body['duration'])
-            image_name = body['image']
-            environment = body.get('environment', 'any')
-        except (KeyError, ValueError):
+            seconds = int(args.get('timeperiod', [self.DEFAULT_TIMEPERIOD])[0])
+            timeperiod = datetime.timedelta(seconds=seconds)
+            if 'group_by' in args:
+                group_by = [a for a in args['group_by'][0].split(',') if a]
+            else:
+                group_by = state_transitions.GROUP_BY
+            stats = self.db.state_transitions.get_stats(self.machine_type,
+                    timeperiod=timeperiod, states=args.get('state'),
+                    group_by=group_by)
+        except ValueError:
             raise web.badrequest()
-
+        return {'stats': stats}
+
+class device_state_durations(StateDurationsMixin, Handler):
+    machine_type = 'device'
+
+def parse_request_body(db, body):
+    """
+    Parse the body of a device request, returning a tuple (assignee,
+    duration, image, environment, boot_config, priority), where image is the
+    image information from the DB.  Raises the appropriate HTTP error if the
+    body is invalid.
+    """
+    try:
+        assignee = body['assignee']
+        duration = int(body['duration'])
+        image_name = body['image']
+        environment = body.get('environment', 'any')
+        priority = body.get('priority', requestmachine.DEFAULT_PRIORITY)
+    except (KeyError, ValueError, TypeError):
+        raise web.badrequest()
+    if priority not in requestmachine.PRIORITIES:
+        raise web.badrequest()
+
+    try:
+        image = db.images.get(image_name)
+    except exceptions.NotFound:
+        raise web.notfound()
+
+    boot_config = {}
+    for k in image['boot_config_keys']:
         try:
-            image = self.db.images.get(image_name)
-        except exceptions.NotFound:
-            raise web.notfound()
+            boot_config[k] = body[k]
+        except KeyError:
+            raise web.badrequest()
+    return assignee, duration, image, environment, boot_config, priority
+
+def request_url(request_id):
+    return "http://%s/api/request/%d/" % ((config.get('server', 'fqdn'), request_id))
 
-        boot_config = {}
-        for k in image['boot_config_keys']:
-            try:
-                boot_config[k] = body[k]
-            except KeyError:
-                raise web.badrequest()
+class device_request(Handler):
+    @templeton.handlers.json_response
+    def POST(self, device_name):
+        args, body = templeton.handlers.get_request_parms()
+        assignee, duration, image, environment, boot_config, priority = \
+                parse_request_body(self.db, body)
 
         request_id = self.db.requests.add(device_name, environment, assignee,
-                duration, image['id'], boot_config)
+                duration, image['id'], boot_config, priority)
         mozpool.mozpool.driver.handle_event(request_id, 'find_device', None)
         info = self.db.requests.get_info(request_id)
-        info['url'] = "http://%s/api/request/%d/" % ((config.get('server', 'fqdn'), request_id))
+        info['url'] = request_url(request_id)
         response_data = {'request': info}
         if self.db.requests.get_machine_state(request_id) == 'closed':
             raise ConflictJSON(response_data)
         return response_data
 
+class request_bulk(Handler):
+    """
+    Request several devices at once.  This creates all of the requests in a
+    single transaction and assigns devices to them in a single pass, rather
+    than having them compete for devices.
+    """
+
+    MAX_COUNT = 100
+
+    @templeton.handlers.json_response
+    def POST(self):
+        args, body = templeton.handlers.get_request_parms()
+        assignee, duration, image, environment, boot_config, priority = \
+                parse_request_body(self.db, body)
+        try:
+            count = int(body['count'])
+        except (KeyError, ValueError):
+            raise web.badrequest()
+        if not 0 < count <= self.MAX_COUNT:
+            raise web.badrequest()
+
+        request_ids = self.db.requests.add_many(count, 'any', environment,
+                assignee, duration, image['id'], boot_config, priority)
+        assigned = mozpool.mozpool.driver.allocate_requests(request_ids)
+        return {'requests': [
+            {'id': request_id,
+             'url': request_url(request_id),
+             'assigned_device': assigned.get(request_id) or ''}
+            for request_id in request_ids ]}
+
 class request_list(Handler):
     @templeton.handlers.json_response
     def GET(self):
@@ -74,13 +161,28 @@ class request_list(Handler):
         include_closed = args.get('include_closed', False)
         return dict(requests=self.db.requests.list(include_closed=include_closed))
 
+class request_queue(Handler):
+    @templeton.handlers.json_response
+    def GET(self):
+        return {'queue': mozpool.mozpool.driver.request_queue.list()}
+
+class request_stats(Handler):
+    @templeton.handlers.json_response
+    def GET(self):
+        driver = mozpool.mozpool.driver
+        return {'allocation_times': driver.allocation_stats.get(),
+                'prewarm': driver.prewarmer.get_stats()}
+
+class request_state_durations(StateDurationsMixin, Handler):
+    machine_type = 'request'
+
 class request_details(Handler):
     @templeton.handlers.json_response
     def GET(self, request_id):
         try:
             request_id = int(request_id)
             info = self.db.requests.get_info(request_id)
-            info['url'] = "http://%s/api/request/%d/" % ((config.get('server', 'fqdn'), request_id))
+            info['url'] = request_url(request_id)
             return info
         except ValueError:
             raise web.badrequest()
@@ -94,6 +196,21 @@ class request_status(Handler):
         logs = self.db.requests.get_logs(request_id, limit=100)
         return {'state': state, 'log': logs}
 
+class request_wait(Handler, StateWaitMixin):
+    machine_cls = requestmachine.RequestStateMachine
+
+    def read_state(self, request_id):
+        return self.db.requests.get_machine_state(request_id)
+
+    @requestredirect
+    @templeton.handlers.json_response
+    def GET(self, request_id):
+        try:
+            request_id = int(request_id)
+        except ValueError:
+            raise web.badrequest()
+        return self.wait_for_state_change(request_id)
+
 class request_log(Handler):
     @templeton.handlers.json_response
     def GET(self, request_id):
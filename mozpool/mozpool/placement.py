@@ -0,0 +1,155 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Placement of requests on available devices.
+
+Preparing a device for a request can take anywhere from a minute (power
+cycling a device that already has the right image) to well over ten minutes
+(PXE booting and installing a new image), so the choice of device matters.  The
+placement engine estimates the preparation time for each candidate device
+and picks the quickest, learning from the preparation times it observes.
+"""
+
+import random
+import threading
+
+from mozpool import clock
+from mozpool.db import availability
+
+class PlacementEngine(object):
+    """
+    Choose the device for a request with the least expected preparation time,
+    based on the image installed on each device, whether its hardware type
+    can take the requested image, and the preparation times previously seen
+    for that hardware type and image.
+
+    Devices that already have a reusable image installed are held back from
+    requests that would have to reimage them, so that they remain available
+    for requests that can reuse them.
+    """
+
+    # estimates, in seconds, used until preparation has been observed
+    DEFAULT_TIMES = {'please_image': 600, 'please_power_cycle': 60}
+
+    # added to the estimate for a device whose hardware type has no PXE
+    # config for the requested image, since imaging it will fail
+    UNIMAGEABLE_PENALTY = 24 * 3600
+
+    # added to the estimate for a device that would lose a reusable image
+    HOLD_BACK_PENALTY = 300
+
+    # weight given to each new observation in the moving averages
+    SMOOTHING = 0.2
+
+    # how long to cache image information from the DB, in seconds
+    IMAGE_INFO_TTL = 60
+
+    def __init__(self, db):
+        self.db = db
+        self._lock = threading.Lock()
+        # (hardware_type_id, image, event) -> estimated seconds
+        self._estimates = {}
+        # request ID -> (hardware_type_id, image)
+        self._placements = {}
+        # request ID -> ((hardware_type_id, image, event), start time)
+        self._started = {}
+        self._image_info = {}
+        self._image_info_loaded_at = None
+
+    def _get_image_info(self):
+        loaded_at = self._image_info_loaded_at
+        if loaded_at is None or clock.time() - loaded_at > self.IMAGE_INFO_TTL:
+            self._image_info = self.db.images.list_hardware_types()
+            self._image_info_loaded_at = clock.time()
+        return self._image_info
+
+    def estimate(self, hardware_type_id, image, event):
+        """
+        Return the expected time, in seconds, to prepare a device of the given
+        hardware type with the given image, using the given lifeguard event.
+        """
+        with self._lock:
+            return self._estimates.get((hardware_type_id, image, event),
+                                       self.DEFAULT_TIMES[event])
+
+    def expected_time(self, device, request):
+        """
+        Return the expected time to prepare the given device (from
+        `availability.details`) for the given request (from
+        `requests.get_info`), including any penalties.
+        """
+        image_info = self._get_image_info()
+        requested = image_info.get(request['image'],
+                {'can_reuse': False, 'hardware_type_ids': []})
+        hardware_type_id = device['hardware_type_id']
+
+        if (requested['can_reuse'] and device['image'] == request['image'] and
+            device['boot_config_key'] ==
+                availability.boot_config_key(request['boot_config'])):
+            return self.estimate(hardware_type_id, request['image'],
+                                 'please_power_cycle')
+
+        expected = self.estimate(hardware_type_id, request['image'], 'please_image')
+        if hardware_type_id not in requested['hardware_type_ids']:
+            expected += self.UNIMAGEABLE_PENALTY
+        installed = image_info.get(device['image'])
+        if installed and installed['can_reuse']:
+            expected += self.HOLD_BACK_PENALTY
+        return expected
+
+    def choose(self, request_id, request, device_names):
+        """
+        Choose the best of the given available devices for the request, or
+        None if none of them is still available (another thread may have
+        taken them since they were found).  Ties are broken at random.
+        """
+        details = self.db.availability.details(device_names)
+        if not details:
+            return None
+        scores = dict((name, self.expected_time(device, request))
+                      for name, device in details.iteritems())
+        best = min(scores.itervalues())
+        name = random.choice([ n for n, s in scores.iteritems() if s == best ])
+        with self._lock:
+            self._placements[request_id] = (details[name]['hardware_type_id'],
+                                            request['image'])
+            self._started.pop(request_id, None)
+        return name
+
+    def started(self, request_id, event):
+        """
+        Note that preparation of the device placed for this request has begun,
+        using the given lifeguard event.  Repeated calls (for example, when
+        retrying) do not reset the start time.
+        """
+        with self._lock:
+            placement = self._placements.get(request_id)
+            if placement and request_id not in self._started:
+                self._started[request_id] = (placement + (event,), clock.time())
+
+    def finished(self, request_id):
+        """
+        Note that the device placed for this request is ready, and update the
+        estimate for its hardware type, image, and event.  Returns the elapsed
+        time, or None if the start was not noted.
+        """
+        with self._lock:
+            self._placements.pop(request_id, None)
+            try:
+                key, started = self._started.pop(request_id)
+            except KeyError:
+                return None
+            elapsed = clock.time() - started
+            if key in self._estimates:
+                self._estimates[key] += self.SMOOTHING * (elapsed - self._estimates[key])
+            else:
+                self._estimates[key] = elapsed
+            return elapsed
+
+    def discard(self, request_id):
+        "Forget about this request, which will not become ready."
+        with self._lock:
+            self._placements.pop(request_id, None)
+            self._started.pop(request_id, None)
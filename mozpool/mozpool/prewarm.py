@@ -0,0 +1,208 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Pre-imaging of idle devices with popular images.
+
+A request for a reusable image that is already installed on an available
+device only needs a power cycle, while any other request waits for a full PXE
+boot, download, and install.  When there are no requests waiting for a
+device, the pre-warmer looks at recent demand and images some of this
+server's available devices with the most popular reusable images, so that
+future requests find them already installed.
+"""
+
+import logging
+import threading
+
+from mozpool import config, eventbus, clock
+from mozpool.db import availability
+
+logger = logging.getLogger('mozpool.prewarm')
+
+class Prewarmer(object):
+    """
+    Keep up to the configured number of this server's available devices
+    imaged with the reusable images most in demand, sharing the devices among
+    images in proportion to the number of recent requests for each.  Also
+    keeps track of how often requests for reusable images find them already
+    installed.
+
+    Configuration is in the [prewarm] section: `devices` is the number of
+    devices to keep warm (the default, 0, disables pre-warming), `interval`
+    is the minimum time between checks, in seconds, and `window` is the
+    number of recent requests used to estimate demand.
+    """
+
+    DEFAULT_INTERVAL = 60
+    DEFAULT_WINDOW = 200
+
+    # a device being pre-imaged is counted as warm for this long, in seconds,
+    # or until it becomes available again
+    IMAGING_TIMEOUT = 30 * 60
+
+    def __init__(self, db):
+        self.db = db
+        self._imaging_server_id = None
+        self._lock = threading.Lock()
+        self._last_check = None
+        # device name -> (demand key, start time)
+        self._imaging = {}
+        # names of devices that became available with a pre-warmed image and
+        # have not been assigned since
+        self._warmed = set()
+        self._stats = {'hits': 0, 'misses': 0, 'warm_hits': 0, 'images_started': 0}
+
+    @property
+    def imaging_server_id(self):
+        if self._imaging_server_id is None:
+            self._imaging_server_id = self.db.imaging_servers.get_id(config.get('server', 'fqdn'))
+        return self._imaging_server_id
+
+    def _get_int(self, option, default):
+        if not config.has_option('prewarm', option):
+            return default
+        return int(config.get('prewarm', option))
+
+    def demand_key(self, environment, image, boot_config):
+        return (environment, image, availability.boot_config_key(boot_config))
+
+    def targets(self, demand, count):
+        """
+        Divide `count` warm devices among the entries of `demand` (from
+        `requests.list_demand`) in proportion to their popularity, returning a
+        list of (demand entry, number of devices).  Entries that get no
+        devices are omitted.
+        """
+        slots = [0] * len(demand)
+        for _ in xrange(count):
+            if not demand:
+                break
+            # highest-averages allocation
+            best = max(xrange(len(demand)),
+                       key=lambda i: (float(demand[i]['count']) / (slots[i] + 1), -i))
+            slots[best] += 1
+        return [ (entry, n) for entry, n in zip(demand, slots) if n ]
+
+    def poll(self, idle):
+        """
+        Called from the driver on every pass.  If pre-warming is enabled,
+        enough time has passed since the last check, and `idle` is true (no
+        requests are waiting for a device), then start imaging a device with
+        the image that is furthest below its target.
+        """
+        count = self._get_int('devices', 0)
+        if not count or not idle:
+            return
+        now = clock.time()
+        if (self._last_check is not None and
+                now - self._last_check < self._get_int('interval', self.DEFAULT_INTERVAL)):
+            return
+        self._last_check = now
+        self.warm(count)
+
+    def warm(self, count):
+        """
+        Start imaging at most one device, if any image is below its share of
+        the `count` warm devices.  Returns the name of the device, or None.
+        """
+        demand = self.db.requests.list_demand(
+                self._get_int('window', self.DEFAULT_WINDOW))
+        targets = self.targets(demand, count)
+        if not targets:
+            return None
+        hardware_types = self.db.images.list_hardware_types()
+        devices = self.db.devices.list_available(
+                imaging_server_id=self.imaging_server_id)
+
+        # count the warm devices for each target, including those being imaged
+        now = clock.time()
+        warm = {}
+        for device in devices:
+            key = self.demand_key(device['environment'], device['image'],
+                                  device['boot_config'])
+            warm.setdefault(key, []).append(device['name'])
+        available = set(d['name'] for d in devices)
+        with self._lock:
+            for name, (key, started) in self._imaging.items():
+                if name in available or now - started > self.IMAGING_TIMEOUT:
+                    del self._imaging[name]
+                else:
+                    warm.setdefault(key, []).append(name)
+
+        def matching(entry):
+            # an 'any' request can use a device in any environment
+            if entry['environment'] in ('any', None):
+                return [ key for key in warm if key[1:] ==
+                         self.demand_key(None, entry['image'], entry['boot_config'])[1:] ]
+            return [ self.demand_key(entry['environment'], entry['image'],
+                                     entry['boot_config']) ]
+
+        # devices carrying an image within its target are kept as they are
+        keep = set()
+        shortfalls = []
+        for entry, n in targets:
+            names = [ name for key in matching(entry) for name in warm.get(key, []) ]
+            keep.update(names[:n])
+            if len(names) < n:
+                shortfalls.append((float(len(names)) / n, entry))
+        if not shortfalls:
+            return None
+
+        shortfalls.sort(key=lambda s: s[0])
+        for _, entry in shortfalls:
+            compatible = hardware_types.get(entry['image'], {}).get('hardware_type_ids', [])
+            for device in devices:
+                if device['name'] in keep:
+                    continue
+                if device['hardware_type_id'] not in compatible:
+                    continue
+                if entry['environment'] not in ('any', None, device['environment']):
+                    continue
+                self.start_imaging(device['name'], entry)
+                return device['name']
+        return None
+
+    def start_imaging(self, device_name, entry):
+        """
+        Ask lifeguard to image the given device for the given demand entry.
+        """
+        logger.info('pre-warming %s with image %s' % (device_name, entry['image']))
+        # make sure this process does not assign the device in the meantime
+        self.db.availability.discard(device_name)
+        with self._lock:
+            self._imaging[device_name] = (self.demand_key(entry['environment'],
+                    entry['image'], entry['boot_config']), clock.time())
+            self._warmed.add(device_name)
+            self._stats['images_started'] += 1
+
+        def posted(status_code):
+            if status_code != 200:
+                logger.warn('got %d from Lifeguard when pre-warming %s' %
+                            (status_code, device_name))
+        eventbus.bus.send('device', self.db.devices.get_imaging_server(device_name),
+                device_name, 'please_image',
+                {'image': entry['image'], 'boot_config': entry['boot_config']},
+                posted)
+
+    def record(self, device_name, hit):
+        """
+        Record whether a request for a reusable image found it already
+        installed on its assigned device (`hit`), or had to install it.
+        """
+        with self._lock:
+            self._stats['hits' if hit else 'misses'] += 1
+            if hit and device_name in self._warmed:
+                self._stats['warm_hits'] += 1
+            self._warmed.discard(device_name)
+
+    def get_stats(self):
+        """
+        Return a dictionary with keys 'hits' and 'misses', counting requests
+        for reusable images that did and did not find the image installed;
+        'warm_hits', counting the hits on pre-warmed devices; and
+        'images_started', counting pre-warming operations.
+        """
+        with self._lock:
+            return dict(self._stats)
@@ -3,10 +3,10 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import datetime
-import json
-import random
+import threading
 
-from mozpool import config, statemachine, statedriver, util, async, mozpool
+from mozpool import config, statemachine, statedriver, util, eventbus, clock
+from mozpool.mozpool import placement, prewarm
 
 ####
 # State machine
@@ -26,10 +26,13 @@ class RequestStateMachine(statemachine.StateMachine):
         if timeout_duration is None:
             state_timeout = None
         else:
-            state_timeout = datetime.datetime.now() + datetime.timedelta(seconds=timeout_duration)
+            state_timeout = clock.now() + datetime.timedelta(seconds=timeout_duration)
         self.db.requests.set_machine_state(self.request_id,
                                            new_state, state_timeout)
 
+    def write_transition(self, old_state, new_state):
+        self.db.requests.record_transition(self.request_id, old_state, new_state)
+
     def read_counters(self):
         return self.db.requests.get_counters(self.request_id)
 
@@ -37,6 +40,206 @@ class RequestStateMachine(statemachine.StateMachine):
         self.db.requests.set_counters(self.request_id, counters)
 
 
+####
+# Device selection
+
+# priority classes, highest first
+PRIORITIES = ('high', 'normal', 'low')
+DEFAULT_PRIORITY = 'normal'
+
+def priority_rank(priority):
+    "Return a sort key for the given priority class; lower sorts first"
+    try:
+        return PRIORITIES.index(priority)
+    except ValueError:
+        return PRIORITIES.index(DEFAULT_PRIORITY)
+
+def reserved_capacity(environment):
+    """
+    Return the number of available devices in the given environment that are
+    held back for requests of the highest priority, as configured in the
+    [reservations] section of the config.
+    """
+    if not environment or not config.has_option('reservations', environment):
+        return 0
+    return int(config.get('reservations', environment))
+
+def available_devices(db, request, image_is_reusable):
+    """
+    Return the names of the available devices best suited to the given request
+    (from `requests.get_info`).  Unless the request has the highest priority,
+    devices in environments that are down to their reserved capacity are not
+    considered.
+    """
+    held = []
+    if priority_rank(request['priority']) > 0:
+        held = [ env for env, count in db.availability.counts().iteritems()
+                 if count <= reserved_capacity(env) ]
+    return db.availability.find(
+            environment=request['environment'],
+            device_name=request['requested_device'],
+            image=request['image'],
+            boot_config=request['boot_config'],
+            prefer_image=image_is_reusable,
+            exclude_environments=held)
+
+
+class AllocationStats(object):
+    """
+    Time taken to allocate a device to each request, summarized by priority
+    class.  Only requests handled by this process are counted.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = {}
+        self._stats = {}
+
+    def start(self, request_id):
+        with self._lock:
+            self._started.setdefault(request_id, clock.time())
+
+    def finish(self, request_id, priority):
+        """
+        Record that the request has been allocated a device, returning the time
+        taken, or None if the start was not recorded.
+        """
+        with self._lock:
+            started = self._started.pop(request_id, None)
+            if started is None:
+                return None
+            elapsed = clock.time() - started
+            stats = self._stats.setdefault(priority,
+                    {'count': 0, 'total': 0.0, 'max': 0.0})
+            stats['count'] += 1
+            stats['total'] += elapsed
+            stats['max'] = max(stats['max'], elapsed)
+            return elapsed
+
+    def discard(self, request_id):
+        with self._lock:
+            self._started.pop(request_id, None)
+
+    def get(self):
+        """
+        Return a dictionary keyed by priority class, with values giving the
+        'count', 'mean', and 'max' time to allocate, in seconds.
+        """
+        with self._lock:
+            return dict((priority, {'count': stats['count'],
+                                    'mean': stats['total'] / stats['count'],
+                                    'max': stats['max']})
+                        for priority, stats in self._stats.iteritems())
+
+
+####
+# Request queue
+
+class RequestQueue(object):
+    """
+    First-in, first-out queues of requests for 'any' device that are waiting
+    for a device to become available, keyed by (environment, image).  Requests
+    of higher priority are queued ahead of those of lower priority.  Each
+    mozpool server queues only the requests it is responsible for.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> list of request IDs, oldest first
+        self._queues = {}
+        # request ID -> (key, time enqueued, priority)
+        self._entries = {}
+
+    def __contains__(self, request_id):
+        return request_id in self._entries
+
+    def _position(self, queue, priority):
+        # the position at which a new request with this priority belongs
+        rank = priority_rank(priority)
+        for position, request_id in enumerate(queue):
+            if priority_rank(self._entries[request_id][2]) > rank:
+                return position
+        return len(queue)
+
+    def add(self, request_id, key, priority=DEFAULT_PRIORITY):
+        """
+        Add a request to the queue for the given key, behind any requests of the
+        same or higher priority.  This does nothing if the request is already
+        queued.
+        """
+        with self._lock:
+            if request_id in self._entries:
+                return
+            queue = self._queues.setdefault(key, [])
+            queue.insert(self._position(queue, priority), request_id)
+            self._entries[request_id] = (key, clock.time(), priority)
+
+    def remove(self, request_id):
+        """
+        Remove a request from its queue, returning the number of seconds it
+        spent there, or None if it was not queued.
+        """
+        with self._lock:
+            try:
+                key, enqueued_at, _ = self._entries.pop(request_id)
+            except KeyError:
+                return None
+            queue = self._queues[key]
+            queue.remove(request_id)
+            if not queue:
+                del self._queues[key]
+            return clock.time() - enqueued_at
+
+    def keys(self):
+        with self._lock:
+            return self._queues.keys()
+
+    def waiting(self, key):
+        """
+        Return the IDs of the requests waiting with the given key, oldest
+        first.
+        """
+        with self._lock:
+            return list(self._queues.get(key, []))
+
+    def ahead_of(self, request_id, key, priority=DEFAULT_PRIORITY):
+        """
+        Return the number of requests waiting with the given key that are
+        ahead of this request, or that would be ahead of it if it were queued
+        with the given priority.
+        """
+        with self._lock:
+            queue = self._queues.get(key, [])
+            if request_id in queue:
+                return queue.index(request_id)
+            return self._position(queue, priority)
+
+    def list(self):
+        """
+        Return a list of dictionaries describing each queued request, with keys
+        'id', 'environment', 'image', 'priority', 'position', and 'waiting'
+        (the number of seconds the request has been queued).
+        """
+        now = clock.time()
+        rv = []
+        with self._lock:
+            for (environment, image), queue in self._queues.iteritems():
+                for position, request_id in enumerate(queue):
+                    _, enqueued_at, priority = self._entries[request_id]
+                    rv.append({'id': request_id,
+                               'environment': environment,
+                               'image': image,
+                               'priority': priority,
+                               'position': position,
+                               'waiting': now - enqueued_at})
+        return rv
+
+
+def queue_key(request):
+    "Return the RequestQueue key for the given request (from get_info)"
+    return (request['environment'], request['image'])
+
+
 ####
 # Driver
 
@@ -59,13 +262,99 @@ class MozpoolDriver(statedriver.StateDriver):
     def __init__(self, db, poll_frequency=statedriver.POLL_FREQUENCY):
         statedriver.StateDriver.__init__(self, db, poll_frequency)
         self._imaging_server_id = None
+        self.request_queue = RequestQueue()
+        self.allocation_stats = AllocationStats()
+        self.placement = placement.PlacementEngine(db)
+        self.prewarmer = prewarm.Prewarmer(db)
+        self._devices_available = False
+        db.availability.add_listener(self._device_available)
+
+    def _get_machine(self, machine_name):
+        # states use this driver's request queue, placement engine, and
+        # statistics, rather than those of mozpool.mozpool.driver
+        machine = super(MozpoolDriver, self)._get_machine(machine_name)
+        machine.driver = self
+        return machine
 
     def _get_timed_out_machine_names(self):
         return self.db.requests.list_timed_out(self.imaging_server_id)
 
+    def _device_available(self):
+        # called by the availability index; serve the queue from the polling
+        # thread as soon as possible
+        self._devices_available = True
+        self.wake()
+
     def poll_others(self):
         for request_id in self.db.requests.list_expired(self.imaging_server_id):
             self.handle_event(request_id, 'expire', None)
+        if self.request_queue.keys():
+            # devices released by other servers are only seen by reloading
+            # the index, which notifies us of any additions
+            self.db.availability.refresh()
+        if self._devices_available:
+            self._devices_available = False
+            self.serve_queue()
+        self.prewarmer.poll(idle=not self.request_queue.keys())
+
+    def serve_queue(self):
+        """
+        Offer available devices to the waiting requests for each key, in
+        priority order and then in the order in which they were queued, until
+        a request fails to get a device.
+        """
+        for key in self.request_queue.keys():
+            for request_id in self.request_queue.waiting(key):
+                # drop requests that have moved on without us noticing
+                if self.db.requests.get_machine_state(request_id) != 'waiting_for_device':
+                    self.request_queue.remove(request_id)
+                    continue
+                self.handle_event(request_id, 'device_available', None)
+                if request_id in self.request_queue:
+                    break
+
+    def allocate_requests(self, request_ids):
+        """
+        Find devices for a batch of new requests for 'any' device, all with the
+        same parameters, using a single pass over the available devices.
+        Requests that get a device go directly to contacting lifeguard; the
+        remainder go through the usual 'find_device' process.  If other
+        requests are already waiting for a device with these parameters, then
+        the whole batch goes through 'find_device' and queues up behind them.
+        Returns a dictionary mapping request ID to assigned device name, or
+        None.
+        """
+        assigned = dict((request_id, None) for request_id in request_ids)
+        if not request_ids:
+            return assigned
+        request = self.db.requests.get_info(request_ids[0])
+        image_is_reusable = self.db.images.is_reusable(request['image'])
+        queued = self.request_queue.ahead_of(None, queue_key(request),
+                                             request['priority'])
+
+        for request_id in request_ids:
+            self.allocation_stats.start(request_id)
+            while not queued:
+                candidates = available_devices(self.db, request,
+                                               image_is_reusable)
+                if not candidates:
+                    break
+                # this fails if another request got the device first; either
+                # way, the device is removed from the availability index
+                device_name = self.placement.choose(request_id, request,
+                                                    candidates)
+                if device_name is None:
+                    # the candidates were all taken meanwhile; look again
+                    continue
+                if self.db.device_requests.add(request_id, device_name):
+                    assigned[request_id] = device_name
+                    break
+            if assigned[request_id]:
+                self.handle_event(request_id, 'device_assigned',
+                                  {'device_name': assigned[request_id]})
+            else:
+                self.handle_event(request_id, 'find_device', None)
+        return assigned
 
     @property
     def imaging_server_id(self):
@@ -94,6 +383,41 @@ class ClearDeviceRequests(object):
 
     def on_entry(self):
         self.db.device_requests.clear(self.machine.request_id)
+        self.machine.driver.allocation_stats.discard(self.machine.request_id)
+        self.machine.driver.placement.discard(self.machine.request_id)
+
+
+class AssignsDevice(object):
+    """
+    Try to assign an available device to the request.
+    """
+
+    def assign_device(self, request):
+        """
+        Pick an available device suitable for `request` (from
+        `requests.get_info`) and assign it to the request.  Returns the name
+        of the device, or None if no device could be assigned.
+        """
+        image_is_reusable = self.db.images.is_reusable(request['image'])
+        avail_devices = available_devices(self.db, request, image_is_reusable)
+        if not avail_devices:
+            return None
+
+        # pick the device that can be prepared most quickly
+        device_name = self.machine.driver.placement.choose(
+                self.machine.request_id, request, avail_devices)
+        if device_name is None:
+            # the devices were all taken since they were found
+            return None
+        self.logger.info('Assigning device %s.' % device_name)
+        if not self.db.device_requests.add(self.machine.request_id, device_name):
+            return None
+        elapsed = self.machine.driver.allocation_stats.finish(
+                self.machine.request_id, request['priority'])
+        if elapsed is not None:
+            self.logger.info('Allocated a device to this %s-priority request '
+                             'in %.1fs.' % (request['priority'], elapsed))
+        return device_name
 
 
 @RequestStateMachine.state_class
@@ -101,23 +425,27 @@ class new(Closable, statemachine.State):
     "New request; no action taken yet."
 
     def on_find_device(self, args):
+        self.machine.driver.allocation_stats.start(self.machine.request_id)
         self.machine.goto_state(finding_device)
 
+    def on_device_assigned(self, args):
+        # a device was assigned in bulk by MozpoolDriver.allocate_requests
+        self.logger.info('Assigned device %s.' % args['device_name'])
+        request = self.db.requests.get_info(self.machine.request_id)
+        self.machine.driver.allocation_stats.finish(self.machine.request_id,
+                                                    request['priority'])
+        self.machine.goto_state(contact_lifeguard)
+
 
 @RequestStateMachine.state_class
-class finding_device(Closable, statemachine.State):
+class finding_device(AssignsDevice, Closable, statemachine.State):
     """
     Assign a device. If this is a request for a specific device,
     fail immediately if the device is busy. If a request for 'any',
-    and no devices available, try a few times, with a delay between.
-
-    FIXME: Better to differentiate the finding state (might take a
-    few tries to find a free device) from the overall time to allocate a
-    device (client might not want to wait more than X seconds).
+    and no devices available, wait in the request queue for one.
     """
 
     TIMEOUT = 10
-    MAX_ANY_REQUESTS = 60
     MAX_SPECIFIC_REQUESTS = 2
 
     def on_entry(self):
@@ -128,50 +456,102 @@ class finding_device(Closable, statemachine.State):
 
     def find_device(self):
         self.logger.info('Finding device.')
-        device_name = None
         count = self.machine.increment_counter(self.state_name)
         self.db.device_requests.clear(self.machine.request_id)
         request = self.db.requests.get_info(self.machine.request_id)
-        image_is_reusable = self.db.images.is_reusable(request['image'])
 
-        avail_devices = self.db.devices.list_available(
-                environment=request['environment'],
-                device_name=request['requested_device'])
-
-        if avail_devices:
-            if image_is_reusable:
-                devices_with_image = [x for x in avail_devices
-                                      if x['image'] == request['image'] and
-                                         util.from_json(x['boot_config']) ==
-                                         util.from_json(request['boot_config'])]
-                if devices_with_image:
-                    avail_devices = devices_with_image
-
-            # pick a device at random from the returned list
-            device_name = random.choice(avail_devices)['name']
-            self.logger.info('Assigning device %s.' % device_name)
-            if self.db.device_requests.add(self.machine.request_id,
-                                                device_name):
+        if request['requested_device'] == 'any':
+            # don't jump the queue if other requests are already waiting
+            if self.machine.driver.request_queue.ahead_of(self.machine.request_id,
+                    queue_key(request), request['priority']):
+                self.machine.goto_state(waiting_for_device)
+            elif self.assign_device(request):
                 self.logger.info('Request succeeded.')
                 self.machine.goto_state(contact_lifeguard)
+            else:
+                self.logger.warn('No devices available; waiting.')
+                self.machine.goto_state(waiting_for_device)
+            return
+
+        if self.assign_device(request):
+            self.logger.info('Request succeeded.')
+            self.machine.goto_state(contact_lifeguard)
         else:
             self.logger.warn('Request failed!')
-            if request['requested_device'] == 'any':
-                if count >= self.MAX_ANY_REQUESTS:
-                    self.logger.warn('Hit maximum number of attempts to find '
-                                     'a free device; giving up.')
-                    self.machine.goto_state(failed_device_not_found)
-            else:
-                if count >= self.MAX_SPECIFIC_REQUESTS:
-                    self.logger.warn('Requested device %s is busy.' %
-                                     request['requested_device'])
-                    self.machine.goto_state(failed_device_busy)
-                    return
-                # check the device status - if it's failed, then short-circuit
-                # to failed_bad_device
-                state = self.db.devices.get_machine_state(request['requested_device'])
-                if state.startswith('failed_'):
-                    self.machine.goto_state(failed_bad_device)
+            if count >= self.MAX_SPECIFIC_REQUESTS:
+                self.logger.warn('Requested device %s is busy.' %
+                                 request['requested_device'])
+                self.machine.goto_state(failed_device_busy)
+                return
+            # check the device status - if it's failed, then short-circuit
+            # to failed_bad_device
+            state = self.db.devices.get_machine_state(request['requested_device'])
+            if state.startswith('failed_'):
+                self.machine.goto_state(failed_bad_device)
+
+
+@RequestStateMachine.state_class
+class waiting_for_device(AssignsDevice, Closable, statemachine.State):
+    """
+    A request for 'any' device is waiting in the driver's request queue for a
+    device to become available.  The driver sends 'device_available' to the
+    waiting requests, in order, when a device enters the ready state or is
+    released by another request.
+
+    The timeout is used as a polling interval, in case a device becomes
+    available without the driver noticing (for example, because it was
+    released by another mozpool server), and to eventually give up.
+    """
+
+    TIMEOUT = 60
+    MAX_TIMEOUTS = 10
+
+    def on_entry(self):
+        request = self.db.requests.get_info(self.machine.request_id)
+        queue = self.machine.driver.request_queue
+        queue.add(self.machine.request_id, queue_key(request), request['priority'])
+        self.logger.info('Waiting for a device; %d requests ahead.' %
+                queue.ahead_of(self.machine.request_id, queue_key(request)))
+
+    def on_device_available(self, args):
+        self.try_assign_device()
+
+    def on_timeout(self):
+        request = self.db.requests.get_info(self.machine.request_id)
+        queue = self.machine.driver.request_queue
+        # re-queue if the queue was lost, e.g., in a restart
+        queue.add(self.machine.request_id, queue_key(request), request['priority'])
+        if not queue.ahead_of(self.machine.request_id, queue_key(request)):
+            if self.try_assign_device(request):
+                return
+        if self.machine.increment_counter(self.state_name) >= self.MAX_TIMEOUTS:
+            waited = queue.remove(self.machine.request_id)
+            self.logger.warn('No device available after %ds in the queue; '
+                             'giving up.' % waited)
+            self.machine.clear_counter(self.state_name)
+            self.machine.goto_state(failed_device_not_found)
+        else:
+            self.machine.goto_state(waiting_for_device)
+
+    def on_close(self, args):
+        self.machine.driver.request_queue.remove(self.machine.request_id)
+        Closable.on_close(self, args)
+
+    def on_expire(self, args):
+        self.machine.driver.request_queue.remove(self.machine.request_id)
+        Closable.on_expire(self, args)
+
+    def try_assign_device(self, request=None):
+        if request is None:
+            request = self.db.requests.get_info(self.machine.request_id)
+        device_name = self.assign_device(request)
+        if not device_name:
+            return False
+        waited = self.machine.driver.request_queue.remove(self.machine.request_id)
+        self.logger.info('Request succeeded after %.1fs in the queue.' % (waited or 0))
+        self.machine.clear_counter(self.state_name)
+        self.machine.goto_state(contact_lifeguard)
+        return True
 
 
 @RequestStateMachine.state_class
@@ -224,6 +604,8 @@ class contacting_lifeguard(Closable, statemachine.State):
                 util.from_json(dev['boot_config']) ==
                 util.from_json(req['boot_config'])):
                 event = 'please_power_cycle'
+            self.machine.driver.prewarmer.record(assigned_device_name,
+                                                 hit=bool(event))
 
         if not event:
             # Use the device's hardware type and requested image to find the
@@ -232,17 +614,17 @@ class contacting_lifeguard(Closable, statemachine.State):
             device_request_data['boot_config'] = req['boot_config']
             device_request_data['image'] = req['image']
 
+        self.machine.driver.placement.started(self.machine.request_id, event)
+
         # try to ask lifeguard to start imaging or power cycling
-        device_url = 'http://%s/api/device/%s/event/%s/' % (
-            self.db.devices.get_imaging_server(assigned_device_name),
-            assigned_device_name, event)
-        def posted(result):
-            if result.status_code != 200:
-                self.logger.warn("got %d from Lifeguard" % result.status_code)
+        def posted(status_code):
+            if status_code != 200:
+                self.logger.warn("got %d from Lifeguard" % status_code)
                 return
-            mozpool.driver.handle_event(self.machine.request_id, 'lifeguard_contacted', {})
-        async.requests.post.start(posted, device_url,
-                data=json.dumps(device_request_data))
+            self.machine.driver.handle_event(self.machine.request_id, 'lifeguard_contacted', {})
+        eventbus.bus.send('device',
+                self.db.devices.get_imaging_server(assigned_device_name),
+                assigned_device_name, event, device_request_data, posted)
 
     def on_lifeguard_contacted(self, args):
         self.machine.goto_state(pending)
@@ -330,6 +712,11 @@ class pending(Closable, statemachine.State):
 class ready(Closable, statemachine.State):
     "Device has been prepared and is ready for use."
 
+    def on_entry(self):
+        elapsed = self.machine.driver.placement.finished(self.machine.request_id)
+        if elapsed is not None:
+            self.logger.info('Device prepared in %.1fs.' % elapsed)
+
 
 @RequestStateMachine.state_class
 class failed_device_not_found(ClearDeviceRequests, statemachine.State):
@@ -2,18 +2,30 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+from __future__ import absolute_import
+
 import os
 import abc
 import time
 import signal
 import threading
 import logging
+from mozpool import clock, metrics
 
 ####
 # Driver
 
 POLL_FREQUENCY = 10
 
+tick_seconds = metrics.histogram('mozpool_statedriver_tick_seconds',
+        'Time taken by each poll of a state driver', ('machine_type',))
+tick_timeouts = metrics.histogram('mozpool_statedriver_tick_timeouts',
+        'Number of timed-out machines handled by each poll of a state driver',
+        ('machine_type',), buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+stalls = metrics.counter('mozpool_statedriver_stalls_total',
+        'Polls of a state driver still running after the poll interval',
+        ('machine_type',))
+
 class StateDriver(threading.Thread):
     """
     A generic state-machine driver.  This handles timeouts, as well as handling
@@ -31,12 +43,20 @@ class StateDriver(threading.Thread):
         threading.Thread.__init__(self, name=self.thread_name)
         self.setDaemon(True)
         self._stop = False
+        self._wakeup = threading.Event()
         self.db = db
         self.poll_frequency = poll_frequency
         self.logger = logging.getLogger(self.logger_name)
         self.log_handler = self.log_db_handler(db)
         self.logger.addHandler(self.log_handler)
 
+    def wake(self):
+        """
+        Begin the next poll immediately, rather than waiting for the poll
+        interval to expire.
+        """
+        self._wakeup.set()
+
     def stop(self):
         self._stop = True
         if self.isAlive():
@@ -58,11 +78,15 @@ class StateDriver(threading.Thread):
                 polling_thd.setDaemon(1)
                 polling_thd.start()
 
-                time.sleep(self.poll_frequency)
+                clock.wait(self._wakeup, self.poll_frequency)
+                self._wakeup.clear()
 
                 # if the thread is still alive now, we have a problem.  This is bug 817762.  It
-                # happens when the DB server goes away.
+                # happens when the DB server goes away.  This watchdog uses the real time,
+                # even with a simulated clock, since it is the process that is stuck.
                 delay = 1
+                if polling_thd.isAlive():
+                    stalls.labels(self.logger_name).inc()
                 while polling_thd.isAlive():
                     elapsed = time.time() - started_at
                     # Commit suicide after 10 minutes.  The PuppetAgain
@@ -89,12 +113,14 @@ class StateDriver(threading.Thread):
             self.logger.warning("run loop returned (this should not happen!)")
 
     def _tick(self):
+        started_at = time.time()
         try:
             self.poll_for_timeouts()
             self.poll_others()
         except Exception:
             self.logger.error("failure in _tick", exc_info=True)
             # don't worry, we'll get called again, for surez..
+        tick_seconds.labels(self.logger_name).observe(time.time() - started_at)
 
     def handle_event(self, machine_name, event, args):
         """
@@ -124,7 +150,9 @@ class StateDriver(threading.Thread):
         return machine.conditional_goto_state(old_state, new_state)
 
     def poll_for_timeouts(self):
-        for machine_name in self._get_timed_out_machine_names():
+        machine_names = self._get_timed_out_machine_names()
+        tick_timeouts.labels(self.logger_name).observe(len(machine_names))
+        for machine_name in machine_names:
             self.logger.info("handling timeout on %s" % machine_name)
             self.handle_timeout(machine_name)
 
@@ -22,11 +22,23 @@ This class implements process-local locking to prevent overlapping state
 transitions.  Note that it is up to the caller to ensure that overlapping state
 transitions do not occur in other processes.
 
+Every state transition is also announced via the class's C{changeNotifier},
+allowing other threads in the same process to wait for a machine to change
+state without polling the database.
+
+Every change of state is recorded with C{write_transition}, which machines can
+implement to keep a history of their transitions, e.g., to measure the time
+spent in each state.
+
 """
 
 from __future__ import absolute_import
 import logging
-from mozpool import util
+from mozpool import util, metrics
+
+transitions = metrics.counter('mozpool_state_transitions_total',
+        'State machine transitions, by machine type and the state entered',
+        ('machine_type', 'state'))
 
 ####
 # Base and Mixins
@@ -36,6 +48,7 @@ class StateMachine(object):
     # external interface
 
     def __init__(self, machine_type, machine_name, db):
+        self.machine_type = machine_type
         self.machine_name = machine_name
         self.db = db
         self.state = None
@@ -92,6 +105,11 @@ class StateMachine(object):
     def write_counters(self, counters):
         raise NotImplementedError
 
+    def write_transition(self, old_state, new_state):
+        """Record a change from OLD_STATE to NEW_STATE; by default, this does
+        nothing."""
+        pass
+
     # state mechanics
 
     def goto_state(self, new_state_name_or_class):
@@ -100,14 +118,27 @@ class StateMachine(object):
         if isinstance(new_state_name_or_class, type) and issubclass(new_state_name_or_class, State):
             new_state_name_or_class = new_state_name_or_class.state_name
 
+        old_state_name = self.state.state_name
         self.state.on_exit()
 
-        # only log actual state changes, rather than re-entries of the same state
-        if self.state.state_name != new_state_name_or_class:
+        # only log and record actual state changes, rather than re-entries of
+        # the same state
+        changed = old_state_name != new_state_name_or_class
+        if changed:
             self.logger.info('entering state %s' % (new_state_name_or_class,))
 
         self.state = self._make_state_instance(new_state_name_or_class)
         self.write_state(new_state_name_or_class, self.state.TIMEOUT)
+        if changed:
+            # the history is informational, so failing to record it must not
+            # stop the machine from entering the new state
+            try:
+                self.write_transition(old_state_name, new_state_name_or_class)
+            except Exception:
+                self.logger.warning("(ignored) error recording state transition:",
+                                    exc_info=True)
+        self.changeNotifier.notify(self.machine_name)
+        transitions.labels(self.machine_type, new_state_name_or_class).inc()
 
         self.state.on_entry()
 
@@ -170,6 +201,7 @@ class StateMachine(object):
             # add distinct class-level variables for each subclass
             cls.statesByName = {}
             cls.locksByMachine = util.LocksByName()
+            cls.changeNotifier = util.ChangeNotifier()
 
             return cls
 
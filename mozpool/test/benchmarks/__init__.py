@@ -0,0 +1,120 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Benchmarks for Mozpool's hot paths.
+
+Benchmarks are unittest test cases in `bench_*.py` files in this directory,
+using BenchmarkMixin to time operations.  Run them with `runbenchmarks.py`,
+which writes the results to a JSON file, and optionally compares them with
+the results of an earlier run (a baseline).
+"""
+
+import sys
+import json
+import timeit
+import datetime
+import platform
+import mozpool
+from mozpool.db import model
+
+# benchmark name -> result, as returned from BenchmarkMixin.measure
+results = {}
+
+# a benchmark is considered to have regressed if it is this fraction slower
+# than the baseline
+DEFAULT_TOLERANCE = 0.25
+
+class BenchmarkMixin(object):
+    """
+    Support for benchmarks.  Use `self.measure` to time an operation; its
+    results are recorded in the `results` dictionary of this module.
+    """
+
+    def measure(self, name, fn, number=1, repeat=5, setup=None, **params):
+        """
+        Time `number` calls to FN, `repeat` times, calling SETUP (untimed)
+        before each repetition.  The result is recorded under NAME, qualified
+        with any additional keyword arguments, e.g., `list_available(devices=100)`.
+
+        Returns the result, a dictionary with keys 'min', 'median', and 'mean'
+        giving the time per call in seconds, as well as 'number' and 'repeat'.
+        The minimum is the best indication of the cost of the operation; the
+        others show how noisy the measurement was.
+        """
+        if params:
+            name = '%s(%s)' % (name, ','.join('%s=%s' % kv
+                                               for kv in sorted(params.items())))
+        times = []
+        for _ in xrange(repeat):
+            if setup:
+                setup()
+            started = timeit.default_timer()
+            for _ in xrange(number):
+                fn()
+            times.append((timeit.default_timer() - started) / number)
+        times.sort()
+        result = {
+            'min': times[0],
+            'median': times[len(times) // 2],
+            'mean': sum(times) / len(times),
+            'number': number,
+            'repeat': repeat,
+        }
+        results[name] = result
+        return result
+
+    def add_devices(self, count, first=0, server='server', **columns):
+        """
+        Add COUNT devices, named dev<first> and up, to `self.db` in a single
+        statement.  This is much faster than `add_device` for large numbers of
+        devices.  Keyword arguments give column values for all of the devices.
+        """
+        server_id = self.db.imaging_servers.get_id(server)
+        defaults = dict(state='offline', state_counters='{}',
+                        mac_address='000000000000', imaging_server_id=server_id,
+                        relay_info='', hardware_type_id=1, boot_config='{}')
+        defaults.update(columns)
+        rows = []
+        for i in xrange(first, first + count):
+            row = dict(defaults, name='dev%d' % i, fqdn='dev%d.example.com' % i,
+                       inventory_id=i + 1)
+            rows.append(row)
+        self.db.execute(model.devices.insert(), rows)
+
+
+def write_results(filename, results=results):
+    """
+    Write RESULTS to FILENAME as JSON, along with some information about the
+    environment in which they were measured.
+    """
+    data = {
+        'created': datetime.datetime.now().isoformat(),
+        'mozpool': mozpool.version,
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'results': results,
+    }
+    with open(filename, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+
+def load_results(filename):
+    with open(filename) as f:
+        return json.load(f)['results']
+
+
+def compare(baseline, results, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compare RESULTS with BASELINE (both dictionaries as in `results`) by their
+    minimum times.  Returns a list of (name, baseline time, new time, ratio,
+    regressed) for each benchmark in both, sorted by name, where `regressed`
+    is true if the new time exceeds the baseline by more than TOLERANCE.
+    """
+    rows = []
+    for name in sorted(set(baseline) & set(results)):
+        old, new = baseline[name]['min'], results[name]['min']
+        ratio = new / old if old else float('inf')
+        rows.append((name, old, new, ratio, ratio > 1 + tolerance))
+    return rows
@@ -0,0 +1,48 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+from mozpool.test.benchmarks import BenchmarkMixin
+from mozpool.test.util import DBMixin, TestCase
+
+class QueryBenchmarks(DBMixin, BenchmarkMixin, TestCase):
+
+    # numbers of devices; half are ready, and a tenth of those are assigned
+    # to requests, while a tenth of all devices have timed out
+    SIZES = (100, 1000, 10000)
+
+    def setUp(self):
+        super(QueryBenchmarks, self).setUp()
+        self.add_server('server')
+        self.add_hardware_type('panda', 'ES')
+        self.add_image('b2g')
+        self.server_id = self.db.imaging_servers.get_id('server')
+
+    def grow(self, first, count):
+        now = datetime.datetime.now()
+        past = now - datetime.timedelta(seconds=1)
+        future = now + datetime.timedelta(hours=1)
+        for offset in xrange(0, count, 10):
+            start = first + offset
+            self.add_devices(1, first=start, state='pxe_booting', state_timeout=past)
+            self.add_devices(4, first=start + 1, state='pxe_booting',
+                             state_timeout=future)
+            self.add_devices(5, first=start + 5, state='ready', state_timeout=future)
+            if offset % 100 == 0:
+                request_id = self.add_request(no_assign=True)
+                self.add_device_request(request_id, 'dev%d' % (start + 5))
+
+    def test_queries(self):
+        added = 0
+        for size in self.SIZES:
+            self.grow(added, size - added)
+            added = size
+
+            self.measure('devices.list_available',
+                         self.db.devices.list_available, number=5, devices=size)
+            self.measure('devices.list_timed_out',
+                         lambda: self.db.devices.list_timed_out(self.server_id),
+                         number=5, devices=size)
+            self.assertEqual(len(self.db.devices.list_timed_out(self.server_id)),
+                             size / 10)
@@ -0,0 +1,39 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from mozpool.lifeguard import inventorysync
+from mozpool.test.benchmarks import BenchmarkMixin
+from mozpool.test.util import TestCase
+
+class MergeBenchmarks(BenchmarkMixin, TestCase):
+
+    SIZE = 10000
+
+    def make_device(self, i):
+        return dict(
+            name='panda-%04d' % i,
+            fqdn='panda-%04d.r402-4.scl3.mozilla.com' % i,
+            inventory_id=i,
+            mac_address='%012x' % i,
+            imaging_server='mobile-imaging-%03d' % (i // 200),
+            relay_info='panda-relay-%03d:bank%d:relay%d' % (i // 14, i % 14 // 8 + 1,
+                                                            i % 8 + 1))
+
+    def test_merge_devices(self):
+        # 1% of the devices are new, 1% are gone, and 1% have changed
+        from_inv = [ self.make_device(i) for i in xrange(self.SIZE) ]
+        from_db = []
+        for i, device in enumerate(from_inv[self.SIZE / 100:]):
+            device = dict(device, id=i + 1)
+            if i % 99 == 0:
+                device['mac_address'] = 'ffffffffffff'
+            from_db.append(device)
+        from_db.extend(dict(self.make_device(self.SIZE + i), id=self.SIZE + i)
+                       for i in xrange(self.SIZE / 100))
+
+        commands = []
+        def merge():
+            commands[:] = inventorysync.merge_devices(from_db, from_inv)
+        self.measure('inventorysync.merge_devices', merge, devices=self.SIZE)
+        self.assertEqual(len(commands), 3 * self.SIZE / 100)
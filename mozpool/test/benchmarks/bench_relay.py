@@ -0,0 +1,31 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from mozpool.bmm import relay
+from mozpool.test import fakerelay
+from mozpool.test.benchmarks import BenchmarkMixin
+from mozpool.test.util import TestCase
+
+class RelayBenchmarks(BenchmarkMixin, TestCase):
+
+    def setUp(self):
+        self.relayboard = fakerelay.RelayBoard('bench', ('127.0.0.1', 0))
+        self.relayboard.add_relay(2, 2, fakerelay.Relay())
+        # don't measure the deliberate pauses for the relay board to recover
+        relay.ONE_SECOND = 0
+
+    def tearDown(self):
+        relay.ONE_SECOND = 1
+
+    def spawn(self):
+        # the fake relay board accepts one connection per spawn
+        self.addCleanup(self.relayboard.spawn_one().join)
+        self.relay_host = '127.0.0.1:%d' % self.relayboard.get_port()
+
+    def test_powercycle(self):
+        results = []
+        self.measure('relay.powercycle',
+                     lambda: results.append(relay.powercycle(self.relay_host, 2, 2, 10)),
+                     setup=self.spawn, repeat=20)
+        self.assertEqual(results, [True] * 20)
@@ -0,0 +1,60 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import threading
+from mozpool.db import model
+from mozpool.mozpool import requestmachine
+from mozpool.test.benchmarks import BenchmarkMixin
+from mozpool.test.util import StateDriverMixin, PatchMixin, TestCase
+
+class FindDeviceBenchmarks(StateDriverMixin, PatchMixin, BenchmarkMixin, TestCase):
+
+    driver_class = requestmachine.MozpoolDriver
+
+    auto_patch = [
+        ('requests_post', 'mozpool.async.AsyncRequests.post'),
+    ]
+
+    DEVICES = 100
+    REQUESTS = 200
+
+    def setUp(self):
+        super(FindDeviceBenchmarks, self).setUp()
+        self.add_hardware_type('panda', 'ES')
+        self.add_image('b2g')
+        self.add_devices(self.DEVICES, state='ready')
+        self.request_ids = [ self.add_request(no_assign=True)
+                             for _ in xrange(self.REQUESTS) ]
+
+    def reset(self):
+        self.db.execute(model.device_requests.delete())
+        self.db.execute(model.requests.update().values(state='new',
+                        state_timeout=None, state_counters='{}'))
+        self.driver.request_queue = requestmachine.RequestQueue()
+        self.db.availability.invalidate()
+
+    def find_devices(self, threads):
+        def find(request_ids):
+            for request_id in request_ids:
+                self.driver.handle_event(request_id, 'find_device', None)
+        thds = [ threading.Thread(target=find, args=(self.request_ids[i::threads],))
+                 for i in xrange(threads) ]
+        for thd in thds:
+            thd.start()
+        for thd in thds:
+            thd.join()
+
+    def test_find_device(self):
+        for threads in 1, 8:
+            self.measure('requestmachine.find_device',
+                         lambda: self.find_devices(threads), setup=self.reset,
+                         repeat=3, devices=self.DEVICES, requests=self.REQUESTS,
+                         threads=threads)
+            # no device was assigned twice, and every other request waits; under
+            # contention, requests that lose a race for a device wait too
+            assigned = filter(None, [ self.db.requests.get_assigned_device(request_id)
+                                      for request_id in self.request_ids ])
+            self.assertEqual(len(set(assigned)), len(assigned))
+            self.assertEqual(len(assigned) + len(self.driver.request_queue.list()),
+                             self.REQUESTS)
@@ -0,0 +1,60 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+import logging
+import mock
+from mozpool.db import model
+from mozpool.lifeguard import devicemachine
+from mozpool.test.benchmarks import BenchmarkMixin
+from mozpool.test.util import StateDriverMixin, TestCase
+
+class TickBenchmarks(StateDriverMixin, BenchmarkMixin, TestCase):
+
+    driver_class = devicemachine.LifeguardDriver
+
+    # numbers of devices; a tenth of them time out on each tick
+    SIZES = (100, 1000, 5000)
+
+    def setUp(self):
+        super(TickBenchmarks, self).setUp()
+        self.add_hardware_type('panda', 'ES')
+        self.driver.api = mock.Mock()
+
+    def time_out(self, count):
+        past = datetime.datetime.now() - datetime.timedelta(seconds=1)
+        self.db.execute(model.devices.update().
+                where(model.devices.c.id <= count).
+                values(state='ready', state_timeout=past))
+
+    def test_tick(self):
+        future = datetime.datetime.now() + datetime.timedelta(hours=1)
+        added = 0
+        for size in self.SIZES:
+            self.add_devices(size - added, first=added, state='ready',
+                             state_timeout=future)
+            added = size
+
+            self.measure('statedriver.tick_idle', self.driver._tick,
+                         number=10, devices=size)
+            self.measure('statedriver.tick', self.driver._tick,
+                         setup=lambda: self.time_out(size / 10), repeat=3,
+                         devices=size, timeouts=size / 10)
+            # every timed-out device was handled
+            self.assertEqual(self.db.devices.list_timed_out(
+                             self.driver.imaging_server_id), [])
+
+
+class LogBenchmarks(StateDriverMixin, BenchmarkMixin, TestCase):
+
+    driver_class = devicemachine.LifeguardDriver
+
+    def test_dbhandler(self):
+        self.add_hardware_type('panda', 'ES')
+        self.add_device('dev1')
+        record = logging.LogRecord('device.dev1', logging.INFO, __file__, 0,
+                                   'entering state ready', None, None)
+        self.measure('statedriver.dbhandler_emit',
+                     lambda: self.driver.log_handler.emit(record), number=500)
+        self.assertEqual(len(self.db.devices.get_logs('dev1')), 500 * 5)
@@ -13,6 +13,17 @@ from mozpool import config, util
 from mozpool.bmm import ping, sut
 from mozpool.test import fakerelay
 
+def get_second_stage(pxe_config):
+    """
+    Return the name of the second-stage script that a device booted with the
+    given PXE config contents would run, or None if there is none.
+    """
+    mo = re.search('mobile-imaging-url=[^ ]*/([^ ]*).sh', pxe_config)
+    if mo:
+        return mo.group(1)
+    return None
+
+
 class Relay(fakerelay.Relay):
 
     def __init__(self, device, initial_status=1):
@@ -121,10 +132,9 @@ class Device(object):
         filename = os.path.join(dir, "01-" + mac_address)
         if os.path.exists(filename):
             with open(filename) as f:
-                cfg = f.read()
-                mo = re.search('mobile-imaging-url=[^ ]*/([^ ]*).sh', cfg)
-                if mo:
-                    return mo.group(1)
+                second_stage = get_second_stage(f.read())
+                if second_stage:
+                    return second_stage
                 else:
                     self.logger.warn('PXE config does not contain a mobile-imaging-url; not PXE booting')
         # if nothing's found, return None
@@ -5,6 +5,7 @@
 from __future__ import absolute_import
 
 import mock
+from mozpool import clock, statemachine
 from mozpool.lifeguard import devicemachine
 from mozpool.test.util import StateDriverMixin, DBMixin, PatchMixin, TestCase
 
@@ -55,11 +56,51 @@ class Tests(StateDriverMixin, DBMixin, PatchMixin, TestCase):
     def test_ready_ping_ok(self):
         "A ready device without SUT will be pinged, but not change states if the ping succeeds."
         self.set_state('ready')
-        self.driver.handle_timeout('dev1')
+        with self.assertQueryBudget(5):
+            self.driver.handle_timeout('dev1')
         self.ping.start.assert_called_with(mock.ANY, 'dev1')
-        self.invoke_callback(self.ping.start, True)
+        with self.assertQueryBudget(0):
+            self.invoke_callback(self.ping.start, True)
         self.assert_state('ready')
 
+    def test_transition_metrics(self):
+        "State transitions are counted by machine type and state entered."
+        transitions = statemachine.transitions.labels('device', 'ready')
+        before = transitions.value
+        self.set_state('ready')
+        self.driver.handle_timeout('dev1')
+        self.assertEqual(transitions.value, before + 1)
+
+    def test_ready_timeout_simulated_clock(self):
+        "A ready device is checked again once its timeout elapses on the current clock."
+        self.set_state('ready')
+        simulated = clock.SimulatedClock()
+        with mock.patch.object(clock, 'current', simulated):
+            self.driver.handle_timeout('dev1')
+            self.invoke_callback(self.ping.start, True)
+            self.ping.start.reset_mock()
+
+            simulated.advance(devicemachine.ready.TIMEOUT - 1)
+            self.driver._tick()
+            self.assertFalse(self.ping.start.called)
+
+            simulated.advance(2)
+            self.driver._tick()
+            self.ping.start.assert_called_with(mock.ANY, 'dev1')
+
+    def test_transition_durations(self):
+        "State transitions are recorded with the time spent in the state left."
+        self.set_state('pc_rebooting')
+        simulated = clock.SimulatedClock()
+        with mock.patch.object(clock, 'current', simulated):
+            self.driver.handle_timeout('dev1')
+            simulated.advance(7)
+            self.invoke_callback(self.ping.start, True)
+        self.assertEqual(self.db.state_transitions.get_stats('device',
+                states=['pc_rebooting', 'pc_pinging'], group_by=['hardware_type']),
+            [{'state': 'pc_pinging', 'hardware_type': 'test', 'hardware_model': 'test',
+              'count': 1, 'p50': 7, 'p90': 7, 'p99': 7, 'max': 7}])
+
     def test_ready_ping_selftest(self):
         "A ready device without SUT will be pinged, and if that fails, will be self-tested."
         # add a self-test image and pxe_config for this device and hardware type
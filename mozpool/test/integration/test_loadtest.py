@@ -0,0 +1,67 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import random
+import mozpool.lifeguard
+import mozpool.mozpool
+from mozpool import eventbus
+from mozpool.test import loadtest
+from mozpool.test.util import DBMixin, TestCase
+
+class EventLoopTests(TestCase):
+
+    def test_order(self):
+        loop = loadtest.EventLoop(start=100)
+        calls = []
+        loop.call_later(10, calls.append, 'b')
+        loop.call_at(105, calls.append, 'a')
+        loop.call_later(10, calls.append, 'c')
+        loop.call_later(20, calls.append, 'd')
+        while loop.step(115):
+            pass
+        self.assertEqual(calls, ['a', 'b', 'c'])
+        self.assertEqual(loop.now, 110)
+        self.assertEqual(loop.events_run, 3)
+
+    def test_errors(self):
+        loop = loadtest.EventLoop(start=0)
+        loop.call_later(1, lambda: 1/0)
+        self.assertTrue(loop.step(1))
+        self.assertFalse(loop.step(1))
+        self.assertEqual(loop.errors, 1)
+
+
+class LoadTestTests(DBMixin, TestCase):
+
+    def test_run(self):
+        random.seed(1)
+        loadtest.populate(self.db, 10)
+        workload = loadtest.Workload(rate=20, hold=300, images={'b2g': 1})
+        test = loadtest.LoadTest(self.db, workload)
+        bus = eventbus.bus
+        report = test.run(1800)
+
+        self.assertEqual(report['devices'], 10)
+        self.assertEqual(report['duration'], 1800)
+        self.assertEqual(report['errors'], 0)
+        requests = report['requests']
+        self.assertTrue(requests['submitted'] > 0)
+        # b2g is not reusable, so every ready device was imaged
+        self.assertTrue(requests['ready'] > 0)
+        self.assertEqual(report['latency']['ready']['count'], requests['ready'])
+        self.assertTrue(report['latency']['ready']['p50'] > 60)
+        self.assertTrue(report['queries']['total'] > 0)
+        self.assertIn('SELECT devices', report['queries']['by_statement'])
+        self.assertIn('devices.get_machine_state', report['queries']['by_caller'])
+        # the harness's own queries are not counted
+        self.assertNotIn('loadtest.populate', report['queries']['by_caller'])
+        self.assertTrue(report['transitions']['device'] > 0)
+
+        # the globals are restored
+        self.assertTrue(eventbus.bus is bus)
+        self.assertEqual(mozpool.lifeguard.driver, None)
+        self.assertEqual(mozpool.mozpool.driver, None)
+        self.assertEqual(loadtest.format_report(report).split('\n')[0],
+                '10 devices for 1800s in %.1fs (%d events, 0 errors)' %
+                (report['wall_time'], report['events']))
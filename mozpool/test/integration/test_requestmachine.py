@@ -3,6 +3,7 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import mock
+from mozpool import config
 from mozpool.mozpool import requestmachine
 from mozpool.test.util import StateDriverMixin, DBMixin, PatchMixin, TestCase
 
@@ -42,7 +43,9 @@ class Tests(StateDriverMixin, DBMixin, PatchMixin, TestCase):
 
     def test_new(self):
         self.set_state('new')
-        self.driver.handle_event(self.req_id, 'find_device', {})
+        # (including one statement to record each state transition)
+        with self.assertQueryBudget(22):
+            self.driver.handle_event(self.req_id, 'find_device', {})
         # the finding_device state assigns a device..
         dev = self.db.requests.get_assigned_device(self.req_id)
         self.assertEqual(dev, 'dev1')
@@ -57,6 +60,173 @@ class Tests(StateDriverMixin, DBMixin, PatchMixin, TestCase):
         # and then the machine ends up in the pending state
         self.assert_state('pending')
 
+    def test_new_without_global_driver(self):
+        # states use the driver that runs them, not mozpool.mozpool.driver
+        import mozpool.mozpool
+        mozpool.mozpool.driver = None
+        self.set_state('new')
+        self.driver.handle_event(self.req_id, 'find_device', {})
+        self.assertEqual(self.db.requests.get_assigned_device(self.req_id), 'dev1')
+        self.assert_state('contact_lifeguard')
+        self.driver.handle_timeout(self.req_id)
+        self.requests_result(self.requests_post, 200)
+        self.assert_state('pending')
+
+    def test_allocate_requests(self):
+        self.add_device('dev2', state='ready')
+        req_ids = [ self.req_id ] + [ self.add_request(image='img1', no_assign=True)
+                                      for _ in range(2) ]
+        assigned = self.driver.allocate_requests(req_ids)
+        # two devices are available, so the third request goes looking for one
+        self.assertEqual(sorted(assigned.values()), [None, 'dev1', 'dev2'])
+        for req_id in req_ids:
+            state = self.db.requests.get_machine_state(req_id)
+            if assigned[req_id]:
+                self.assertEqual(state, 'contact_lifeguard')
+                self.assertEqual(self.db.requests.get_assigned_device(req_id),
+                                 assigned[req_id])
+            else:
+                self.assertEqual(state, 'waiting_for_device')
+
+    def take_dev1_before_details(self):
+        # another thread takes dev1 between finding it and getting its details
+        real_details = self.db.availability.details
+        def details(device_names):
+            self.db.availability.discard('dev1')
+            return real_details(device_names)
+        return mock.patch.object(self.db.availability, 'details', details)
+
+    def test_new_device_taken(self):
+        self.set_state('new')
+        with self.take_dev1_before_details():
+            self.driver.handle_event(self.req_id, 'find_device', {})
+        self.assertEqual(self.db.requests.get_assigned_device(self.req_id), None)
+        self.assert_state('waiting_for_device')
+
+    def test_allocate_requests_device_taken(self):
+        with self.take_dev1_before_details():
+            assigned = self.driver.allocate_requests([self.req_id])
+        self.assertEqual(assigned, {self.req_id: None})
+        self.assert_state('waiting_for_device')
+
+    def test_allocate_requests_prefers_image(self):
+        self.db.execute("update images set can_reuse=1")
+        self.add_device('dev2', state='ready', image_id=1)
+        assigned = self.driver.allocate_requests([self.req_id])
+        self.assertEqual(assigned, {self.req_id: 'dev2'})
+
+    def test_allocate_requests_queued(self):
+        # requests already waiting for a device are not overtaken
+        self.db.devices.set_machine_state('dev1', 'busy', None)
+        self.set_state('new')
+        self.driver.handle_event(self.req_id, 'find_device', {})
+        self.db.devices.set_machine_state('dev1', 'ready', None)
+        new_req_id = self.add_request(image='img1', no_assign=True)
+        assigned = self.driver.allocate_requests([new_req_id])
+        self.assertEqual(assigned, {new_req_id: None})
+        self.assertEqual(self.driver.request_queue.waiting((None, 'img1')),
+                         [self.req_id, new_req_id])
+
+    def test_waiting_for_device(self):
+        self.db.devices.set_machine_state('dev1', 'busy', None)
+        req2_id = self.add_request(image='img1', no_assign=True)
+        for req_id in self.req_id, req2_id:
+            self.db.requests.set_machine_state(req_id, 'new', None)
+            self.driver.handle_event(req_id, 'find_device', {})
+            self.assertEqual(self.db.requests.get_machine_state(req_id),
+                             'waiting_for_device')
+        self.assertEqual(self.driver.request_queue.waiting((None, 'img1')),
+                         [self.req_id, req2_id])
+
+        # when the device becomes ready, the first request in the queue gets it
+        self.db.devices.set_machine_state('dev1', 'ready', None)
+        self.driver.poll_others()
+        self.assert_state('contact_lifeguard')
+        self.assertEqual(self.db.requests.get_assigned_device(self.req_id), 'dev1')
+        self.assertEqual(self.db.requests.get_machine_state(req2_id),
+                         'waiting_for_device')
+        self.assertEqual(self.driver.request_queue.waiting((None, 'img1')),
+                         [req2_id])
+
+        # and when that request is closed, the second gets it
+        self.driver.handle_event(self.req_id, 'close', {})
+        self.driver.poll_others()
+        self.assertEqual(self.db.requests.get_assigned_device(req2_id), 'dev1')
+        self.assertEqual(self.driver.request_queue.waiting((None, 'img1')), [])
+
+    def test_waiting_for_device_other_server(self):
+        # a device made ready behind the index's back (by another server) is
+        # found on the next poll
+        self.db.devices.set_machine_state('dev1', 'busy', None)
+        self.set_state('new')
+        self.driver.handle_event(self.req_id, 'find_device', {})
+        self.db.execute("update devices set state='ready'")
+        self.driver.poll_others()
+        self.assert_state('contact_lifeguard')
+        self.assertEqual(self.db.requests.get_assigned_device(self.req_id), 'dev1')
+
+    def test_waiting_for_device_gives_up(self):
+        self.db.devices.set_machine_state('dev1', 'busy', None)
+        self.set_state('new')
+        self.driver.handle_event(self.req_id, 'find_device', {})
+        for _ in range(requestmachine.waiting_for_device.MAX_TIMEOUTS):
+            self.assert_state('waiting_for_device')
+            self.driver.handle_timeout(self.req_id)
+        self.assert_state('failed_device_not_found')
+        self.assertFalse(self.req_id in self.driver.request_queue)
+
+    def test_waiting_for_device_timeout_polls(self):
+        # a device that becomes available without notification is found on
+        # timeout
+        self.db.devices.set_machine_state('dev1', 'busy', None)
+        self.set_state('new')
+        self.driver.handle_event(self.req_id, 'find_device', {})
+        self.db.execute("update devices set state='ready'")
+        self.db.availability.invalidate()
+        self.driver.handle_timeout(self.req_id)
+        self.assert_state('contact_lifeguard')
+
+    def test_waiting_for_device_closed(self):
+        self.db.devices.set_machine_state('dev1', 'busy', None)
+        self.set_state('new')
+        self.driver.handle_event(self.req_id, 'find_device', {})
+        self.driver.handle_event(self.req_id, 'close', {})
+        self.assert_state('closed')
+        self.assertFalse(self.req_id in self.driver.request_queue)
+
+    def test_waiting_for_device_priority(self):
+        self.db.devices.set_machine_state('dev1', 'busy', None)
+        low_id = self.add_request(image='img1', no_assign=True, priority='low')
+        high_id = self.add_request(image='img1', no_assign=True, priority='high')
+        for req_id in self.req_id, low_id, high_id:
+            self.db.requests.set_machine_state(req_id, 'new', None)
+            self.driver.handle_event(req_id, 'find_device', {})
+        self.assertEqual(self.driver.request_queue.waiting((None, 'img1')),
+                         [high_id, self.req_id, low_id])
+        self.db.devices.set_machine_state('dev1', 'ready', None)
+        self.driver.poll_others()
+        self.assertEqual(self.db.requests.get_assigned_device(high_id), 'dev1')
+        self.assertEqual(self.driver.allocation_stats.get().keys(), ['high'])
+
+    def test_reserved_capacity(self):
+        config.set('reservations', 'prod', '1')
+        self.db.devices.set_environment('dev1', 'prod')
+        self.add_device('dev2', state='ready', environment='prod')
+        low_id = self.add_request(image='img1', no_assign=True,
+                                  environment='prod', priority='low')
+        low2_id = self.add_request(image='img1', no_assign=True,
+                                   environment='any', priority='low')
+        high_id = self.add_request(image='img1', no_assign=True,
+                                   environment='prod', priority='high')
+        for req_id in low_id, low2_id, high_id:
+            self.db.requests.set_machine_state(req_id, 'new', None)
+            self.driver.handle_event(req_id, 'find_device', {})
+        # the first low-priority request gets a device, but the last device
+        # is held for the high-priority request
+        self.assertEqual(self.db.requests.get_machine_state(low_id), 'contact_lifeguard')
+        self.assertEqual(self.db.requests.get_machine_state(low2_id), 'waiting_for_device')
+        self.assertEqual(self.db.requests.get_machine_state(high_id), 'contact_lifeguard')
+
     def test_new_lifeguard_fails(self):
         self.set_state('new')
         self.driver.handle_event(self.req_id, 'find_device', {})
@@ -0,0 +1,794 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+A load- and soak-testing harness for Mozpool.
+
+This simulates a rack of thousands of fake devices in a single thread, driving
+the real LifeguardDriver and MozpoolDriver against a real database.  Rather
+than one thread per device sleeping in real time, as in fakedevices.py, every
+activity is an event scheduled on a virtual clock, which jumps directly from
+one event to the next.  Hours of operation take seconds or minutes, depending
+mostly on the speed of the database.
+
+The devices use the failure and functionality probabilities of
+`fakedevices.Device`, and are controlled through a simulated BMM API instead
+of patching the ping and SUT modules.  A workload of clients submits requests
+for devices, holds them for a while once they are ready, and returns them.
+
+Run it from the command line with, for example,
+
+    python -m mozpool.test.loadtest --devices 2000 --hours 12 \\
+        --db sqlite:////tmp/loadtest.sqlite
+
+The database must be empty; the schema and test data are created
+automatically.
+"""
+
+from __future__ import absolute_import
+
+import re
+import sys
+import json
+import heapq
+import random
+import logging
+import argparse
+import datetime
+import itertools
+import time
+import mock
+import mozpool.lifeguard
+import mozpool.mozpool
+from mozpool import config, eventbus, statedriver, util, clock
+from mozpool.db import model, pool, setup as db_setup
+from mozpool.lifeguard import devicemachine
+from mozpool.mozpool import requestmachine
+from mozpool.test import fakedevices
+
+logger = logging.getLogger('loadtest')
+
+DEVICES_PER_RELAY_BOARD = 14
+
+
+####
+# Event loop
+
+class EventLoop(object):
+    """
+    A discrete-event loop with a virtual clock, `clock`, which is a
+    `SimulatedClock`.  Callables are scheduled to run at a virtual time, and
+    are run in order of that time, and then in the order in which they were
+    scheduled.  The clock jumps directly from one event to the next.
+
+    Exceptions from callables are logged and counted in `errors`, just as an
+    exception in a thread would be logged and otherwise ignored.
+    """
+
+    def __init__(self, start=None):
+        self.clock = clock.SimulatedClock(start)
+        self.events_run = 0
+        self.errors = 0
+        self._queue = []
+        self._seq = itertools.count()
+
+    @property
+    def now(self):
+        return self.clock.time()
+
+    def call_at(self, when, fn, *args):
+        heapq.heappush(self._queue, (when, next(self._seq), fn, args))
+
+    def call_later(self, delay, fn, *args):
+        self.call_at(self.now + max(0, delay), fn, *args)
+
+    def step(self, until):
+        """
+        Run the next callable, if it is scheduled no later than UNTIL.  Returns
+        False if there is no such callable.
+        """
+        if not self._queue or self._queue[0][0] > until:
+            return False
+        when, _, fn, args = heapq.heappop(self._queue)
+        if when > self.now:
+            self.clock.set(when)
+        self.events_run += 1
+        try:
+            fn(*args)
+        except Exception:
+            self.errors += 1
+            logger.error("exception in simulated event", exc_info=True)
+        return True
+
+
+class _Notifier(util.ChangeNotifier):
+    """
+    A ChangeNotifier that also calls `callback` with the name of each machine
+    that changes state.
+    """
+
+    def __init__(self, callback):
+        util.ChangeNotifier.__init__(self)
+        self.callback = callback
+
+    def notify(self, name):
+        util.ChangeNotifier.notify(self, name)
+        self.callback(name)
+
+
+####
+# Devices
+
+class SimDevice(fakedevices.Device):
+    """
+    A fake device driven by events on the loop, rather than by a thread.  The
+    boot process and second-stage scripts follow those of
+    `fakedevices.Device`, with the same failure probabilities, except that an
+    injected failure leaves the device hung until it is next power-cycled.
+    """
+
+    def __init__(self, rack, name, dev_dict):
+        fakedevices.Device.__init__(self, rack, name, dev_dict)
+        self.loop = rack.loop
+        self.relay_board = dev_dict['relay_info'].rsplit(':', 2)[0]
+        self.second_stage = None
+        # incremented on every power cycle, abandoning whatever the device
+        # was doing before
+        self.generation = 0
+
+    def start(self):
+        # as in Device.run, come up hung unless the DB says this device is
+        # up and running
+        if self.dev_dict['state'] in ('free', 'ready'):
+            self.boot_sdcard()
+        else:
+            self.fail()
+
+    def power_cycle(self):
+        self.generation += 1
+        self.power = True
+        self._set_state('booting')
+        # load uboot, which makes us pingable for a bit
+        self.pingable = True
+        self._after(7, 3, self._booted)
+
+    def _booted(self):
+        self.pingable = False
+        if not self.second_stage:
+            self.boot_sdcard()
+            return
+        self.pingable = True
+        self._send_event('mobile_init_started')
+        meth = getattr(self, 'boot_%s' % self.second_stage.replace('-', '_'))
+        self._after(1, 0, meth)
+
+    def _after(self, seconds, splay, fn, *args):
+        """
+        Call FN after the given time, as Device._wait does, unless a failure
+        is injected first or the device is power-cycled in the meantime.
+        """
+        if self._failure_injected():
+            return
+        if splay:
+            seconds = seconds + random.randint(-splay, splay)
+        generation = self.generation
+        def call():
+            if self.generation == generation:
+                fn(*args)
+        self.loop.call_later(seconds, call)
+
+    def _failure_injected(self):
+        p = self.failure_probability.get(self.state, 0)
+        if p and random.random() < p:
+            self.logger.warning('failure injected')
+            self.fail()
+            return True
+        return False
+
+    def _send_event(self, event, set_state=True):
+        if set_state:
+            self._set_state(event)
+        self.loop.call_later(0, mozpool.lifeguard.driver.handle_event,
+                             self.name, event, {})
+
+    def boot_sdcard(self):
+        self._set_state('running_%s' % self.sdcard_image)
+        self.pingable = self.image_pingable.get(self.sdcard_image, False)
+        # runs until the next power cycle
+        self._failure_injected()
+
+    def boot_b2g_second_stage(self):
+        self._send_event('b2g_downloading')
+        self._after(60, 30, self._b2g_extracting)
+
+    def _b2g_extracting(self):
+        self._send_event('b2g_extracting')
+        self.sdcard_image = 'corrupt'
+        self._after(90, 60, self._b2g_rebooting)
+
+    def _b2g_rebooting(self):
+        self._send_event('b2g_rebooting')
+        # time for the reboot command to do its thing
+        self._after(3, 2, self._rebooted, 'b2g')
+
+    def boot_android_second_stage(self):
+        self._send_event('android_downloading')
+        self._after(60, 30, self._android_extracting)
+
+    def _android_extracting(self):
+        self._send_event('android_extracting')
+        self.sdcard_image = 'corrupt'
+        self._after(90, 60, self._android_rebooting)
+
+    def _android_rebooting(self):
+        self._send_event('android_rebooting')
+        self._after(3, 2, self._rebooted, 'android')
+
+    def _rebooted(self, image):
+        self.pingable = False
+        self.sdcard_image = image
+        self.boot_sdcard()
+
+    def boot_maintenance_second_stage(self):
+        self._send_event('maint_mode')
+        # run for an hour, then crash
+        self._after(3600, 0, self.fail)
+
+    def boot_selftest_second_stage(self):
+        self._send_event('self_test_running')
+        if random.random() < 0.8:
+            # run for a minute, then succeed
+            self._after(60, 0, self._send_event, 'self_test_ok')
+        else:
+            self.fail()
+
+    def fail(self):
+        self.pingable = False
+        self._set_state('failed')
+
+
+class SimRack(object):
+    """
+    All of the devices managed by this imaging server, as SimDevices.  Relay
+    boards handle one power cycle at a time, so power cycles are queued per
+    board.
+    """
+
+    def __init__(self, loop, db):
+        self.loop = loop
+        self.db = db
+        self.devices = {}
+        # relay board hostname -> time at which it is free
+        self._relay_free_at = {}
+
+        fqdn = config.get('server', 'fqdn')
+        for dev_dict in db.devices.list(detail=True):
+            if dev_dict['imaging_server'] != fqdn or not dev_dict['relay_info']:
+                continue
+            self.devices[dev_dict['name']] = SimDevice(self, dev_dict['name'],
+                                                       dev_dict)
+
+    def start(self):
+        for device in self.devices.itervalues():
+            device.start()
+
+    def schedule_relay(self, device, duration):
+        """
+        Return the time at which an operation of the given duration on the
+        device's relay board will be complete, reserving the board until then.
+        """
+        start = max(self.loop.now, self._relay_free_at.get(device.relay_board, 0))
+        self._relay_free_at[device.relay_board] = done = start + duration
+        return done
+
+
+class SimOperation(object):
+    """
+    A simulated BMM operation with the same interface as an AsyncOperation.
+    The operation's result is computed when it completes, `latency` seconds
+    after it is started.
+    """
+
+    def __init__(self, loop, func, latency):
+        self.loop = loop
+        self.func = func
+        self.latency = latency
+
+    def start(self, callback, *args):
+        def complete():
+            callback(self.func(*args))
+        self.loop.call_later(self.latency, complete)
+
+    def run(self, *args):
+        return self.func(*args)
+
+
+class SimAPI(object):
+    """
+    A replacement for `mozpool.bmm.api.API` that operates on the devices of a
+    SimRack.  Each operation makes the same database queries as the real
+    operation, so that the load on the database is realistic.
+    """
+
+    # seconds for each operation to complete
+    RELAY_TIME = 3
+    LATENCY = {
+        'ping': 0.5,
+        'sut_verify': 2,
+        'check_sdcard': 5,
+    }
+
+    def __init__(self, rack):
+        self.rack = rack
+        self.db = rack.db
+        loop = rack.loop
+        for name in 'ping', 'sut_verify', 'check_sdcard':
+            setattr(self, name, SimOperation(loop, getattr(self, '_' + name),
+                                             self.LATENCY[name]))
+        self.set_pxe = SimOperation(loop, self._set_pxe, 0)
+        self.clear_pxe = SimOperation(loop, self._clear_pxe, 0)
+        self.powercycle = _RelayOperation(self, self._powercycle)
+        self.poweroff = _RelayOperation(self, self._poweroff)
+
+    def _device(self, device_name):
+        return self.rack.devices[device_name]
+
+    def _ping(self, device_name):
+        self.db.devices.get_fqdn(device_name)
+        return self._device(device_name).ping()
+
+    def _sut_verify(self, device_name):
+        self.db.devices.log_message(device_name, 'connecting to SUT agent', 'sut')
+        self.db.devices.get_fqdn(device_name)
+        return self._device(device_name).sut_verify()
+
+    def _check_sdcard(self, device_name):
+        self.db.devices.log_message(device_name, 'verifying SD card', 'sut')
+        self.db.devices.get_fqdn(device_name)
+        return self._device(device_name).check_sdcard()
+
+    def _set_pxe(self, device_name, pxe_config_name):
+        pxe_config = self.db.pxe_configs.get(pxe_config_name)['contents']
+        self.db.devices.get_mac_address(device_name)
+        self._device(device_name).second_stage = \
+                fakedevices.get_second_stage(pxe_config)
+
+    def _clear_pxe(self, device_name):
+        self.db.devices.get_mac_address(device_name)
+        self._device(device_name).second_stage = None
+
+    def _powercycle(self, device):
+        device.power_cycle()
+        return True
+
+    def _poweroff(self, device):
+        device.generation += 1
+        device.power = False
+        device.pingable = False
+        device._set_state('off')
+        return True
+
+
+class _RelayOperation(object):
+    """
+    A simulated relay operation, which waits its turn at the device's relay
+    board.
+    """
+
+    def __init__(self, api, func):
+        self.api = api
+        self.func = func
+
+    def start(self, callback, device_name):
+        self.api.db.devices.get_relay_info(device_name)
+        device = self.api._device(device_name)
+        done = self.api.rack.schedule_relay(device, self.api.RELAY_TIME)
+        def complete():
+            callback(self.func(device))
+        self.api.rack.loop.call_at(done, complete)
+
+    def run(self, device_name):
+        self.api.db.devices.get_relay_info(device_name)
+        return self.func(self.api._device(device_name))
+
+
+class SimEventBus(eventbus.EventBus):
+    """
+    An event bus that delivers every event to the local drivers on the loop.
+    """
+
+    def __init__(self, loop):
+        eventbus.EventBus.__init__(self)
+        self.loop = loop
+
+    def send(self, object_type, imaging_server, name, event, body, callback):
+        self.loop.call_later(0, self.deliver, object_type, name, event, body,
+                             callback)
+
+
+####
+# Measurement
+
+_table_re = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+(\w+)', re.I)
+
+def summarize_statements(by_statement):
+    """
+    Combine the counts and times of SQL statements (as in
+    `QueryStats.by_statement`) by the type of statement and the first table
+    it names, e.g., 'SELECT devices'.
+    """
+    summary = {}
+    for statement, stats in by_statement.iteritems():
+        mo = _table_re.search(statement)
+        key = statement.split(None, 1)[0].upper()
+        if mo:
+            key += ' ' + mo.group(1)
+        entry = summary.setdefault(key, {'count': 0, 'time': 0.0})
+        entry['count'] += stats['count']
+        entry['time'] += stats['time']
+    return summary
+
+
+####
+# Workload
+
+class Workload(object):
+    """
+    Clients requesting devices.  Requests arrive at random (as a Poisson
+    process) at `rate` requests per hour, each asking for 'any' device with an
+    image chosen at random according to the weights in `images`.  A client
+    holds its device for an exponentially distributed time with mean `hold`
+    seconds after it is ready, then returns it.  Requests that fail are
+    counted and forgotten.
+    """
+
+    ASSIGNED_STATES = ('contact_lifeguard', 'contacting_lifeguard', 'pending',
+                       'ready')
+
+    def __init__(self, rate=120, hold=1800, images=None, duration=12*3600):
+        self.rate = rate
+        self.hold = hold
+        self.images = images or {'android': 3, 'b2g': 1}
+        self.duration = duration
+
+        self.submitted = {}
+        self.assign_latency = []
+        self.ready_latency = []
+        self.closed = 0
+        self.failed = {}
+        self._assigned = set()
+        self._done = set()
+
+    def start(self, loadtest):
+        self.loadtest = loadtest
+        self.loop = loadtest.loop
+        self.db = loadtest.db
+        self._image_ids = dict((name, self.db.images.get(name)['id'])
+                               for name in self.images)
+        self._schedule_arrival()
+
+    def _schedule_arrival(self):
+        self.loop.call_later(random.expovariate(self.rate / 3600.0), self.arrive)
+
+    def _choose_image(self):
+        choice = random.uniform(0, sum(self.images.itervalues()))
+        for name, weight in sorted(self.images.iteritems()):
+            choice -= weight
+            if choice <= 0:
+                break
+        return name
+
+    def arrive(self):
+        self._schedule_arrival()
+        image = self._choose_image()
+        request_id = self.db.requests.add('any', 'any', 'loadtest',
+                self.duration, self._image_ids[image], {})
+        self.submitted[request_id] = self.loop.now
+        mozpool.mozpool.driver.handle_event(request_id, 'find_device', None)
+
+    def changed(self, request_id):
+        """
+        Called when a request changes state.
+        """
+        if request_id not in self.submitted or request_id in self._done:
+            return
+        with self.loadtest.queries.paused():
+            state = self.db.requests.get_machine_state(request_id)
+        elapsed = self.loop.now - self.submitted[request_id]
+
+        if state in self.ASSIGNED_STATES and request_id not in self._assigned:
+            self._assigned.add(request_id)
+            self.assign_latency.append(elapsed)
+        if state == 'ready':
+            self._done.add(request_id)
+            self.ready_latency.append(elapsed)
+            self.loop.call_later(random.expovariate(1.0 / self.hold),
+                                 self.close, request_id)
+        elif state.startswith('failed_'):
+            self._done.add(request_id)
+            self.failed[state] = self.failed.get(state, 0) + 1
+
+    def close(self, request_id):
+        mozpool.mozpool.driver.handle_event(request_id, 'close', None)
+        self.closed += 1
+
+    def report(self):
+        return {
+            'submitted': len(self.submitted),
+            'assigned': len(self._assigned),
+            'ready': len(self.ready_latency),
+            'closed': self.closed,
+            'failed': dict(self.failed),
+            'outstanding': len(self.submitted) - len(self._done),
+        }
+
+
+####
+# Harness
+
+def populate(db, num_devices, imaging_server=None):
+    """
+    Add test data for a simulated rack of NUM_DEVICES devices managed by the
+    given imaging server (by default, this one) to an empty database.  The
+    devices start out ready, with the 'android' image installed.
+    """
+    imaging_server = imaging_server or config.get('server', 'fqdn')
+    now = datetime.datetime.now()
+    with db.transaction() as conn:
+        server_id = conn.execute(model.imaging_servers.insert(),
+                                 fqdn=imaging_server).inserted_primary_key[0]
+        hw_id = conn.execute(model.hardware_types.insert(), type='panda',
+                             model='ES Rev B2').inserted_primary_key[0]
+        image_ids = {}
+        for name, can_reuse, hidden, second_stage in [
+                ('b2g', False, False, 'b2g-second-stage'),
+                ('android', True, False, 'android-second-stage'),
+                ('self-test', False, True, 'selftest-second-stage'),
+                ('maintenance', False, True, 'maintenance-second-stage')]:
+            image_ids[name] = conn.execute(model.images.insert(), name=name,
+                    boot_config_keys='[]', can_reuse=can_reuse, hidden=hidden,
+                    has_sut_agent=not hidden).inserted_primary_key[0]
+            pxe_config_id = conn.execute(model.pxe_configs.insert(),
+                    name='sim-%s' % name, description='simulated %s' % name,
+                    contents='mobile-imaging-url=http://%s/scripts/%s.sh' %
+                             (imaging_server, second_stage),
+                    active=True).inserted_primary_key[0]
+            conn.execute(model.image_pxe_configs.insert(),
+                    image_id=image_ids[name], pxe_config_id=pxe_config_id,
+                    hardware_type_id=hw_id)
+
+        devices = []
+        for i in xrange(num_devices):
+            board, relay = divmod(i, DEVICES_PER_RELAY_BOARD)
+            bank, relay = divmod(relay, 8)
+            devices.append({
+                'name': 'sim%d' % i,
+                'fqdn': 'sim%d.sim' % i,
+                'inventory_id': i + 1,
+                'mac_address': '%012x' % i,
+                'imaging_server_id': server_id,
+                'relay_info': 'simrelay%d:bank%d:relay%d' % (board, bank + 1,
+                                                             relay + 1),
+                'hardware_type_id': hw_id,
+                'image_id': image_ids['android'],
+                'boot_config': '{}',
+                'state': 'ready',
+                # spread the devices' periodic checks over the ready timeout
+                'state_timeout': now + datetime.timedelta(
+                    seconds=random.uniform(0, devicemachine.ready.TIMEOUT)),
+                'state_counters': '{}',
+                'environment': None,
+            })
+        if devices:
+            conn.execute(model.devices.insert(), devices)
+
+
+class LoadTest(object):
+    """
+    Simulate the devices managed by this imaging server in the given
+    database (see `populate`), under the given workload.
+
+    The drivers are polled every `poll_frequency` virtual seconds, and
+    immediately when woken, as their threads would be in the server.  While
+    the test runs, the loop's clock is the current clock (see `mozpool.clock`).
+    """
+
+    def __init__(self, db, workload, poll_frequency=statedriver.POLL_FREQUENCY):
+        self.db = db
+        self.workload = workload
+        self.poll_frequency = poll_frequency
+        self.loop = EventLoop()
+        # SQL statements executed by the simulation, excluding the harness
+        self.queries = pool.QueryStats()
+        self.rack = SimRack(self.loop, db)
+        self.transitions = {'device': 0, 'request': 0}
+
+    def _device_changed(self, device_name):
+        self.transitions['device'] += 1
+
+    def _request_changed(self, request_id):
+        self.transitions['request'] += 1
+        self.loop.call_later(0, self.workload.changed, request_id)
+
+    def _poll(self, driver):
+        driver._tick()
+        self.loop.call_later(self.poll_frequency, self._poll, driver)
+
+    def _patches(self):
+        loop = self.loop
+        return [
+            mock.patch.object(clock, 'current', loop.clock),
+            mock.patch.object(eventbus, 'bus', SimEventBus(loop)),
+            mock.patch.object(devicemachine.DeviceStateMachine, 'changeNotifier',
+                              _Notifier(self._device_changed)),
+            mock.patch.object(requestmachine.RequestStateMachine, 'changeNotifier',
+                              _Notifier(self._request_changed)),
+        ]
+
+    def run(self, duration):
+        """
+        Run the simulation for DURATION virtual seconds, returning a report as
+        described for `report`.
+        """
+        patches = self._patches()
+        for p in patches:
+            p.start()
+        drivers = []
+        try:
+            lifeguard_driver = devicemachine.LifeguardDriver(self.db,
+                    self.poll_frequency)
+            lifeguard_driver.api = SimAPI(self.rack)
+            mozpool_driver = requestmachine.MozpoolDriver(self.db,
+                    self.poll_frequency)
+            drivers = [lifeguard_driver, mozpool_driver]
+            mozpool.lifeguard.driver = lifeguard_driver
+            mozpool.mozpool.driver = mozpool_driver
+            eventbus.bus.register('device', lifeguard_driver)
+            eventbus.bus.register('request', mozpool_driver)
+
+            self.rack.start()
+            for driver in drivers:
+                self._poll(driver)
+            self.workload.start(self)
+
+            with self.db.pool.count_queries() as self.queries:
+                started_at = time.time()
+                end = self.loop.now + duration
+                while self.loop.step(end):
+                    for driver in drivers:
+                        if driver._wakeup.isSet():
+                            driver._wakeup.clear()
+                            self.loop.call_later(0, driver._tick)
+                self.loop.clock.set(end)
+                wall_time = time.time() - started_at
+        finally:
+            for driver in drivers:
+                driver.stop()
+            mozpool.lifeguard.driver = None
+            mozpool.mozpool.driver = None
+            for p in reversed(patches):
+                p.stop()
+        return self.report(duration, wall_time)
+
+    def report(self, duration, wall_time):
+        """
+        Return a dictionary describing a run of DURATION virtual seconds that
+        took WALL_TIME seconds, with keys
+
+          - devices -- the number of simulated devices
+          - duration, wall_time
+          - events -- the number of simulated events
+          - errors -- the number of events that raised an exception
+          - transitions -- state transitions, keyed by 'device' and 'request'
+          - requests -- the workload's counts of requests 'submitted',
+            'assigned', 'ready', 'closed', 'failed' (by state) and
+            'outstanding' (neither ready nor failed)
+          - throughput -- 'ready_per_hour' and 'transitions_per_hour'
+          - latency -- percentiles (see `mozpool.util.percentiles`) of the
+            virtual time from submitting a request until a device was
+            'assigned' and until it was 'ready'
+          - queries -- the 'total' number of SQL statements, the number 'per_hour'
+            and 'per_request' (per ready request), their total 'time' in
+            seconds, and the count and time 'by_statement' (see
+            `summarize_statements`) and 'by_caller' (as in `QueryStats`)
+        """
+        hours = duration / 3600.0
+        requests = self.workload.report()
+        total = self.queries.count
+        return {
+            'devices': len(self.rack.devices),
+            'duration': duration,
+            'wall_time': wall_time,
+            'events': self.loop.events_run,
+            'errors': self.loop.errors,
+            'transitions': dict(self.transitions),
+            'requests': requests,
+            'throughput': {
+                'ready_per_hour': requests['ready'] / hours,
+                'transitions_per_hour': sum(self.transitions.values()) / hours,
+            },
+            'latency': {
+                'assigned': util.percentiles(self.workload.assign_latency),
+                'ready': util.percentiles(self.workload.ready_latency),
+            },
+            'queries': {
+                'total': total,
+                'per_hour': total / hours,
+                'per_request': float(total) / requests['ready'] if requests['ready'] else None,
+                'time': self.queries.time,
+                'by_statement': summarize_statements(self.queries.by_statement),
+                'by_caller': dict(self.queries.by_caller),
+            },
+        }
+
+
+def format_report(report):
+    lines = [
+        '%(devices)d devices for %(duration)ds in %(wall_time).1fs '
+        '(%(events)d events, %(errors)d errors)' % report,
+        'requests: %(submitted)d submitted, %(assigned)d assigned, %(ready)d ready, '
+        '%(closed)d closed, %(outstanding)d outstanding' % report['requests'],
+    ]
+    for state, count in sorted(report['requests']['failed'].iteritems()):
+        lines.append('  %s: %d' % (state, count))
+    lines.append('throughput: %(ready_per_hour).1f ready/h, '
+                 '%(transitions_per_hour).1f transitions/h' % report['throughput'])
+    for name in 'assigned', 'ready':
+        latency = report['latency'][name]
+        if latency['count']:
+            lines.append('latency to %s: p50 %.1fs, p90 %.1fs, p99 %.1fs, max %.1fs' %
+                    (name, latency['p50'], latency['p90'], latency['p99'],
+                     latency['max']))
+    queries = report['queries']
+    lines.append('queries: %d (%.1f/h, %s/request) in %.1fs' % (queries['total'],
+            queries['per_hour'], '%.1f' % queries['per_request']
+                    if queries['per_request'] is not None else '-',
+            queries['time']))
+    for title in 'by_statement', 'by_caller':
+        lines.append('  %s:' % title.replace('_', ' '))
+        for key, stats in sorted(queries[title].iteritems(),
+                                 key=lambda item: -item[1]['count']):
+            lines.append('    %-40s %8d %8.2fs' % (key, stats['count'], stats['time']))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test Mozpool with simulated devices.')
+    parser.add_argument('--db', metavar='URL', required=True,
+                        help='SQLAlchemy URL of an empty database to use')
+    parser.add_argument('--devices', type=int, default=1000,
+                        help='number of simulated devices')
+    parser.add_argument('--hours', type=float, default=6,
+                        help='virtual time to simulate')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='requests per hour (default: one per device per hour)')
+    parser.add_argument('--hold', type=float, default=1800,
+                        help='mean time for which clients hold devices, in seconds')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='random seed, for repeatable runs')
+    parser.add_argument('--log', metavar='FILE', default='loadtest.log',
+                        help='file for the servers\' log output')
+    parser.add_argument('--json', action='store_true', default=False,
+                        help='print the report as JSON')
+    args = parser.parse_args()
+
+    logging.basicConfig(filename=args.log, level=logging.DEBUG,
+            format="%(name)s %(levelname)s - [%(asctime)s] %(message)s")
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    db = db_setup(args.db)
+    model.metadata.create_all(bind=db.pool.engine)
+    populate(db, args.devices)
+
+    workload = Workload(rate=args.rate or args.devices, hold=args.hold)
+    report = LoadTest(db, workload).run(args.hours * 3600)
+    if args.json:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print
+    else:
+        print format_report(report)
+
+if __name__ == '__main__':
+    main()
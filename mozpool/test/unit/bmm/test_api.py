@@ -3,6 +3,8 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import mock
+import time
+from mozpool import async
 from mozpool.bmm import api
 from mozpool.test.util import ConfigMixin, DBMixin, TestCase
 
@@ -58,3 +60,40 @@ class Tests(DBMixin, ConfigMixin, TestCase):
     def test_two_way_comms(self, test_two_way_comms):
         self.api.test_two_way_comms.run('relay1')
         test_two_way_comms.assert_called_with('relay1.example.com', 10)
+
+    @mock.patch('mozpool.bmm.ping.ping')
+    def test_bulk_ping(self, ping):
+        self.add_device('dev2')
+        ping.side_effect = lambda fqdn : fqdn == 'dev1.example.com'
+        self.assertEqual(self.api.bulk('ping', ['dev1', 'dev2']),
+                         {'dev1': True, 'dev2': False})
+
+    @mock.patch('mozpool.bmm.relay.powercycle')
+    def test_bulk_powercycle_serialized_by_board(self, powercycle):
+        self.add_device('dev2', relayinfo='rly:bank1:relay3')
+        self.add_device('dev3', relayinfo='rly2:bank1:relay1')
+        order = []
+        def fake_powercycle(hostname, bnk, rly, timeout):
+            order.append((hostname, 'start'))
+            time.sleep(0.01)
+            order.append((hostname, 'end'))
+            return rly != 3
+        powercycle.side_effect = fake_powercycle
+        self.assertEqual(self.api.bulk('powercycle', ['dev1', 'dev2', 'dev3']),
+                         {'dev1': True, 'dev2': False, 'dev3': True})
+        # operations on the same board did not overlap
+        rly_order = [ evt for host, evt in order if host == 'rly' ]
+        self.assertEqual(rly_order, ['start', 'end', 'start', 'end'])
+
+    def test_bulk_max_time(self):
+        self.add_device('dev2', relayinfo='rly:bank1:relay3')
+        self.add_device('dev3', relayinfo='rly2:bank1:relay1')
+        # two boards in parallel, one of which has two devices in sequence
+        self.assertEqual(self.api.bulk_max_time('powercycle', ['dev1', 'dev2', 'dev3']),
+                         (3 / 2.0 + 2) * self.api.powercycle.max_time)
+        self.assertEqual(self.api.bulk_max_time('ping', []), 0)
+
+    @mock.patch('mozpool.bmm.api.API.ping')
+    def test_bulk_timeout(self, ping):
+        ping.run.side_effect = async.TimeoutError
+        self.assertEqual(self.api.bulk('ping', ['dev1']), {'dev1': False})
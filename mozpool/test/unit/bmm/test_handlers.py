@@ -3,8 +3,9 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import mock
+import time
 import datetime
-from mozpool import config
+from mozpool import config, async
 from mozpool.test.util import TestCase, AppMixin, DBMixin, ConfigMixin, PatchMixin
 
 class Tests(AppMixin, DBMixin, ConfigMixin, PatchMixin, TestCase):
@@ -26,6 +27,8 @@ class Tests(AppMixin, DBMixin, ConfigMixin, PatchMixin, TestCase):
         img_id = self.add_image('img1')
         self.dev_id = self.add_device('dev1', environment='abc', next_image_id=img_id)
         self.add_relay_board('relay1', server='server')
+        for op in self.clear_pxe, self.powercycle, self.poweroff, self.ping:
+            op.max_time = 10
 
     def test_device_power_cycle(self):
         self.check_json_result(self.post_json('/api/device/dev1/power-cycle/', {}))
@@ -64,10 +67,87 @@ class Tests(AppMixin, DBMixin, ConfigMixin, PatchMixin, TestCase):
         body = self.check_json_result(self.app.get('/api/device/dev1/ping/'))
         self.assertEqual(body, {'success': False})
 
+    def test_device_ping_job(self):
+        self.ping.max_time = 10
+        body = self.check_json_result(self.post_json('/api/device/dev1/ping/', {}))
+        self.ping.start.assert_called_with(mock.ANY, 'dev1')
+        self.assertEqual(body['url'], 'http://server/api/job/%s/' % body['job'])
+        body = self.check_json_result(self.app.get('/api/job/%s/' % body['job']))
+        self.assertEqual(body['state'], 'running')
+
+        # invoke the callback and check that the result is available
+        self.ping.start.call_args[0][0](True)
+        body = self.check_json_result(self.app.get('/api/job/%s/' % body['id']))
+        self.assertEqual((body['operation'], body['state'], body['result']),
+                         ('ping', 'complete', True))
+
+    @mock.patch('mozpool.async.jobs.start')
+    def test_device_ping_job_full(self, start):
+        start.side_effect = async.JobStoreFull('too many')
+        r = self.post_json('/api/device/dev1/ping/', {}, expect_errors=True)
+        self.assertEqual(r.status, 503)
+
     def test_device_clear_pxe(self):
         self.check_json_result(self.post_json('/api/device/dev1/clear-pxe/', {}))
         self.clear_pxe.run.assert_called_with('dev1')
 
+    def run_bulk(self, operation, request_body):
+        """Start a bulk operation and return its job once it is finished."""
+        body = self.check_json_result(self.post_json(
+            '/api/bmm/bulk/%s/' % operation, request_body))
+        start = time.time()
+        while True:
+            job = self.check_json_result(self.app.get('/api/job/%s/' % body['job']))
+            if job['state'] != 'running' or time.time() - start > 5:
+                break
+            time.sleep(0.001)
+        self.assertEqual((job['operation'], job['state']),
+                         ('bulk %s' % operation, 'complete'))
+        return job
+
+    @mock.patch('mozpool.bmm.api.API.bulk')
+    def test_bulk_ping(self, bulk):
+        self.add_server('otherserver')
+        self.add_device('dev2', server='otherserver')
+        bulk.return_value = {'dev1': True}
+        body = self.run_bulk('ping', {'devices': ['dev1', 'dev2', 'dev99']})
+        bulk.assert_called_with('ping', ['dev1'], mock.ANY)
+        self.assertEqual(body['result'], {
+            'dev1': {'success': True},
+            'dev2': {'success': False, 'error': 'wrong imaging server',
+                     'imaging_server': 'otherserver'},
+            'dev99': {'success': False, 'error': 'not found'},
+        })
+
+    @mock.patch('mozpool.bmm.api.API.bulk')
+    def test_bulk_power_cycle(self, bulk):
+        bulk.return_value = {'dev1': True}
+        body = self.run_bulk('power-cycle', {'devices': ['dev1']})
+        bulk.assert_has_calls([
+            mock.call('clear_pxe', ['dev1'], mock.ANY),
+            mock.call('powercycle', ['dev1'], mock.ANY)])
+        self.assertEqual(body['result'], {'dev1': {'success': True}})
+
+    @mock.patch('mozpool.bmm.api.API.bulk')
+    def test_bulk_clear_pxe(self, bulk):
+        bulk.return_value = {'dev1': None}
+        body = self.run_bulk('clear-pxe', {'devices': ['dev1']})
+        self.assertEqual(body['result'], {'dev1': {'success': True}})
+
+    def test_bulk_set_environment(self):
+        body = self.run_bulk('set-environment', {'devices': ['dev1'], 'environment': 'xyz'})
+        self.assertEqual(body['result'], {'dev1': {'success': True}})
+        self.assertEqual(self.db.environments.list(), ['xyz'])
+
+    def test_bulk_bad_operation(self):
+        r = self.post_json('/api/bmm/bulk/explode/', {'devices': ['dev1']},
+                           expect_errors=True)
+        self.assertEqual(r.status, 404)
+
+    def test_bulk_missing_devices(self):
+        r = self.post_json('/api/bmm/bulk/ping/', {}, expect_errors=True)
+        self.assertEqual(r.status, 400)
+
     def test_device_log(self):
         # NOTE: datetime can't be patched, so we patch get_logs instead
         self.get_logs.return_value = [{'a': 'b'}]
@@ -133,4 +213,13 @@ class Tests(AppMixin, DBMixin, ConfigMixin, PatchMixin, TestCase):
     def test_test_two_way_comms_fails(self):
         self.test_two_way_comms.run.return_value = False
         body = self.check_json_result(self.app.get('/api/relay/relay1/test/'))
-        self.assertEqual(body, {'success': False})
\ No newline at end of file
+        self.assertEqual(body, {'success': False})
+
+    def test_test_two_way_comms_job(self):
+        self.test_two_way_comms.max_time = 11
+        body = self.check_json_result(self.post_json('/api/relay/relay1/test/', {}))
+        self.test_two_way_comms.start.assert_called_with(mock.ANY, 'relay1')
+        self.test_two_way_comms.start.call_args[0][0](False)
+        body = self.check_json_result(self.app.get('/api/job/%s/' % body['job']))
+        self.assertEqual((body['operation'], body['state'], body['result']),
+                         ('test_two_way_comms', 'complete', False))
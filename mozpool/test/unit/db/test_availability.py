@@ -0,0 +1,119 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import mock
+from mozpool.db import availability
+from mozpool.test.util import DBMixin, TestCase
+
+class Tests(DBMixin, TestCase):
+
+    def setUp(self):
+        super(Tests, self).setUp()
+        self.add_server('server')
+        self.img1_id = self.add_image('img1')
+        self.add_device('dev1', environment='prod', state='ready',
+                        image_id=self.img1_id, boot_config=u'{"a": "b", "c": "d"}')
+        self.add_device('dev2', environment='prod', state='ready')
+        self.add_device('dev3', environment='staging', state='ready')
+        self.add_device('dev4', environment='prod', state='offline')
+
+    def find(self, **kwargs):
+        return sorted(self.db.availability.find(**kwargs))
+
+    def test_boot_config_key(self):
+        self.assertEqual(availability.boot_config_key('{"a": "b", "c": "d"}'),
+                         availability.boot_config_key('{"c":"d","a":"b"}'))
+        self.assertNotEqual(availability.boot_config_key('{"a": "b"}'),
+                            availability.boot_config_key('{"a": "c"}'))
+        self.assertEqual(availability.boot_config_key(None),
+                         availability.boot_config_key(''))
+
+    def test_find_environment(self):
+        self.assertEqual(self.find(), ['dev1', 'dev2', 'dev3'])
+        self.assertEqual(self.find(environment='prod'), ['dev1', 'dev2'])
+        self.assertEqual(self.find(environment='nosuch'), [])
+
+    def test_find_device_name(self):
+        self.assertEqual(self.find(device_name='dev2'), ['dev2'])
+        self.assertEqual(self.find(device_name='dev2', environment='staging'), [])
+        self.assertEqual(self.find(device_name='dev4'), [])
+
+    def test_find_prefer_image(self):
+        self.assertEqual(self.find(environment='prod', image='img1',
+                                   boot_config='{"c": "d", "a": "b"}',
+                                   prefer_image=True), ['dev1'])
+        self.assertEqual(self.find(image='img1', boot_config='{"c": "d", "a": "b"}',
+                                   prefer_image=True), ['dev1'])
+        # a different boot_config falls back to all devices
+        self.assertEqual(self.find(environment='prod', image='img1',
+                                   boot_config='{"a": "b"}', prefer_image=True),
+                         ['dev1', 'dev2'])
+        # as does a non-reusable image
+        self.assertEqual(self.find(environment='prod', image='img1',
+                                   boot_config='{"c": "d", "a": "b"}'),
+                         ['dev1', 'dev2'])
+
+    def test_state_change(self):
+        self.assertEqual(self.find(), ['dev1', 'dev2', 'dev3'])
+        self.db.devices.set_machine_state('dev4', 'ready', None)
+        self.db.devices.set_machine_state('dev1', 'pxe_booting', None)
+        self.assertEqual(self.find(), ['dev2', 'dev3', 'dev4'])
+
+    def test_set_environment(self):
+        self.assertEqual(self.find(environment='staging'), ['dev3'])
+        self.db.devices.set_environment('dev2', 'staging')
+        self.assertEqual(self.find(environment='staging'), ['dev2', 'dev3'])
+
+    def test_assignment(self):
+        self.assertEqual(self.find(), ['dev1', 'dev2', 'dev3'])
+        req_id = self.add_request(image='img1', no_assign=True)
+        self.assertTrue(self.db.device_requests.add(req_id, 'dev2'))
+        self.assertEqual(self.find(), ['dev1', 'dev3'])
+        self.db.device_requests.clear(req_id)
+        self.assertEqual(self.find(), ['dev1', 'dev2', 'dev3'])
+
+    def test_no_queries_between_refreshes(self):
+        self.db.availability.find()
+        with mock.patch('mozpool.db.devices.Methods.list_available') as list_available:
+            self.db.availability.find(environment='prod')
+            list_available.assert_not_called()
+
+    def test_refresh(self):
+        self.assertEqual(self.find(), ['dev1', 'dev2', 'dev3'])
+        # changes made directly in the DB (e.g., by another process) are seen
+        # after the refresh interval has passed
+        self.add_device('dev5', environment='prod', state='ready')
+        self.assertEqual(self.find(), ['dev1', 'dev2', 'dev3'])
+        with mock.patch('time.time') as time:
+            time.return_value = self.db.availability._loaded_at + 31
+            self.assertEqual(self.find(), ['dev1', 'dev2', 'dev3', 'dev5'])
+
+    def test_find_device_name_not_indexed(self):
+        # a particular device made available by another process is found
+        # without waiting for a refresh
+        self.assertEqual(self.find(), ['dev1', 'dev2', 'dev3'])
+        self.add_device('dev5', environment='prod', state='ready')
+        self.assertEqual(self.find(device_name='dev5'), ['dev5'])
+        self.assertEqual(self.find(), ['dev1', 'dev2', 'dev3', 'dev5'])
+
+    def test_invalidate(self):
+        self.assertEqual(self.find(), ['dev1', 'dev2', 'dev3'])
+        self.add_device('dev5', environment='prod', state='ready')
+        self.db.availability.invalidate()
+        self.assertEqual(self.find(), ['dev1', 'dev2', 'dev3', 'dev5'])
+
+    def test_counts(self):
+        self.assertEqual(self.db.availability.counts(), {'prod': 2, 'staging': 1})
+
+    def test_find_exclude_environments(self):
+        self.assertEqual(self.find(exclude_environments=['prod']), ['dev3'])
+        self.assertEqual(self.find(environment='prod', exclude_environments=['prod']), [])
+        self.assertEqual(self.find(device_name='dev2', exclude_environments=['prod']), [])
+
+    def test_details(self):
+        self.db.availability.find()
+        self.assertEqual(self.db.availability.details(['dev1', 'dev4']), {
+            'dev1': {'environment': 'prod', 'image': 'img1', 'hardware_type_id': 1,
+                     'boot_config_key': availability.boot_config_key('{"a": "b", "c": "d"}')},
+        })
@@ -50,3 +50,18 @@ class Tests(DBMixin, TestCase):
             {'name': 'img2', 'hidden': False},
             {'name': 'img3', 'hidden': True},
         ]))
+
+    def test_transaction(self):
+        with self.db.transaction() as conn:
+            conn.execute(model.images.insert(), name='img1', can_reuse=False,
+                         hidden=False, has_sut_agent=False)
+        self.assertEqual(self.db.my.get_column(), ['img1'])
+
+    def test_transaction_rollback(self):
+        def fail():
+            with self.db.transaction() as conn:
+                conn.execute(model.images.insert(), name='img1', can_reuse=False,
+                             hidden=False, has_sut_agent=False)
+                raise RuntimeError('oh noes')
+        self.assertRaises(RuntimeError, fail)
+        self.assertEqual(self.db.my.get_column(), [])
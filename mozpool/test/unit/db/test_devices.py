@@ -4,7 +4,9 @@
 
 import time
 import datetime
-from mozpool.db import exceptions
+import sqlalchemy
+from sqlalchemy.sql import select
+from mozpool.db import exceptions, model
 from mozpool.test.util import DBMixin, TestCase
 
 class Tests(DBMixin, TestCase):
@@ -63,13 +65,19 @@ class Tests(DBMixin, TestCase):
 
         self.add_device('dev10', environment='staging', state='ready',
                 image_id=self.img1_id, boot_config=u'{"a": "b"}')
-        dev10 = {'image': 'img1', 'name': u'dev10', 'boot_config': u'{"a": "b"}'}
+        dev10 = {'image': 'img1', 'name': u'dev10', 'environment': u'staging',
+                 'hardware_type_id': 1,
+                 'boot_config': u'{"a": "b"}'}
 
         self.add_device('dev11', environment='production', state='ready')
-        dev11 = {'image': None, 'name': u'dev11', 'boot_config': u'{}'}
+        dev11 = {'image': None, 'name': u'dev11', 'environment': u'production',
+                 'hardware_type_id': 1,
+                 'boot_config': u'{}'}
 
         self.add_device('dev12', environment='production', state='ready')
-        dev12 = {'image': None, 'name': u'dev12', 'boot_config': u'{}'}
+        dev12 = {'image': None, 'name': u'dev12', 'environment': u'production',
+                 'hardware_type_id': 1,
+                 'boot_config': u'{}'}
 
         # distractor that is in state 'ready' but associated with a request, so
         # it should not be seen below
@@ -85,6 +93,13 @@ class Tests(DBMixin, TestCase):
                 [])
         self.assertEqual(self.db.devices.list_available(device_name='dev1'), [])
 
+        self.add_server('other')
+        self.add_device('dev14', server='other', state='ready')
+        other_id = self.db.imaging_servers.get_id('other')
+        self.assertEqual([ d['name'] for d in
+                           self.db.devices.list_available(imaging_server_id=other_id) ],
+                         ['dev14'])
+
     def test_list_states(self):
         self.assertEqual(self.db.devices.list_states(), {u'dev2': u'denial', u'dev1': u'occupied'})
 
@@ -174,6 +189,17 @@ class Tests(DBMixin, TestCase):
         self.assertRaises(exceptions.NotFound, lambda :
                 self.db.devices.get_relay_info('dev99'))
 
+    def test_list_bmm_info(self):
+        self.add_device('dev10', relayinfo='relay-fqdn:bank2:relay6')
+        self.add_device('dev11', relayinfo=None)
+        self.assertEqual(self.db.devices.list_bmm_info(['dev10', 'dev11', 'dev99']), {
+            'dev10': {'imaging_server': 'server', 'relay_board': 'relay-fqdn'},
+            'dev11': {'imaging_server': 'server', 'relay_board': None},
+        })
+
+    def test_list_bmm_info_empty(self):
+        self.assertEqual(self.db.devices.list_bmm_info([]), {})
+
     def test_get_image(self):
         self.add_device('dev10', image_id=self.img1_id, boot_config='{"a": "b"}')
         self.assertEqual(self.db.devices.get_image('dev10'),
@@ -280,6 +306,41 @@ class TestStateMachineMethods(DBMixin, TestCase):
         self.assertEqual(sorted(self.db.devices.list_timed_out(self.server_id)),
                          sorted(['dev11', 'dev13']))
 
+    def test_count_by_state(self):
+        self.add_server('other')
+        self.add_device('dev10', server='other', state='ready')
+        self.add_device('dev11', server='server', state='ready')
+        self.add_device('dev12', server='server', state='failed_pxe_booting')
+        self.add_device('dev13', server='server', state='ready')
+        self.assertEqual(self.db.devices.count_by_state(self.server_id),
+                         {'occupied': 1, 'denial': 1, 'ready': 2, 'failed_pxe_booting': 1})
+
+    def test_record_transition(self):
+        img2_id = self.add_image('img2')
+        hw_id = self.add_hardware_type('panda', 'ES Rev B2')
+        dev_id = self.add_device('dev3', image_id=self.img1_id,
+                                 next_image_id=img2_id, hardware_type_id=hw_id)
+        self.db.devices.record_transition('dev3', 'pxe_power_cycling', 'pxe_booting')
+        # once imaged, the device's image is recorded
+        self.db.devices.set_next_image('dev3', None, None)
+        self.db.devices.record_transition('dev3', 'pxe_booting', 'ready')
+        tbl = model.state_transitions
+        res = self.db.execute(select([tbl.c.machine_type, tbl.c.machine_id,
+                tbl.c.from_state, tbl.c.to_state, tbl.c.imaging_server_id,
+                tbl.c.hardware_type_id, tbl.c.image_id], order_by=[tbl.c.id]))
+        self.assertEqual([tuple(row) for row in res.fetchall()], [
+            ('device', dev_id, 'pxe_power_cycling', 'pxe_booting', self.server_id, hw_id, img2_id),
+            ('device', dev_id, 'pxe_booting', 'ready', self.server_id, hw_id, self.img1_id),
+        ])
+
+    def test_record_transition_missing(self):
+        self.assertRaises(sqlalchemy.exc.IntegrityError, lambda :
+                self.db.devices.record_transition('dev99', 'a', 'b'))
+
+    def test_record_transition_one_statement(self):
+        with self.assertQueryBudget(1):
+            self.db.devices.record_transition('dev1', 'a', 'b')
+
 class TestObjectLogsMethods(DBMixin, TestCase):
 
     def setUp(self):
@@ -50,3 +50,12 @@ class Tests(DBMixin, TestCase):
     def test_is_reusable_missing(self):
         self.assertRaises(exceptions.NotFound, lambda :
                 self.db.images.is_reusable('i99'))
+
+    def test_list_hardware_types(self):
+        hw_id = self.add_hardware_type('panda', 'ES')
+        self.add_pxe_config('pxe1')
+        self.add_image_pxe_config('i2', 'pxe1', 'panda', 'ES')
+        self.assertEqual(self.db.images.list_hardware_types(), {
+            'i1': {'can_reuse': False, 'hardware_type_ids': []},
+            'i2': {'can_reuse': True, 'hardware_type_ids': [hw_id]},
+        })
@@ -174,3 +174,70 @@ class Tests(DBMixin, TestCase):
         self.assertEquals([dict(r) for r in res.fetchall()], [
             {u'relay_info': u'relay-1:bank1:relay1', u'hardware_type_id': 2},
         ])
+
+    def test_apply(self):
+        now = datetime.datetime(2013, 1, 1)
+        self.add_server('server1')
+        self.add_hardware_type('panda', 'ES')
+        self.add_device('device1', server='server1', relayinfo='relay-1:bank1:relay1')
+        self.add_device('device2', server='server1', relayinfo='relay-1:bank1:relay2')
+        self.add_device('device3', server='server1', relayinfo='relay-1:bank1:relay3')
+        self.add_relay_board('relay1', server='server1')
+        self.add_relay_board('relay2', server='server1')
+        self.db.execute(model.device_logs.insert(), [
+            dict(device_id=1, ts=now, source='test', message='hi'),
+        ])
+        self.db.inventorysync.apply([
+            ('delete', 1, dict(name='device1')),
+            ('insert', dict(name='device4', fqdn='device4.fqdn', inventory_id=24,
+                            mac_address='aabbccddeeff', imaging_server='server2',
+                            relay_info='relay-2:bank1:relay1',
+                            hardware_type='tegra', hardware_model='blah')),
+            ('update', 2, dict(id=2, fqdn='device2.fqdn', imaging_server='server2')),
+            ('update', 3, dict(fqdn='device3.fqdn', imaging_server='server1',
+                               hardware_type='panda', hardware_model='ES')),
+        ], [
+            ('delete', 2, dict(name='relay2')),
+            ('insert', dict(name='relay3', fqdn='relay3.fqdn', imaging_server='server2')),
+            ('update', 1, dict(fqdn='relay1.fqdn', imaging_server='server2')),
+        ], _now=now)
+
+        tbl = model.devices
+        res = self.db.execute(sa.select([tbl.c.name, tbl.c.fqdn, tbl.c.state,
+                tbl.c.imaging_server_id, tbl.c.hardware_type_id]).order_by(tbl.c.name))
+        self.assertEqual([ tuple(r) for r in res.fetchall() ], [
+            (u'device2', u'device2.fqdn', u'offline', 2, 1),
+            (u'device3', u'device3.fqdn', u'offline', 1, 1),
+            (u'device4', u'device4.fqdn', u'new', 2, 2),
+        ])
+        res = self.db.execute(model.device_logs.select())
+        self.assertEqual(res.fetchall(), [])
+        tbl = model.relay_boards
+        res = self.db.execute(sa.select([tbl.c.name, tbl.c.fqdn, tbl.c.state,
+                tbl.c.imaging_server_id]).order_by(tbl.c.name))
+        self.assertEqual([ tuple(r) for r in res.fetchall() ], [
+            (u'relay1', u'relay1.fqdn', u'offline', 2),
+            (u'relay3', u'relay3.fqdn', u'ready', 2),
+        ])
+
+    def test_apply_rollback(self):
+        self.add_server('server1')
+        self.add_device('device1', server='server1')
+        self.add_device('device2', server='server1')
+        # the insert conflicts with device2, so nothing is changed
+        self.assertRaises(sa.exc.SQLAlchemyError, lambda :
+            self.db.inventorysync.apply([
+                ('delete', 1, dict(name='device1')),
+                ('insert', dict(name='device2', fqdn='device2.fqdn', inventory_id=24,
+                                mac_address='aabbccddeeff', imaging_server='server2',
+                                relay_info='', hardware_type='tegra',
+                                hardware_model='blah')),
+            ]))
+        res = self.db.execute(sa.select([model.devices.c.name]))
+        self.assertEqual(sorted(r[0] for r in res.fetchall()), ['device1', 'device2'])
+        res = self.db.execute(sa.select([model.imaging_servers.c.fqdn]))
+        self.assertEqual(res.fetchall(), [('server1',)])
+
+    def test_apply_bad_task(self):
+        self.assertRaises(RuntimeError, lambda :
+            self.db.inventorysync.apply([('frob', 1, {})]))
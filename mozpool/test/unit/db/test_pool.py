@@ -0,0 +1,93 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import mock
+import threading
+from mozpool.db import pool
+from mozpool.test.util import DBMixin, TestCase
+
+class FingerprintTests(TestCase):
+
+    def test_whitespace(self):
+        self.assertEqual(pool.fingerprint("SELECT a\n  FROM t\n WHERE b = ?"),
+                         "SELECT a FROM t WHERE b = ?")
+
+    def test_in_list(self):
+        self.assertEqual(pool.fingerprint("SELECT a FROM t WHERE b IN (?, ?, ?)"),
+                         pool.fingerprint("SELECT a FROM t WHERE b IN (?)"))
+        self.assertEqual(pool.fingerprint("SELECT a FROM t WHERE b in (%s,%s)"),
+                         "SELECT a FROM t WHERE b IN (...)")
+
+
+class Tests(DBMixin, TestCase):
+
+    def setUp(self):
+        super(Tests, self).setUp()
+        self.add_server('server')
+        self.db.pool.stats.reset()
+
+    def test_stats_by_caller(self):
+        with self.db.pool.count_queries() as stats:
+            self.db.imaging_servers.get_id('server')
+            self.db.imaging_servers.get_id('server')
+            self.db.execute("SELECT 1")
+        self.assertEqual(stats.count, 3)
+        self.assertEqual(stats.by_caller['imaging_servers.get_id']['count'], 2)
+        self.assertEqual(stats.by_caller['test_pool.test_stats_by_caller']['count'], 1)
+        self.assertEqual(stats.by_statement['SELECT 1']['count'], 1)
+        self.assertEqual(self.db.pool.stats.by_caller, stats.by_caller)
+
+    def test_stats_mixin_caller(self):
+        # methods inherited from mixins are attributed to the Methods class
+        with self.db.pool.count_queries() as stats:
+            self.db.devices.list_timed_out(1)
+        self.assertEqual(stats.by_caller.keys(), ['devices.list_timed_out'])
+
+    def test_stats_no_caller(self):
+        # outside of count_queries, statements are counted, but the stack is
+        # not examined to find their caller
+        with mock.patch.object(pool, '_caller') as _caller:
+            self.db.imaging_servers.get_id('server')
+        _caller.assert_not_called()
+        self.assertEqual(self.db.pool.stats.count, 1)
+        self.assertEqual(self.db.pool.stats.by_caller, {})
+
+    def test_count_queries(self):
+        with self.db.pool.count_queries() as outer:
+            self.db.imaging_servers.get_id('server')
+            with self.db.pool.count_queries() as inner:
+                self.db.imaging_servers.list()
+        self.db.imaging_servers.list()
+        self.assertEqual((outer.count, inner.count), (2, 1))
+        self.assertEqual(inner.by_caller.keys(), ['imaging_servers.list'])
+        self.assertEqual(self.db.pool.stats.count, 3)
+
+    def test_count_queries_other_threads(self):
+        with self.db.pool.count_queries() as stats:
+            thd = threading.Thread(target=self.db.imaging_servers.list)
+            thd.start()
+            thd.join()
+        self.assertEqual(stats.count, 0)
+
+    def test_paused(self):
+        with self.db.pool.stats.paused():
+            self.db.imaging_servers.list()
+        self.assertEqual(self.db.pool.stats.count, 0)
+
+    def test_slow_query(self):
+        self.db.pool.slow_query_threshold = 0
+        with mock.patch.object(pool.logger, 'warning') as warning:
+            self.db.imaging_servers.get_id('server')
+        msg = warning.call_args[0][0]
+        self.assertIn('from imaging_servers.get_id:', msg)
+        self.assertIn("parameters: ('server',)", msg)
+
+    def test_assertQueryBudget(self):
+        with self.assertQueryBudget(1):
+            self.db.imaging_servers.list()
+        def over_budget():
+            with self.assertQueryBudget(1):
+                self.db.imaging_servers.list()
+                self.db.imaging_servers.list()
+        self.assertRaises(AssertionError, over_budget)
@@ -3,7 +3,8 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import datetime
-from mozpool.db import exceptions
+from sqlalchemy.sql import select
+from mozpool.db import exceptions, model
 from mozpool.test.util import DBMixin, ConfigMixin, TestCase
 
 class Tests(DBMixin, ConfigMixin, TestCase):
@@ -28,9 +29,30 @@ class Tests(DBMixin, ConfigMixin, TestCase):
                  'assignee': u'any',
                  'image': u'b2g',
                  'expires': datetime.datetime(1978, 6, 15, 1, 0),
+                 'priority': u'normal',
                  'id': request_id,
                  'assigned_device': ''})
 
+    def test_add_many(self):
+        now = lambda : datetime.datetime(1978, 6, 15)
+        request_ids = self.db.requests.add_many(3, requested_device='any',
+                environment='prod', assignee='me', duration=3600,
+                image_id=self.img_id, boot_config={'a': 'b'}, priority='high',
+                _now=now)
+        self.assertEqual(len(set(request_ids)), 3)
+        for request_id in request_ids:
+            self.assertEqual(self.db.requests.get_info(request_id),
+                    {'environment': u'prod',
+                     'requested_device': u'any',
+                     'boot_config': u'{"a": "b"}',
+                     'assignee': u'me',
+                     'image': u'b2g',
+                     'expires': datetime.datetime(1978, 6, 15, 1, 0),
+                     'priority': u'high',
+                     'id': request_id,
+                     'assigned_device': ''})
+            self.assertEqual(self.db.requests.get_machine_state(request_id), 'new')
+
     def test_renew(self):
         now = lambda : datetime.datetime(1978, 6, 15)
         self.db.requests.renew(self.req_id, 36000, _now=now)
@@ -54,6 +76,27 @@ class Tests(DBMixin, ConfigMixin, TestCase):
         self.assertEqual(self.db.requests.list_expired(self.server_id, _now=now),
                          req_ids[:2])
 
+    def test_list_demand(self):
+        self.add_image('android', can_reuse=True)
+        self.add_request(image='android', boot_config='{"a": "b", "c": "d"}', no_assign=True)
+        self.add_request(image='android', boot_config='{"c":"d","a":"b"}', no_assign=True)
+        self.add_request(image='android', boot_config='{}', no_assign=True)
+        self.add_request(image='android', boot_config='{}', environment='prod', no_assign=True)
+        # b2g is not reusable, so does not appear
+        self.add_request(image='b2g', no_assign=True)
+        self.assertEqual(self.db.requests.list_demand(10), [
+            {'environment': None, 'image': 'android',
+             'boot_config': '{"c":"d","a":"b"}', 'count': 2},
+            {'environment': None, 'image': 'android', 'boot_config': '{}', 'count': 1},
+            {'environment': 'prod', 'image': 'android', 'boot_config': '{}', 'count': 1},
+        ])
+        # only the most recent requests are counted
+        self.assertEqual(self.db.requests.list_demand(3), [
+            {'environment': None, 'image': 'android', 'boot_config': '{"c":"d","a":"b"}', 'count': 1},
+            {'environment': None, 'image': 'android', 'boot_config': '{}', 'count': 1},
+            {'environment': 'prod', 'image': 'android', 'boot_config': '{}', 'count': 1},
+        ])
+
     def test_get_imaging_server(self):
         self.assertEqual(self.db.requests.get_imaging_server(self.req_id), 'my_fqdn')
 
@@ -71,6 +114,7 @@ class Tests(DBMixin, ConfigMixin, TestCase):
             u'expires': datetime.datetime(1978, 6, 15),
             u'id': self.req_id,
             u'imaging_server': u'my_fqdn',
+            u'priority': u'normal',
             u'requested_device': u'any',
             u'state': u'new'}
         self.add_device('dev1', state='sleeping')
@@ -85,6 +129,7 @@ class Tests(DBMixin, ConfigMixin, TestCase):
             u'expires': datetime.datetime(1978, 6, 2),
             u'id': closed_id,
             u'imaging_server': u'server',
+            u'priority': u'normal',
             u'requested_device': u'dev1',
             u'state': u'closed'}
         self.add_device('dev2', state='snoring')
@@ -99,6 +144,7 @@ class Tests(DBMixin, ConfigMixin, TestCase):
             u'expires': datetime.datetime(1978, 6, 3),
             u'id': assigned_id,
             u'imaging_server': u'server',
+            u'priority': u'normal',
             u'requested_device': u'dev2',
             u'state': u'assigned'}
         self.assertEqual(sorted(self.db.requests.list()),
@@ -125,6 +171,7 @@ class Tests(DBMixin, ConfigMixin, TestCase):
                  'assignee': u'slave',
                  'image': u'b2g',
                  'expires': datetime.datetime(1978, 6, 15),
+                 'priority': u'normal',
                  'id': self.req_id,
                  'assigned_device': ''})
 
@@ -139,6 +186,7 @@ class Tests(DBMixin, ConfigMixin, TestCase):
                  'assignee': u'slave',
                  'image': u'b2g',
                  'expires': datetime.datetime(1978, 6, 3),
+                 'priority': u'normal',
                  'id': assigned_id,
                  'assigned_device': 'dev2'})
 
@@ -162,6 +210,14 @@ class TestStateMachineMethods(DBMixin, TestCase):
     def test_get_machine_state(self):
         self.assertEqual(self.db.requests.get_machine_state(self.req_id), 'disarray')
 
+    def test_record_transition(self):
+        self.db.requests.record_transition(self.req_id, 'disarray', 'order')
+        tbl = model.state_transitions
+        res = self.db.execute(select([tbl.c.machine_type, tbl.c.machine_id,
+                tbl.c.from_state, tbl.c.to_state, tbl.c.hardware_type_id]))
+        self.assertEqual([tuple(row) for row in res.fetchall()],
+                [('request', self.req_id, 'disarray', 'order', None)])
+
 
 class TestObjectLogsMethods(DBMixin, TestCase):
 
@@ -0,0 +1,149 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import mock
+import datetime
+from sqlalchemy.sql import select
+from mozpool.db import model, state_transitions
+from mozpool.test.util import DBMixin, TestCase
+
+class Tests(DBMixin, TestCase):
+
+    def setUp(self):
+        super(Tests, self).setUp()
+        self.add_server('server1')
+        self.add_server('server2')
+        self.add_hardware_type('panda', 'ES Rev B2')
+        self.add_hardware_type('panda', 'ES Rev B3')
+        self.add_image('b2g')
+        self.add_image('android')
+        self.now = datetime.datetime.now() - datetime.timedelta(hours=1)
+
+    def get_transitions(self):
+        tbl = model.state_transitions
+        res = self.db.execute(select([tbl.c.machine_type, tbl.c.machine_id,
+            tbl.c.from_state, tbl.c.to_state, tbl.c.duration],
+            order_by=[tbl.c.id]))
+        return [tuple(row) for row in res.fetchall()]
+
+    def test_add(self):
+        def add(from_state, to_state, seconds):
+            self.db.state_transitions.add('device', 1, from_state, to_state, 1,
+                    _now=lambda: self.now + datetime.timedelta(seconds=seconds))
+        add('offline', 'pxe_power_cycling', 0)
+        add('pxe_power_cycling', 'pxe_booting', 10)
+        # a transition for another machine does not affect this one
+        self.db.state_transitions.add('request', 1, 'new', 'finding_device', 1,
+                _now=lambda: self.now + datetime.timedelta(seconds=15))
+        add('pxe_booting', 'mobileinit', 75.5)
+        # the previous transition did not enter this state, so the duration
+        # is unknown
+        add('b2g_downloading', 'failed_b2g_downloading', 90)
+        # a transition recorded by another process is not known to this one
+        other = state_transitions.Methods(self.db)
+        other.add('device', 1, 'failed_b2g_downloading', 'pxe_power_cycling', 1,
+                _now=lambda: self.now + datetime.timedelta(seconds=100))
+        add('pxe_power_cycling', 'pxe_booting', 110)
+        self.assertEqual(self.get_transitions(), [
+            ('device', 1, 'offline', 'pxe_power_cycling', None),
+            ('device', 1, 'pxe_power_cycling', 'pxe_booting', 10.0),
+            ('request', 1, 'new', 'finding_device', None),
+            ('device', 1, 'pxe_booting', 'mobileinit', 65.5),
+            ('device', 1, 'b2g_downloading', 'failed_b2g_downloading', None),
+            ('device', 1, 'failed_b2g_downloading', 'pxe_power_cycling', None),
+            ('device', 1, 'pxe_power_cycling', 'pxe_booting', None),
+        ])
+
+    def test_add_one_statement(self):
+        self.db.state_transitions.add('device', 1, 'offline', 'pxe_power_cycling', 1)
+        with self.assertQueryBudget(1):
+            self.db.state_transitions.add('device', 1, 'pxe_power_cycling',
+                                          'pxe_booting', 1)
+
+    def test_add_forgets_machines(self):
+        with mock.patch.object(state_transitions, 'REMEMBERED_MACHINES', 2):
+            for machine_id in 1, 2, 3:
+                self.db.state_transitions.add('device', machine_id, 'a', 'b', 1)
+            # only the last two machines are remembered
+            for machine_id in 3, 2, 1:
+                self.db.state_transitions.add('device', machine_id, 'b', 'c', 1)
+        self.assertEqual([ (machine_id, duration is not None)
+                           for _, machine_id, _, _, duration
+                           in self.get_transitions()[3:] ],
+                         [(3, True), (2, True), (1, False)])
+
+    def test_get_stats(self):
+        for duration in range(1, 101):
+            self.add_state_transition(1, 'pxe_booting', 'mobileinit', duration,
+                    self.now, imaging_server_id=1, hardware_type_id=1, image_id=1)
+        self.add_state_transition(2, 'pxe_booting', 'mobileinit', 500,
+                self.now, imaging_server_id=2, hardware_type_id=2, image_id=1)
+        self.add_state_transition(2, 'b2g_downloading', 'b2g_extracting', 30,
+                self.now, imaging_server_id=2, hardware_type_id=2, image_id=1)
+        # not counted: unknown duration, and another machine type
+        self.add_state_transition(3, 'pxe_booting', 'mobileinit', None,
+                self.now, imaging_server_id=1, hardware_type_id=1, image_id=1)
+        self.add_state_transition(1, 'pxe_booting', 'finding_device', 1000,
+                self.now, machine_type='request', image_id=1)
+        self.assertEqual(self.db.state_transitions.get_stats('device'), [
+            {'state': 'b2g_downloading', 'hardware_type': 'panda',
+             'hardware_model': 'ES Rev B3', 'image': 'b2g',
+             'imaging_server': 'server2',
+             'count': 1, 'p50': 30, 'p90': 30, 'p99': 30, 'max': 30},
+            {'state': 'pxe_booting', 'hardware_type': 'panda',
+             'hardware_model': 'ES Rev B2', 'image': 'b2g',
+             'imaging_server': 'server1',
+             'count': 100, 'p50': 50, 'p90': 90, 'p99': 99, 'max': 100},
+            {'state': 'pxe_booting', 'hardware_type': 'panda',
+             'hardware_model': 'ES Rev B3', 'image': 'b2g',
+             'imaging_server': 'server2',
+             'count': 1, 'p50': 500, 'p90': 500, 'p99': 500, 'max': 500},
+        ])
+
+    def test_get_stats_group_by(self):
+        self.add_state_transition(1, 'pxe_booting', 'mobileinit', 10,
+                self.now, imaging_server_id=1, hardware_type_id=1, image_id=1)
+        self.add_state_transition(2, 'pxe_booting', 'mobileinit', 20,
+                self.now, imaging_server_id=2, hardware_type_id=1, image_id=2)
+        self.add_state_transition(3, 'pxe_booting', 'mobileinit', 30,
+                self.now, imaging_server_id=2, hardware_type_id=2, image_id=2)
+        self.assertEqual(self.db.state_transitions.get_stats('device',
+                group_by=['hardware_type']), [
+            {'state': 'pxe_booting', 'hardware_type': 'panda',
+             'hardware_model': 'ES Rev B2',
+             'count': 2, 'p50': 10, 'p90': 20, 'p99': 20, 'max': 20},
+            {'state': 'pxe_booting', 'hardware_type': 'panda',
+             'hardware_model': 'ES Rev B3',
+             'count': 1, 'p50': 30, 'p90': 30, 'p99': 30, 'max': 30},
+        ])
+        self.assertEqual(self.db.state_transitions.get_stats('device',
+                group_by=[]), [
+            {'state': 'pxe_booting',
+             'count': 3, 'p50': 20, 'p90': 30, 'p99': 30, 'max': 30},
+        ])
+
+    def test_get_stats_bad_group_by(self):
+        self.assertRaises(ValueError, lambda:
+            self.db.state_transitions.get_stats('device', group_by=['color']))
+
+    def test_get_stats_filters(self):
+        now = datetime.datetime.now()
+        self.add_state_transition(1, 'pxe_booting', 'mobileinit', 10,
+                now - datetime.timedelta(hours=2))
+        self.add_state_transition(1, 'mobileinit', 'sut_verifying', 20, now)
+        self.add_state_transition(1, 'sut_verifying', 'ready', 30, now)
+        stats = self.db.state_transitions.get_stats('device',
+                timeperiod=datetime.timedelta(hours=1), group_by=[])
+        self.assertEqual([s['state'] for s in stats],
+                         ['mobileinit', 'sut_verifying'])
+        stats = self.db.state_transitions.get_stats('device',
+                states=['pxe_booting', 'sut_verifying'], group_by=[])
+        self.assertEqual([s['state'] for s in stats],
+                         ['pxe_booting', 'sut_verifying'])
+        # by default, only the last day is summarized
+        self.add_state_transition(1, 'ready', 'pc_power_cycling', 40,
+                now - datetime.timedelta(days=2))
+        stats = self.db.state_transitions.get_stats('device', group_by=[])
+        self.assertEqual([s['state'] for s in stats],
+                         ['mobileinit', 'pxe_booting', 'sut_verifying'])
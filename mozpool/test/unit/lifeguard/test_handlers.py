@@ -55,3 +55,23 @@ class Tests(AppMixin, DBMixin, ConfigMixin, TestCase):
         # note that the caching itself is tested elsewhere
         body = self.check_json_result(self.app.get('/api/device/dev1/state/?cache=1'))
         self.assertEqual(body, { 'state': 'offline' })
+
+    def test_wait_no_state(self):
+        body = self.check_json_result(self.app.get('/api/device/dev1/wait/'))
+        self.assertEqual(body, { 'state' : 'offline' })
+
+    def test_wait_timeout(self):
+        body = self.check_json_result(self.app.get(
+            '/api/device/dev1/wait/?state=offline&timeout=0.01'))
+        self.assertEqual(body, { 'state' : 'offline' })
+
+    def test_wait_bad_timeout(self):
+        r = self.app.get('/api/device/dev1/wait/?state=offline&timeout=abc',
+                         expect_errors=True)
+        self.assertEqual(r.status, 400)
+
+    def test_wait_invalid_timeout(self):
+        for timeout in 'nan', 'inf', '-1':
+            r = self.app.get('/api/device/dev1/wait/?state=offline&timeout=%s'
+                             % timeout, expect_errors=True)
+            self.assertEqual(r.status, 400)
@@ -2,13 +2,19 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import os
 import mock
 import re
+import json
+import base64
 import requests
 import hashlib
+import threading
+import BaseHTTPServer
+import SocketServer
 from mozpool.lifeguard import inventorysync
 from mozpool import config
-from mozpool.test.util import TestCase, PatchMixin, DBMixin, ConfigMixin, ScriptMixin
+from mozpool.test.util import TestCase, PatchMixin, DBMixin, ScriptMixin, DirMixin
 
 PRODUCTION = 1
 SPARE = 2
@@ -16,18 +22,13 @@ DECOMMISSIONED = 3
 
 PANDABOARD = 529
 
-class Tests(DBMixin, ConfigMixin, PatchMixin, ScriptMixin, TestCase):
+class Tests(DBMixin, DirMixin, PatchMixin, ScriptMixin, TestCase):
 
     auto_patch = [
-        ('requests_get', 'requests.get'),
+        ('requests_get', 'requests.Session.get'),
         ('dump_devices', 'mozpool.db.inventorysync.Methods.dump_devices'),
-        ('insert_device', 'mozpool.db.inventorysync.Methods.insert_device'),
-        ('update_device', 'mozpool.db.inventorysync.Methods.update_device'),
-        ('delete_device', 'mozpool.db.inventorysync.Methods.delete_device'),
         ('dump_relays', 'mozpool.db.inventorysync.Methods.dump_relays'),
-        ('insert_relay_board', 'mozpool.db.inventorysync.Methods.insert_relay_board'),
-        ('update_relay_board', 'mozpool.db.inventorysync.Methods.update_relay_board'),
-        ('delete_relay_board', 'mozpool.db.inventorysync.Methods.delete_relay_board'),
+        ('apply', 'mozpool.db.inventorysync.Methods.apply'),
     ]
 
     # test merge_devices
@@ -109,6 +110,49 @@ class Tests(DBMixin, ConfigMixin, PatchMixin, ScriptMixin, TestCase):
             ('update', 402, self.panda2_inv),
         ])
 
+    def test_merge_devices_iterator(self):
+        self.make_pandas()
+        self.panda2_inv['mac_address'] = '1a2b3c4d5e6f'
+        commands = list(inventorysync.merge_devices(
+            [self.panda1_db, self.panda2_db],
+            iter([self.panda2_inv, self.panda3_inv, self.panda3_inv])))
+        self.assertEqual(commands, [
+            ('update', 402, self.panda2_inv),
+            ('insert', self.panda3_inv),
+            ('delete', 401, self.panda1_db),
+        ])
+
+    # test merge_changed_devices
+
+    def test_merge_changed_devices(self):
+        self.make_pandas()
+        self.panda2_inv['mac_address'] = '1a2b3c4d5e6f'
+        commands = list(inventorysync.merge_changed_devices(
+            [self.panda1_db, self.panda2_db],
+            [(202, self.panda2_inv), (203, self.panda3_inv), (201, None),
+             (204, None), (203, None)]))
+        self.assertEqual(commands, [
+            ('update', 402, self.panda2_inv),
+            ('insert', self.panda3_inv),
+            ('delete', 401, self.panda1_db),
+        ])
+
+    def test_merge_changed_devices_no_change(self):
+        self.make_pandas()
+        commands = list(inventorysync.merge_changed_devices(
+            [self.panda1_db, self.panda2_db], [(201, self.panda1_inv)]))
+        self.assertEqual(commands, [])
+
+    def test_apply_device_tasks(self):
+        self.make_pandas()
+        devices = inventorysync.apply_device_tasks(
+            [self.panda1_db, self.panda2_db], [
+                ('delete', 401, self.panda1_db),
+                ('update', 402, self.panda3_inv),
+                ('insert', self.panda1_inv),
+            ])
+        self.assertEqual(devices, [self.panda3_inv, self.panda1_inv])
+
     # test merge_relay_boards
 
     def make_relay_boards(self):
@@ -193,7 +237,6 @@ class Tests(DBMixin, ConfigMixin, PatchMixin, ScriptMixin, TestCase):
     # test get_devices
 
     def set_inventory_response(self, hosts, status_code=200):
-        inventorysync._systemstatus_cache = {}
         system_status_re = re.compile('/systemstatus/([0-9]+)/')
         system_status = {
             PRODUCTION: {u'status': u'production', u'pk': PRODUCTION},
@@ -201,14 +244,13 @@ class Tests(DBMixin, ConfigMixin, PatchMixin, ScriptMixin, TestCase):
             DECOMMISSIONED: {u'status': u'decommissioned', u'pk': DECOMMISSIONED},
         }
 
-        inventorysync._servermodel_cache = {}
         server_model_re = re.compile('/servermodel/([0-9]+)/')
         server_model = {
             PANDABOARD: {u'vendor': u'PandaBoard', u'description': u'', u'part_number': u'',
                          u'pk': PANDABOARD, u'model': u'ES'},
         }
 
-        def get(url, auth):
+        def get(url, stream=False):
             resp_json = None
             mo = system_status_re.search(url)
             if mo:
@@ -223,6 +265,7 @@ class Tests(DBMixin, ConfigMixin, PatchMixin, ScriptMixin, TestCase):
             r = mock.Mock(spec=requests.Response)
             r.status_code = status_code
             r.json = lambda : resp_json
+            r.iter_content = lambda chunk_size : [json.dumps(resp_json)]
             return r
         self.requests_get.configure_mock(side_effect=get)
 
@@ -268,9 +311,9 @@ class Tests(DBMixin, ConfigMixin, PatchMixin, ScriptMixin, TestCase):
              'hardware_model': 'ES'},
         ]))
         self.assertEqual(self.requests_get.call_args_list, [
-            mock.call('https://inv/en-US/bulk_action/export/?q=filter', auth=('me', 'pass')),
-            mock.call('https://inv/en-US/core/api/v1_core/systemstatus/1/', auth=('me', 'pass')),
-            mock.call('https://inv/en-US/core/api/v1_core/servermodel/529/', auth=('me', 'pass')),
+            mock.call('https://inv/en-US/bulk_action/export/?q=filter', stream=True),
+            mock.call('https://inv/en-US/core/api/v1_core/systemstatus/1/'),
+            mock.call('https://inv/en-US/core/api/v1_core/servermodel/529/'),
         ])
 
     def test_re_filter(self):
@@ -287,9 +330,9 @@ class Tests(DBMixin, ConfigMixin, PatchMixin, ScriptMixin, TestCase):
              'hardware_model': 'ES'},
         ])
         self.assertEqual(self.requests_get.call_args_list, [
-            mock.call('https://inv/en-US/bulk_action/export/?q=filter', auth=('me', 'pass')),
-            mock.call('https://inv/en-US/core/api/v1_core/systemstatus/1/', auth=('me', 'pass')),
-            mock.call('https://inv/en-US/core/api/v1_core/servermodel/529/', auth=('me', 'pass')),
+            mock.call('https://inv/en-US/bulk_action/export/?q=filter', stream=True),
+            mock.call('https://inv/en-US/core/api/v1_core/systemstatus/1/'),
+            mock.call('https://inv/en-US/core/api/v1_core/servermodel/529/'),
         ])
 
     def test_loop_and_filtering(self):
@@ -320,9 +363,9 @@ class Tests(DBMixin, ConfigMixin, PatchMixin, ScriptMixin, TestCase):
             # panda-006 was skipped
         ]))
         self.assertEqual(self.requests_get.call_args_list, [
-            mock.call('https://inv/en-US/bulk_action/export/?q=filter', auth=('me', 'pass')),
-            mock.call('https://inv/en-US/core/api/v1_core/systemstatus/1/', auth=('me', 'pass')),
-            mock.call('https://inv/en-US/core/api/v1_core/servermodel/529/', auth=('me', 'pass'))
+            mock.call('https://inv/en-US/bulk_action/export/?q=filter', stream=True),
+            mock.call('https://inv/en-US/core/api/v1_core/systemstatus/1/'),
+            mock.call('https://inv/en-US/core/api/v1_core/servermodel/529/'),
         ])
 
     def test_get_devices_requests_error(self):
@@ -330,84 +373,206 @@ class Tests(DBMixin, ConfigMixin, PatchMixin, ScriptMixin, TestCase):
         self.assertRaises(RuntimeError, lambda :
             inventorysync.get_devices('https://inv', 'filter', 'me', 'pass', None))
 
+    def test_iter_systems_since(self):
+        old = self.make_host('panda-001')
+        old['updated_on'] = '2013-01-01T00:00:00'
+        new = self.make_host('panda-002', system_status=2)
+        new['updated_on'] = '2013-02-01T00:00:00'
+        self.set_inventory_response([old, new])
+        systems = list(inventorysync.iter_systems('https://inv', 'filter', 'me', 'pass',
+                                                  since='2013-01-15T00:00:00'))
+        self.assertEqual([ (o['hostname'], d['name']) for o, d in systems ],
+                         [('panda-002.vlan.dc.mozilla.com', 'panda-002')])
+        # only the changed system was looked up
+        self.assertEqual(self.requests_get.call_args_list, [
+            mock.call('https://inv/en-US/bulk_action/export/?q=filter', stream=True),
+            mock.call('https://inv/en-US/core/api/v1_core/systemstatus/2/'),
+            mock.call('https://inv/en-US/core/api/v1_core/servermodel/529/'),
+        ])
+
     # test sync
 
-    @mock.patch('mozpool.lifeguard.inventorysync.merge_relay_boards')
-    @mock.patch('mozpool.lifeguard.inventorysync.get_relay_boards')
-    @mock.patch('mozpool.lifeguard.inventorysync.get_devices')
-    @mock.patch('mozpool.lifeguard.inventorysync.merge_devices')
-    def test_sync(self, merge_devices, get_devices, get_relay_boards, merge_relay_boards):
+    def set_up_sync(self, iter_systems, merge_devices, merge_relay_boards):
         config.set('inventory', 'url', 'http://foo/')
         config.set('inventory', 'filter', 'hostname__startswith=panda-')
         config.set('inventory', 'username', 'u')
         config.set('inventory', 'password', 'p')
         self.dump_devices.return_value = 'dumped devices'
-        get_devices.return_value = 'gotten devices'
-        merge_devices.return_value = [
-            ('insert', dict(insert=1)),
-            ('delete', 10, dict(delete=2)),
-            ('update', 11, dict(update=3)),
-        ]
-        get_relay_boards.return_value = 'gotten relay_boards'
+        self.make_pandas()
+        iter_systems.return_value = iter([
+            (dict(pk=201, updated_on='2013-01-01T00:00:00'), self.panda1_inv),
+            (dict(pk=202, updated_on='2013-01-02T00:00:00'), self.panda2_inv),
+            (dict(pk=203, updated_on='2013-01-03T00:00:00'), None),
+        ])
+        self.merged = []
+        def merge(from_db, from_inv):
+            # the inventory is streamed into the merge
+            self.merged.extend(from_inv)
+            return [
+                ('update', 11, dict(update=3)),
+                ('insert', dict(insert=1)),
+                ('delete', 10, dict(delete=2)),
+            ]
+        merge_devices.side_effect = merge
         self.dump_relays.return_value = 'dumped relays'
         merge_relay_boards.return_value = [
             ('insert', dict(insert=1)),
             ('delete', 10, dict(delete=2)),
             ('update', 11, dict(update=3)),
         ]
-        inventorysync.sync(self.db)
+
+    def check_sync(self, merge_devices, merge_relay_boards):
         self.dump_devices.assert_called_with()
-        get_devices.assert_called_with('http://foo/', 'hostname__startswith=panda-', 'u', 'p', None,
-                verbose=False)
-        merge_devices.assert_called_with('dumped devices', 'gotten devices')
-        self.insert_device.assert_called_with(dict(insert=1))
-        self.delete_device.assert_called_with(10)
-        self.update_device.assert_called_with(11, dict(update=3))
-        get_relay_boards.assert_called_with(get_devices.return_value)
+        self.assertEqual(merge_devices.call_args[0][0], 'dumped devices')
+        self.assertEqual(self.merged, [self.panda1_inv, self.panda2_inv])
         self.dump_relays.assert_called_with()
-        merge_relay_boards.assert_called_with(self.dump_relays.return_value, get_relay_boards.return_value)
-        self.insert_relay_board.assert_called_with(dict(insert=1))
-        self.delete_relay_board.assert_called_with(10)
-        self.update_relay_board.assert_called_with(11, dict(update=3))
+        merge_relay_boards.assert_called_with(self.dump_relays.return_value, [
+            {'name': 'relay-1', 'fqdn': 'relay-1', 'imaging_server': 'mobile-services1'},
+            {'name': 'relay-2', 'fqdn': 'relay-2.fqdn', 'imaging_server': 'mobile-services2'},
+        ])
+        # all of the changes are applied together
+        self.apply.assert_called_once_with([
+                ('update', 11, dict(update=3)),
+                ('insert', dict(insert=1)),
+                ('delete', 10, dict(delete=2)),
+            ], [
+                ('insert', dict(insert=1)),
+                ('delete', 10, dict(delete=2)),
+                ('update', 11, dict(update=3)),
+            ])
 
     @mock.patch('mozpool.lifeguard.inventorysync.merge_relay_boards')
-    @mock.patch('mozpool.lifeguard.inventorysync.get_relay_boards')
-    @mock.patch('mozpool.lifeguard.inventorysync.get_devices')
+    @mock.patch('mozpool.lifeguard.inventorysync.iter_systems')
     @mock.patch('mozpool.lifeguard.inventorysync.merge_devices')
-    def test_sync_with_res(self, merge_devices, get_devices, get_relay_boards, merge_relay_boards):
-        config.set('inventory', 'url', 'http://foo/')
-        config.set('inventory', 'filter', 'hostname__startswith=panda-')
-        config.set('inventory', 'username', 'u')
-        config.set('inventory', 'password', 'p')
+    def test_sync(self, merge_devices, iter_systems, merge_relay_boards):
+        self.set_up_sync(iter_systems, merge_devices, merge_relay_boards)
+        inventorysync.sync(self.db)
+        iter_systems.assert_called_with('http://foo/', 'hostname__startswith=panda-', 'u', 'p', None,
+                verbose=False, cache_file=None, since=None)
+        self.check_sync(merge_devices, merge_relay_boards)
+
+    @mock.patch('mozpool.lifeguard.inventorysync.merge_relay_boards')
+    @mock.patch('mozpool.lifeguard.inventorysync.iter_systems')
+    @mock.patch('mozpool.lifeguard.inventorysync.merge_devices')
+    def test_sync_with_res(self, merge_devices, iter_systems, merge_relay_boards):
+        self.set_up_sync(iter_systems, merge_devices, merge_relay_boards)
         config.set('inventory', 'ignore_devices_on_servers_re', 're')
-        self.dump_devices.return_value = 'dumped devices'
-        get_devices.return_value = 'gotten devices'
-        merge_devices.return_value = [
-            ('insert', dict(insert=1)),
-            ('delete', 10, dict(delete=2)),
-            ('update', 11, dict(update=3)),
-        ]
-        get_relay_boards.return_value = 'gotten relay_boards'
-        self.dump_relays.return_value = 'dumped relays'
-        merge_relay_boards.return_value = [
-            ('insert', dict(insert=1)),
-            ('delete', 10, dict(delete=2)),
-            ('update', 11, dict(update=3)),
-        ]
         inventorysync.sync(self.db)
-        self.dump_devices.assert_called_with()
-        get_devices.assert_called_with('http://foo/', 'hostname__startswith=panda-', 'u', 'p', 're',
-                verbose=False)
-        merge_devices.assert_called_with('dumped devices', 'gotten devices')
-        self.insert_device.assert_called_with(dict(insert=1))
-        self.delete_device.assert_called_with(10)
-        self.update_device.assert_called_with(11, dict(update=3))
-        get_relay_boards.assert_called_with(get_devices.return_value)
-        self.dump_relays.assert_called_with()
-        merge_relay_boards.assert_called_with(self.dump_relays.return_value, get_relay_boards.return_value)
-        self.insert_relay_board.assert_called_with(dict(insert=1))
-        self.delete_relay_board.assert_called_with(10)
-        self.update_relay_board.assert_called_with(11, dict(update=3))
+        iter_systems.assert_called_with('http://foo/', 'hostname__startswith=panda-', 'u', 'p', 're',
+                verbose=False, cache_file=None, since=None)
+        self.check_sync(merge_devices, merge_relay_boards)
+
+    # test incremental sync
+
+    def set_up_incremental(self, last_full_sync,
+                           incremental_filter='changed-since-{since}'):
+        self.state_file = os.path.join(self.tempdir, 'state.json')
+        config.set('inventory', 'state_file', self.state_file)
+        if incremental_filter:
+            config.set('inventory', 'incremental_filter', incremental_filter)
+        with open(self.state_file, 'w') as f:
+            json.dump({'high_water_mark': '2013-01-01T00:00:00',
+                       'last_full_sync': last_full_sync}, f)
+
+    def read_state(self):
+        with open(self.state_file) as f:
+            return json.load(f)
+
+    @mock.patch('time.time')
+    @mock.patch('mozpool.lifeguard.inventorysync.merge_relay_boards')
+    @mock.patch('mozpool.lifeguard.inventorysync.iter_systems')
+    @mock.patch('mozpool.lifeguard.inventorysync.merge_devices')
+    def test_sync_incremental(self, merge_devices, iter_systems, merge_relay_boards, time):
+        time.return_value = 10000
+        self.set_up_sync(iter_systems, merge_devices, merge_relay_boards)
+        self.set_up_incremental(last_full_sync=5000)
+        self.panda2_inv['mac_address'] = '1a2b3c4d5e6f'
+        self.panda3_inv['imaging_server'] = 'mobile-services1'
+        self.dump_devices.return_value = [self.panda1_db, self.panda2_db]
+        iter_systems.return_value = iter([
+            (dict(pk=202, updated_on='2013-01-02T00:00:00'), self.panda2_inv),
+            (dict(pk=203, updated_on='2013-01-03T00:00:00'), self.panda3_inv),
+        ])
+        inventorysync.sync(self.db, incremental=True)
+        iter_systems.assert_called_with('http://foo/', 'changed-since-2013-01-01T00:00:00',
+                'u', 'p', None, verbose=False, cache_file=None, since='2013-01-01T00:00:00')
+        # only the changed devices are merged, but relay boards come from all devices
+        merge_devices.assert_not_called()
+        self.apply.assert_called_once_with([
+                ('update', 402, self.panda2_inv),
+                ('insert', self.panda3_inv),
+            ], merge_relay_boards.return_value)
+        self.assertEqual(sorted(r['fqdn'] for r in merge_relay_boards.call_args[0][1]),
+                         ['relay-1', 'relay-2.fqdn'])
+        self.assertEqual(self.read_state(),
+                {'high_water_mark': '2013-01-03T00:00:00', 'last_full_sync': 5000})
+
+    @mock.patch('time.time')
+    @mock.patch('mozpool.lifeguard.inventorysync.merge_relay_boards')
+    @mock.patch('mozpool.lifeguard.inventorysync.iter_systems')
+    @mock.patch('mozpool.lifeguard.inventorysync.merge_devices')
+    def test_sync_incremental_full(self, merge_devices, iter_systems, merge_relay_boards, time):
+        time.return_value = 100000
+        self.set_up_sync(iter_systems, merge_devices, merge_relay_boards)
+        self.set_up_incremental(last_full_sync=5000)
+        inventorysync.sync(self.db, incremental=True)
+        # the last full sync was too long ago, so this is a full sync
+        iter_systems.assert_called_with('http://foo/', 'hostname__startswith=panda-', 'u', 'p', None,
+                verbose=False, cache_file=None, since=None)
+        self.check_sync(merge_devices, merge_relay_boards)
+        self.assertEqual(self.read_state(),
+                {'high_water_mark': '2013-01-03T00:00:00', 'last_full_sync': 100000})
+
+    @mock.patch('mozpool.lifeguard.inventorysync.iter_systems')
+    def test_sync_incremental_no_filter(self, iter_systems):
+        self.set_up_incremental(last_full_sync=5000, incremental_filter=None)
+        self.assertRaises(RuntimeError, lambda :
+            inventorysync.sync(self.db, incremental=True))
+        iter_systems.assert_not_called()
+        self.apply.assert_not_called()
+
+    @mock.patch('time.time')
+    @mock.patch('mozpool.lifeguard.inventorysync.logger')
+    @mock.patch('mozpool.lifeguard.inventorysync.merge_relay_boards')
+    @mock.patch('mozpool.lifeguard.inventorysync.iter_systems')
+    @mock.patch('mozpool.lifeguard.inventorysync.merge_devices')
+    def test_sync_incremental_full_download(self, merge_devices, iter_systems,
+                                            merge_relay_boards, logger, time):
+        time.return_value = 10000
+        self.set_up_sync(iter_systems, merge_devices, merge_relay_boards)
+        self.set_up_incremental(last_full_sync=5000, incremental_filter=None)
+        config.set('inventory', 'incremental_full_download', 'true')
+        self.dump_devices.return_value = [self.panda1_db, self.panda2_db]
+        iter_systems.return_value = iter([])
+        inventorysync.sync(self.db, incremental=True)
+        # the whole export is downloaded, with a warning
+        iter_systems.assert_called_with('http://foo/', 'hostname__startswith=panda-',
+                'u', 'p', None, verbose=False, cache_file=None, since='2013-01-01T00:00:00')
+        self.assertTrue(logger.warning.called)
+
+    @mock.patch('time.time')
+    @mock.patch('mozpool.lifeguard.inventorysync.iter_systems')
+    def test_sync_incremental_failsafe(self, iter_systems, time):
+        time.return_value = 10000
+        config.set('inventory', 'filter', 'f')
+        self.set_up_incremental(last_full_sync=5000)
+        self.make_pandas()
+        self.panda3_inv['imaging_server'] = 'mobile-services1'
+        self.dump_devices.return_value = [self.panda1_db]
+        iter_systems.return_value = iter(
+            (dict(pk=300 + i, updated_on='2013-01-02T00:00:00'),
+             dict(self.panda3_inv, inventory_id=300 + i)) for i in range(6))
+        self.assertRaises(RuntimeError, lambda :
+            inventorysync.sync(self.db, incremental=True))
+        self.apply.assert_not_called()
+        # the high-water mark was not advanced
+        self.assertEqual(self.read_state()['high_water_mark'], '2013-01-01T00:00:00')
+        iter_systems.return_value = iter(
+            (dict(pk=300 + i, updated_on='2013-01-02T00:00:00'),
+             dict(self.panda3_inv, inventory_id=300 + i)) for i in range(6))
+        inventorysync.sync(self.db, incremental=True, ship_it=True)
+        self.assertEqual(len(self.apply.call_args[0][0]), 6)
+        self.assertEqual(self.read_state()['high_water_mark'], '2013-01-02T00:00:00')
 
     # test the script
 
@@ -415,4 +580,220 @@ class Tests(DBMixin, ConfigMixin, PatchMixin, ScriptMixin, TestCase):
     def test_script(self, sync):
         inventorysync.setup = lambda : self.db
         self.assertEqual(self.run_script(inventorysync.main, []), None)
-        sync.assert_called_with(self.db, ship_it=False, verbose=False)
+        sync.assert_called_with(self.db, ship_it=False, verbose=False, incremental=False)
+        self.assertEqual(self.run_script(inventorysync.main, ['--incremental']), None)
+        sync.assert_called_with(self.db, ship_it=False, verbose=False, incremental=True)
+
+    # test plans
+
+    def test_db_fingerprint(self):
+        self.make_pandas()
+        fp = inventorysync.db_fingerprint([self.panda1_db, self.panda2_db], [])
+        self.assertEqual(fp, inventorysync.db_fingerprint([self.panda2_db, self.panda1_db], []))
+        self.assertNotEqual(fp, inventorysync.db_fingerprint([self.panda1_db], [self.panda2_db]))
+        self.panda2_db['mac_address'] = '1a2b3c4d5e6f'
+        self.assertNotEqual(fp, inventorysync.db_fingerprint([self.panda1_db, self.panda2_db], []))
+
+    def test_check_plan(self):
+        plan = dict(devices=[('delete', 1, {})] * 6, db_count=40, inventory_count=0)
+        self.assertRaises(RuntimeError, lambda : inventorysync.check_plan(plan))
+        plan['db_count'] = 100
+        inventorysync.check_plan(plan)
+
+    @mock.patch('mozpool.lifeguard.inventorysync.merge_relay_boards')
+    @mock.patch('mozpool.lifeguard.inventorysync.iter_systems')
+    @mock.patch('mozpool.lifeguard.inventorysync.merge_devices')
+    def test_plan_and_apply(self, merge_devices, iter_systems, merge_relay_boards):
+        inventorysync.setup = lambda : self.db
+        self.set_up_sync(iter_systems, merge_devices, merge_relay_boards)
+        self.dump_devices.return_value = []
+        self.dump_relays.return_value = []
+        plan_file = os.path.join(self.tempdir, 'plan.json')
+
+        # too many changes for the failsafe, but --plan doesn't check
+        merge_devices.side_effect = lambda from_db, from_inv : [
+                ('delete', i, dict(name='dev%d' % i)) for i in range(10) ]
+        self.run_script(inventorysync.main, ['--plan', plan_file])
+        self.apply.assert_not_called()
+        plan = inventorysync.load_plan(plan_file)
+        self.assertEqual(plan['devices'][0], ('delete', 0, {'name': 'dev0'}))
+        self.assertEqual(plan['relay_boards'], merge_relay_boards.return_value)
+
+        # the plan is applied without consulting inventory
+        iter_systems.reset_mock()
+        self.run_script(inventorysync.main, ['--apply', plan_file])
+        iter_systems.assert_not_called()
+        self.apply.assert_called_once_with(plan['devices'], plan['relay_boards'])
+
+        # but not if the DB has changed
+        self.apply.reset_mock()
+        self.make_pandas()
+        self.dump_devices.return_value = [self.panda1_db]
+        self.assertRaises(RuntimeError, lambda :
+            self.run_script(inventorysync.main, ['--apply', plan_file]))
+        self.apply.assert_not_called()
+
+
+class FakeInventoryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        inventory = self.server
+        inventory.paths.append(self.path)
+        if self.headers.get('Authorization') != 'Basic ' + base64.b64encode('me:pass'):
+            return self.respond(401, {})
+        mo = re.match('/en-US/core/api/v1_core/(servermodel|systemstatus)/([0-9]+)/$', self.path)
+        if mo:
+            body = inventory.objects[mo.group(1)].get(int(mo.group(2)))
+        elif self.path.startswith('/en-US/bulk_action/export/'):
+            body = {'systems': inventory.systems}
+        else:
+            body = None
+        if body is None:
+            return self.respond(404, {})
+        self.respond(200, body)
+
+    def respond(self, status, body):
+        body = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeInventory(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A minimal inventory server, with many systems, models, and statuses"""
+
+    daemon_threads = True
+
+    def __init__(self, num_systems):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FakeInventoryHandler)
+        self.paths = []
+        self.objects = {
+            'servermodel': dict((pk, {'pk': pk, 'vendor': 'vendor%d' % pk, 'model': 'model%d' % pk})
+                                for pk in range(100, 120)),
+            'systemstatus': dict((pk, {'pk': pk, 'status': 'status%d' % pk})
+                                 for pk in range(1, 20)),
+        }
+        self.objects['systemstatus'][1]['status'] = 'decommissioned'
+        self.systems = {}
+        for i in range(num_systems):
+            hostname = 'panda-%04d.r1.example.com' % i
+            self.systems[hostname] = {
+                'pk': i,
+                'system_status': 1 + i % 19,
+                'server_model': 100 + i % 20,
+                'keyvalue_set': {
+                    'system.relay.0': {'value': 'relay-%d:bank1:relay1' % (i / 10)},
+                    'system.imaging_server.0': {'value': 'img%d' % (i / 100)},
+                },
+                'staticreg_set': {'nic0': {'hwadapter_set': {'hw0': {'mac': '00:00:00:00:%02x:%02x' % (i / 256, i % 256)}}}},
+            }
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.setDaemon(1)
+        self.thread.start()
+
+    def lookups(self):
+        return [ p for p in self.paths if 'v1_core' in p ]
+
+
+class FakeInventoryTests(DirMixin, TestCase):
+
+    def setUp(self):
+        super(FakeInventoryTests, self).setUp()
+        self.inventory = FakeInventory(2000)
+        self.cache_file = os.path.join(self.tempdir, 'inventory-cache.json')
+
+    def tearDown(self):
+        self.inventory.shutdown()
+        self.inventory.server_close()
+        super(FakeInventoryTests, self).tearDown()
+
+    def get_devices(self, **kwargs):
+        return inventorysync.get_devices(self.inventory.url, 'filter', 'me', 'pass',
+                                         None, **kwargs)
+
+    def test_get_devices(self):
+        hosts = self.get_devices()
+        # one in 19 systems is decommissioned
+        self.assertEqual(len(hosts), 2000 - len(range(0, 2000, 19)))
+        host = [ h for h in hosts if h['name'] == 'panda-0021' ][0]
+        self.assertEqual(host, {
+            'name': 'panda-0021', 'fqdn': 'panda-0021.r1.example.com',
+            'inventory_id': 21, 'mac_address': '000000000015',
+            'imaging_server': 'img0', 'relay_info': 'relay-2:bank1:relay1',
+            'hardware_type': 'vendor101', 'hardware_model': 'model101'})
+        # each model and status is only fetched once
+        self.assertEqual(len(self.inventory.lookups()), 20 + 19)
+
+    def test_cache_file(self):
+        self.get_devices(cache_file=self.cache_file)
+        self.assertEqual(len(self.inventory.lookups()), 39)
+        self.inventory.paths = []
+        self.get_devices(cache_file=self.cache_file)
+        self.assertEqual(self.inventory.paths, ['/en-US/bulk_action/export/?q=filter'])
+
+    def test_cache_ttl(self):
+        client = inventorysync.InventoryClient(self.inventory.url, 'me', 'pass',
+                                               cache_file=self.cache_file, cache_ttl=60)
+        self.assertEqual(client.get_systemstatus(2), 'status2')
+        client.save_cache()
+        client = inventorysync.InventoryClient(self.inventory.url, 'me', 'pass',
+                                               cache_file=self.cache_file, cache_ttl=60)
+        self.assertEqual(client.get_systemstatus(2), 'status2')
+        self.assertEqual(len(self.inventory.lookups()), 1)
+        with mock.patch('time.time') as time:
+            time.return_value = os.path.getmtime(self.cache_file) + 120
+            self.assertEqual(client.get_systemstatus(2), 'status2')
+        self.assertEqual(len(self.inventory.lookups()), 2)
+
+    def test_error(self):
+        client = inventorysync.InventoryClient(self.inventory.url, 'me', 'pass')
+        self.assertRaises(RuntimeError, lambda : client.prefetch('servermodel', [100, 999]))
+        client = inventorysync.InventoryClient(self.inventory.url, 'me', 'wrong')
+        self.assertRaises(RuntimeError, lambda : list(client.iter_export('filter')))
+
+
+class JSONStreamParserTests(TestCase):
+
+    doc = {'version': [1, {'a': 2}], 'systems': {
+        'host1': {'pk': 1, 'name': u'h\xf6st', 'list': [1, 2.5, None, True]},
+        'host2': {'pk': 22222, 'nested': {'systems': {}}},
+    }, 'count': 12345}
+
+    def parse(self, text, chunk_size):
+        chunks = [ text[i:i+chunk_size] for i in range(0, len(text), chunk_size) ]
+        parser = inventorysync.JSONStreamParser(chunks)
+        return list(parser.iter_member('systems'))
+
+    def test_chunk_sizes(self):
+        text = json.dumps(self.doc, indent=2)
+        for chunk_size in 1, 2, 7, 100, len(text):
+            self.assertEqual(sorted(self.parse(text, chunk_size)),
+                             sorted(self.doc['systems'].items()))
+
+    def test_lazy(self):
+        text = '{"systems": {"h1": {"pk": 1}, "h2": {"pk": 2}}}'
+        split = text.index('"h2"')
+        chunks = iter([text[:split], text[split:]])
+        parser = inventorysync.JSONStreamParser(chunks)
+        items = parser.iter_member('systems')
+        self.assertEqual(items.next(), (u'h1', {'pk': 1}))
+        # only the first chunk has been read
+        self.assertEqual(list(chunks), [text[split:]])
+
+    def test_empty(self):
+        self.assertEqual(self.parse('{"systems": {}}', 3), [])
+        self.assertEqual(self.parse('{}', 3), [])
+
+    def test_truncated(self):
+        text = json.dumps(self.doc)
+        self.assertRaises(ValueError, lambda : self.parse(text[:-20], 5))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, lambda : self.parse('{"systems": [1, 2]}', 5))
+        self.assertRaises(ValueError, lambda : self.parse('{"systems": {"a" 1}}', 5))
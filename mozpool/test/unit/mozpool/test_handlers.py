@@ -3,8 +3,11 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import mock
+import time
 import datetime
+import threading
 import mozpool.mozpool
+from mozpool.mozpool import requestmachine
 from mozpool import config
 from mozpool.test.util import TestCase, AppMixin, DBMixin, ConfigMixin
 
@@ -73,9 +76,21 @@ class Tests(AppMixin, DBMixin, ConfigMixin, TestCase):
                         #'expires': '2013-02-22T22:29:06.412207',
                         'id': 1,
                         'image': 'img2',
+                        'priority': 'normal',
                         'requested_device': 'dev1',
                         'url': 'http://server/api/request/1/'}})
 
+    def test_device_request_priority(self):
+        self.check_json_result(self.post_json('/api/device/any/request/',
+            {'assignee': 'me', 'duration': 10, 'image': 'img1', 'priority': 'high'}))
+        self.assertEqual(self.db.requests.get_info(1)['priority'], 'high')
+
+    def test_device_request_bad_priority(self):
+        r = self.post_json('/api/device/any/request/',
+            {'assignee': 'me', 'duration': 10, 'image': 'img1', 'priority': 'urgent'},
+            expect_errors=True)
+        self.assertEqual(r.status, 400)
+
     def test_device_request_conflict(self):
         "if the state machine closes the request right away, the API returns 409"
         def close_req(*args, **kwargs):
@@ -87,6 +102,107 @@ class Tests(AppMixin, DBMixin, ConfigMixin, TestCase):
             expect_errors=True)
         self.assertEqual(r.status, 409)
 
+    def test_request_bulk(self):
+        mozpool.mozpool.driver.allocate_requests.return_value = {1: 'dev1', 2: None}
+        body = self.check_json_result(self.post_json('/api/request/bulk/',
+            {'assignee': 'me', 'duration': 10, 'image': 'img2', 'environment': 'prod',
+             'aa': 'x', 'bb': 'y', 'count': 2}))
+        mozpool.mozpool.driver.allocate_requests.assert_called_with([1, 2])
+        self.assertEqual(body, {'requests': [
+            {'id': 1, 'url': 'http://server/api/request/1/', 'assigned_device': 'dev1'},
+            {'id': 2, 'url': 'http://server/api/request/2/', 'assigned_device': ''},
+        ]})
+        self.assertEqual(self.db.requests.get_info(2)['boot_config'],
+                         '{"aa": "x", "bb": "y"}')
+
+    def test_request_bulk_bad_count(self):
+        for count in 0, 101, 'x':
+            r = self.post_json('/api/request/bulk/',
+                {'assignee': 'me', 'duration': 10, 'image': 'img1', 'count': count},
+                expect_errors=True)
+            self.assertEqual(r.status, 400)
+
+    def test_request_queue(self):
+        queue = requestmachine.RequestQueue()
+        queue.add(1, ('prod', 'img1'), 'high')
+        mozpool.mozpool.driver.request_queue = queue
+        body = self.check_json_result(self.app.get('/api/request/queue/'))
+        body['queue'][0].pop('waiting') # value is time-dependent
+        self.assertEqual(body, {'queue': [
+            {'id': 1, 'environment': 'prod', 'image': 'img1', 'priority': 'high',
+             'position': 0}]})
+
+    def test_request_stats(self):
+        stats = requestmachine.AllocationStats()
+        mozpool.mozpool.driver.allocation_stats = stats
+        with mock.patch('time.time') as time:
+            time.return_value = 100
+            stats.start(1)
+            time.return_value = 104
+            stats.finish(1, 'high')
+        mozpool.mozpool.driver.prewarmer.get_stats.return_value = {
+            'hits': 1, 'misses': 2, 'warm_hits': 1, 'images_started': 3}
+        body = self.check_json_result(self.app.get('/api/request/stats/'))
+        self.assertEqual(body, {'allocation_times': {
+            'high': {'count': 1, 'mean': 4.0, 'max': 4.0}},
+            'prewarm': {'hits': 1, 'misses': 2, 'warm_hits': 1, 'images_started': 3}})
+
+    def test_device_state_durations(self):
+        now = datetime.datetime.now()
+        self.add_state_transition(self.dev_id, 'pxe_booting', 'mobileinit', 60, now,
+                hardware_type_id=1, image_id=1)
+        self.add_state_transition(self.dev_id, 'pxe_booting', 'mobileinit', 90, now,
+                hardware_type_id=1, image_id=2)
+        self.add_state_transition(self.dev_id, 'mobileinit', 'sut_verifying', 10,
+                now - datetime.timedelta(days=2))
+        body = self.check_json_result(self.app.get('/api/device/state-durations/'))
+        self.assertEqual(body, {'stats': [
+            {'state': 'pxe_booting', 'hardware_type': None, 'hardware_model': None,
+             'image': 'img1', 'imaging_server': 'server',
+             'count': 1, 'p50': 60, 'p90': 60, 'p99': 60, 'max': 60},
+            {'state': 'pxe_booting', 'hardware_type': None, 'hardware_model': None,
+             'image': 'img2', 'imaging_server': 'server',
+             'count': 1, 'p50': 90, 'p90': 90, 'p99': 90, 'max': 90}]})
+        body = self.check_json_result(self.app.get(
+            '/api/device/state-durations/?timeperiod=604800&group_by=&state=mobileinit'))
+        self.assertEqual(body, {'stats': [
+            {'state': 'mobileinit',
+             'count': 1, 'p50': 10, 'p90': 10, 'p99': 10, 'max': 10}]})
+
+    def test_device_state_durations_bad_args(self):
+        r = self.app.get('/api/device/state-durations/?group_by=color',
+                expect_errors=True)
+        self.assertEqual(r.status, 400)
+        r = self.app.get('/api/device/state-durations/?timeperiod=forever',
+                expect_errors=True)
+        self.assertEqual(r.status, 400)
+
+    def test_request_state_durations(self):
+        self.add_state_transition(1, 'finding_device', 'contact_lifeguard', 2,
+                datetime.datetime.now(), machine_type='request', image_id=1)
+        body = self.check_json_result(self.app.get(
+            '/api/request/state-durations/?group_by=image'))
+        self.assertEqual(body, {'stats': [
+            {'state': 'finding_device', 'image': 'img1',
+             'count': 1, 'p50': 2, 'p90': 2, 'p99': 2, 'max': 2}]})
+
+    def test_device_list_details_query_budget(self):
+        # the number of queries does not grow with the number of devices
+        for i in range(2, 12):
+            self.add_device('dev%d' % i)
+            self.add_request(device='dev%d' % i, image='img1')
+        with self.assertQueryBudget(1):
+            body = self.check_json_result(self.app.get('/api/device/list/?details=1'))
+        self.assertEqual(len(body['devices']), 11)
+
+    def test_request_list_query_budget(self):
+        for i in range(2, 12):
+            self.add_device('dev%d' % i)
+            self.add_request(device='dev%d' % i, image='img1')
+        with self.assertQueryBudget(2):
+            body = self.check_json_result(self.app.get('/api/request/list/'))
+        self.assertEqual(len(body['requests']), 10)
+
     def test_request_list(self):
         self.add_request(device='dev1', image='img1', server='server', no_assign=True)
         body = self.check_json_result(self.app.get('/api/request/list/'))
@@ -100,6 +216,7 @@ class Tests(AppMixin, DBMixin, ConfigMixin, TestCase):
              'environment': None,
              'assignee': 'slave',
              'state': 'new',
+             'priority': 'normal',
              'imaging_server': 'server',
              'id': 1},
         ]})
@@ -117,6 +234,7 @@ class Tests(AppMixin, DBMixin, ConfigMixin, TestCase):
             'environment': None,
             'assignee': 'slave',
             'boot_config': '{}',
+            'priority': 'normal',
             'id': req_id,
         })
 
@@ -138,6 +256,33 @@ class Tests(AppMixin, DBMixin, ConfigMixin, TestCase):
             {u'id': 2, u'message': u'goodbye', u'source': u'test', u'timestamp': u'1978-06-16T00:00:00'},
         ]})
 
+    def test_request_wait_changed(self):
+        req_id = self.add_request(image='img1', server='server', state='ready', no_assign=True)
+        body = self.check_json_result(self.app.get(
+            '/api/request/%s/wait/?state=pending&timeout=10' % req_id))
+        self.assertEqual(body, {'state': 'ready'})
+
+    def test_request_wait_timeout(self):
+        req_id = self.add_request(image='img1', server='server', state='pending', no_assign=True)
+        body = self.check_json_result(self.app.get(
+            '/api/request/%s/wait/?state=pending&timeout=0.01' % req_id))
+        self.assertEqual(body, {'state': 'pending'})
+
+    def test_request_wait_woken(self):
+        req_id = self.add_request(image='img1', server='server', state='pending', no_assign=True)
+        def change():
+            time.sleep(0.1)
+            self.db.requests.set_machine_state(req_id, 'ready', None)
+            requestmachine.RequestStateMachine.changeNotifier.notify(req_id)
+        thd = threading.Thread(target=change)
+        thd.start()
+        start = time.time()
+        body = self.check_json_result(self.app.get(
+            '/api/request/%s/wait/?state=pending&timeout=30' % req_id))
+        thd.join()
+        self.assertEqual(body, {'state': 'ready'})
+        self.assertTrue(time.time() - start < 5)
+
     def test_request_log(self):
         req_id = self.add_request(image='img1', server='server', state='thinking', no_assign=True)
         self.add_request_log(1, 'hello', 'test', datetime.datetime(1978, 6, 15))
@@ -0,0 +1,92 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import mock
+from mozpool.mozpool import placement
+from mozpool.test.util import DBMixin, TestCase
+
+class Tests(DBMixin, TestCase):
+
+    def setUp(self):
+        super(Tests, self).setUp()
+        self.add_server('server')
+        self.panda_id = self.add_hardware_type('panda', 'ES')
+        self.keon_id = self.add_hardware_type('phone', 'keon')
+        self.add_pxe_config('pxe1')
+        self.img_id = self.add_image('img', can_reuse=False)
+        self.reusable_id = self.add_image('reusable', can_reuse=True)
+        for image in 'img', 'reusable':
+            self.add_image_pxe_config(image, 'pxe1', 'panda', 'ES')
+        self.engine = placement.PlacementEngine(self.db)
+
+    def request(self, image='img', boot_config='{}'):
+        return {'image': image, 'boot_config': boot_config}
+
+    def choose(self, request, request_id=1):
+        return self.engine.choose(request_id, request,
+                                  self.db.availability.find())
+
+    def test_choose_empty(self):
+        self.assertEqual(self.engine.choose(1, self.request(), []), None)
+
+    def test_choose_taken(self):
+        # the device left the index after it was found
+        self.add_device('dev1', state='ready', hardware_type_id=self.panda_id)
+        found = self.db.availability.find()
+        self.db.availability.discard('dev1')
+        self.assertEqual(self.engine.choose(1, self.request(), found), None)
+
+    def test_prefers_reusable_image(self):
+        self.add_device('dev1', state='ready', hardware_type_id=self.panda_id)
+        self.add_device('dev2', state='ready', hardware_type_id=self.panda_id,
+                        image_id=self.reusable_id, boot_config='{"a": "b"}')
+        self.assertEqual(self.choose(self.request('reusable', '{"a":"b"}')), 'dev2')
+
+    def test_avoids_unimageable_hardware(self):
+        self.add_device('dev1', state='ready', hardware_type_id=self.keon_id)
+        self.add_device('dev2', state='ready', hardware_type_id=self.panda_id)
+        self.assertEqual(self.choose(self.request()), 'dev2')
+
+    def test_holds_back_reusable_devices(self):
+        self.add_device('dev1', state='ready', hardware_type_id=self.panda_id,
+                        image_id=self.reusable_id)
+        self.add_device('dev2', state='ready', hardware_type_id=self.panda_id,
+                        image_id=self.img_id)
+        self.assertEqual(self.choose(self.request()), 'dev2')
+
+    @mock.patch('time.time')
+    def test_learns_imaging_time(self, time):
+        time.return_value = 1000
+        self.add_device('dev1', state='ready', hardware_type_id=self.panda_id)
+        self.assertEqual(self.choose(self.request()), 'dev1')
+        self.engine.started(1, 'please_image')
+        time.return_value = 1100
+        self.engine.started(1, 'please_image') # retry doesn't reset
+        time.return_value = 1200
+        self.assertEqual(self.engine.finished(1), 200)
+        self.assertEqual(self.engine.estimate(self.panda_id, 'img', 'please_image'), 200)
+        self.assertEqual(self.engine.finished(1), None)
+
+        # subsequent observations are averaged in
+        self.choose(self.request(), request_id=2)
+        self.engine.started(2, 'please_image')
+        time.return_value = 1700
+        self.engine.finished(2)
+        self.assertEqual(self.engine.estimate(self.panda_id, 'img', 'please_image'),
+                         200 + 0.2 * (500 - 200))
+
+    def test_prefers_faster_hardware(self):
+        self.add_image_pxe_config('img', 'pxe1', 'phone', 'keon')
+        self.add_device('dev1', state='ready', hardware_type_id=self.panda_id)
+        self.add_device('dev2', state='ready', hardware_type_id=self.keon_id)
+        self.engine._estimates[(self.panda_id, 'img', 'please_image')] = 900
+        self.engine._estimates[(self.keon_id, 'img', 'please_image')] = 300
+        self.assertEqual(self.choose(self.request()), 'dev2')
+
+    def test_discard(self):
+        self.add_device('dev1', state='ready', hardware_type_id=self.panda_id)
+        self.choose(self.request())
+        self.engine.started(1, 'please_image')
+        self.engine.discard(1)
+        self.assertEqual(self.engine.finished(1), None)
@@ -0,0 +1,131 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import mock
+from mozpool import config
+from mozpool.mozpool import prewarm
+from mozpool.test.util import DBMixin, ConfigMixin, PatchMixin, TestCase
+
+class Tests(DBMixin, ConfigMixin, PatchMixin, TestCase):
+
+    auto_patch = [
+        ('requests_post', 'mozpool.async.AsyncRequests.post'),
+    ]
+
+    def setUp(self):
+        super(Tests, self).setUp()
+        config.set('server', 'fqdn', 'server')
+        self.add_server('server')
+        self.add_server('other')
+        self.add_hardware_type('panda', 'ES')
+        self.add_pxe_config('pxe1')
+        self.add_image('android', can_reuse=True)
+        self.add_image('b2g', can_reuse=False)
+        self.add_image('old', can_reuse=True)
+        for image in 'android', 'b2g', 'old':
+            self.add_image_pxe_config(image, 'pxe1', 'panda', 'ES')
+        self.prewarmer = prewarm.Prewarmer(self.db)
+
+    def add_demand(self, count, image='android', boot_config='{}', environment=None):
+        for _ in xrange(count):
+            self.add_request(image=image, boot_config=boot_config,
+                             environment=environment, state='closed')
+
+    def assert_imaging(self, device_name, image, boot_config='{}'):
+        self.requests_post.start.assert_called_with(mock.ANY,
+                'http://server/api/device/%s/event/please_image/' % device_name,
+                data=json.dumps({'image': image, 'boot_config': boot_config}))
+
+    def test_targets(self):
+        demand = [{'count': 6}, {'count': 3}, {'count': 1}]
+        self.assertEqual([ n for _, n in self.prewarmer.targets(demand, 3) ], [2, 1])
+        self.assertEqual([ n for _, n in self.prewarmer.targets(demand, 10) ], [6, 3, 1])
+        self.assertEqual(self.prewarmer.targets([], 3), [])
+
+    def test_warm(self):
+        self.add_demand(3)
+        self.add_device('dev1', state='ready')
+        self.assertEqual(self.db.availability.find(), ['dev1'])
+        self.assertEqual(self.prewarmer.warm(1), 'dev1')
+        self.assert_imaging('dev1', 'android')
+        self.assertEqual(self.db.availability.find(), [])
+        self.assertEqual(self.prewarmer.get_stats()['images_started'], 1)
+
+    def test_warm_counts_devices_being_imaged(self):
+        self.add_demand(3)
+        self.add_device('dev1', state='ready')
+        self.add_device('dev2', state='ready')
+        self.assertEqual(self.prewarmer.warm(1), 'dev1')
+        # dev1 has left the ready state for imaging
+        self.db.devices.set_machine_state('dev1', 'pxe_booting', None)
+        self.assertEqual(self.prewarmer.warm(1), None)
+
+    def test_warm_already_warm(self):
+        android_id = self.db.images.get('android')['id']
+        self.add_demand(3)
+        self.add_device('dev1', state='ready', image_id=android_id)
+        self.add_device('dev2', state='ready')
+        self.assertEqual(self.prewarmer.warm(1), None)
+        self.requests_post.start.assert_not_called()
+
+    def test_warm_shares_devices(self):
+        android_id = self.db.images.get('android')['id']
+        self.add_demand(2, image='old')
+        self.add_demand(3)
+        self.add_device('dev1', state='ready', image_id=android_id)
+        self.add_device('dev2', state='ready')
+        # android gets one device and has it; old gets the other
+        self.assertEqual(self.prewarmer.warm(2), 'dev2')
+        self.assert_imaging('dev2', 'old')
+
+    def test_warm_ignores_unreusable_and_remote(self):
+        self.add_demand(3, image='b2g')
+        self.add_device('dev1', state='ready')
+        self.assertEqual(self.prewarmer.warm(1), None)
+        self.add_demand(3)
+        self.add_device('dev2', server='other', state='ready')
+        self.db.devices.set_machine_state('dev1', 'busy', None)
+        self.assertEqual(self.prewarmer.warm(1), None)
+
+    def test_warm_environment(self):
+        self.add_demand(3, environment='prod')
+        self.add_device('dev1', state='ready', environment='staging')
+        self.assertEqual(self.prewarmer.warm(1), None)
+        self.add_device('dev2', state='ready', environment='prod')
+        self.assertEqual(self.prewarmer.warm(1), 'dev2')
+
+    def test_warm_incompatible_hardware(self):
+        self.add_demand(3)
+        other_hw = self.add_hardware_type('phone', 'keon')
+        self.add_device('dev1', state='ready', hardware_type_id=other_hw)
+        self.assertEqual(self.prewarmer.warm(1), None)
+
+    def test_poll(self):
+        self.add_demand(3)
+        self.add_device('dev1', state='ready')
+        self.add_device('dev2', state='ready')
+        with mock.patch.object(self.prewarmer, 'warm') as warm:
+            # disabled by default
+            self.prewarmer.poll(idle=True)
+            warm.assert_not_called()
+            config.set('prewarm', 'devices', '2')
+            self.prewarmer.poll(idle=False)
+            warm.assert_not_called()
+            self.prewarmer.poll(idle=True)
+            warm.assert_called_with(2)
+            warm.reset_mock()
+            # not again until the interval has passed
+            self.prewarmer.poll(idle=True)
+            warm.assert_not_called()
+
+    def test_record(self):
+        self.add_demand(3)
+        self.add_device('dev1', state='ready')
+        self.prewarmer.warm(1)
+        self.prewarmer.record('dev1', hit=True)
+        self.prewarmer.record('dev1', hit=True)
+        self.prewarmer.record('dev2', hit=False)
+        self.assertEqual(self.prewarmer.get_stats(),
+            {'hits': 2, 'misses': 1, 'warm_hits': 1, 'images_started': 1})
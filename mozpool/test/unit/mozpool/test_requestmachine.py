@@ -0,0 +1,93 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import mock
+from mozpool import config
+from mozpool.mozpool import requestmachine
+from mozpool.test.util import TestCase, ConfigMixin
+
+class RequestQueueTests(TestCase):
+
+    def setUp(self):
+        self.queue = requestmachine.RequestQueue()
+
+    def test_fifo(self):
+        self.queue.add(3, 'k')
+        self.queue.add(1, 'k')
+        self.queue.add(2, 'other')
+        self.assertEqual(self.queue.waiting('k'), [3, 1])
+        self.assertEqual(sorted(self.queue.keys()), ['k', 'other'])
+        self.assertEqual(self.queue.ahead_of(3, 'k'), 0)
+        self.assertEqual(self.queue.ahead_of(1, 'k'), 1)
+        self.assertEqual(self.queue.ahead_of(4, 'k'), 2)
+
+    def test_priority(self):
+        self.queue.add(1, 'k', 'low')
+        self.queue.add(2, 'k', 'normal')
+        self.queue.add(3, 'k', 'high')
+        self.queue.add(4, 'k', 'normal')
+        self.assertEqual(self.queue.waiting('k'), [3, 2, 4, 1])
+        self.assertEqual(self.queue.ahead_of(5, 'k', 'high'), 1)
+        self.assertEqual(self.queue.ahead_of(5, 'k', 'low'), 4)
+
+    def test_add_twice(self):
+        self.queue.add(1, 'k')
+        self.queue.add(2, 'k')
+        self.queue.add(1, 'k')
+        self.assertEqual(self.queue.waiting('k'), [1, 2])
+
+    @mock.patch('time.time')
+    def test_remove(self, time):
+        time.return_value = 100
+        self.queue.add(1, 'k')
+        time.return_value = 112
+        self.assertTrue(1 in self.queue)
+        self.assertEqual(self.queue.remove(1), 12)
+        self.assertFalse(1 in self.queue)
+        self.assertEqual(self.queue.keys(), [])
+        self.assertEqual(self.queue.remove(1), None)
+
+    @mock.patch('time.time')
+    def test_list(self, time):
+        time.return_value = 100
+        self.queue.add(1, ('prod', 'img1'))
+        time.return_value = 105
+        self.queue.add(2, ('prod', 'img1'))
+        self.assertEqual(self.queue.list(), [
+            {'id': 1, 'environment': 'prod', 'image': 'img1', 'priority': 'normal',
+             'position': 0, 'waiting': 5},
+            {'id': 2, 'environment': 'prod', 'image': 'img1', 'priority': 'normal',
+             'position': 1, 'waiting': 0},
+        ])
+
+
+class AllocationStatsTests(TestCase):
+
+    @mock.patch('time.time')
+    def test_stats(self, time):
+        stats = requestmachine.AllocationStats()
+        time.return_value = 100
+        stats.start(1)
+        stats.start(2)
+        stats.start(3)
+        time.return_value = 102
+        self.assertEqual(stats.finish(1, 'high'), 2)
+        time.return_value = 110
+        stats.start(2) # ignored; already started
+        self.assertEqual(stats.finish(2, 'normal'), 10)
+        stats.discard(3)
+        self.assertEqual(stats.finish(3, 'normal'), None)
+        self.assertEqual(stats.get(), {
+            'high': {'count': 1, 'mean': 2.0, 'max': 2.0},
+            'normal': {'count': 1, 'mean': 10.0, 'max': 10.0},
+        })
+
+
+class ReservedCapacityTests(ConfigMixin, TestCase):
+
+    def test_reserved_capacity(self):
+        config.set('reservations', 'prod', '3')
+        self.assertEqual(requestmachine.reserved_capacity('prod'), 3)
+        self.assertEqual(requestmachine.reserved_capacity('staging'), 0)
+        self.assertEqual(requestmachine.reserved_capacity(None), 0)
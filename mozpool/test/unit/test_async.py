@@ -6,6 +6,7 @@ from __future__ import absolute_import
 
 import time
 import mock
+import requests
 from mozpool import async
 from mozpool.test.util import TestCase
 
@@ -64,12 +65,149 @@ class Tests(TestCase):
 
 class RequestsTests(TestCase):
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.get')
     def test_get(self, get):
-        async.requests.get.run('foo')
-        get.assert_called_with('foo', timeout=30)
+        async.requests.get.run('http://foo/')
+        get.assert_called_with('http://foo/', timeout=30)
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
     def test_post(self, post):
-        async.requests.post.run('foo', 'DATA')
-        post.assert_called_with('foo', data='DATA', timeout=30)
+        async.requests.post.run('http://foo/', 'DATA')
+        post.assert_called_with('http://foo/', data='DATA', timeout=30)
+
+class HTTPClientTests(TestCase):
+
+    def setUp(self):
+        self.http = async.HTTPClient(retries=2, backoff=0.01)
+
+    def response(self, status_code):
+        r = mock.Mock()
+        r.status_code = status_code
+        return r
+
+    @mock.patch('requests.Session.get')
+    def test_sessions_per_destination(self, get):
+        get.return_value = self.response(200)
+        self.http.get('http://foo/a')
+        self.http.get('http://foo/b')
+        self.http.get('http://bar:8080/a')
+        self.assertIs(self.http._session('foo'), self.http._session('foo'))
+        self.assertIsNot(self.http._session('foo'), self.http._session('bar:8080'))
+        self.assertEqual(sorted(self.http._sessions), ['bar:8080', 'foo'])
+
+    def connect_failure(self):
+        reason = requests.packages.urllib3.exceptions.NewConnectionError(
+                None, 'connection refused')
+        return requests.exceptions.ConnectionError(
+                requests.packages.urllib3.exceptions.MaxRetryError(
+                    None, 'http://foo/', reason))
+
+    @mock.patch('time.sleep')
+    @mock.patch('requests.Session.post')
+    def test_retry(self, post, sleep):
+        post.side_effect = [self.connect_failure(),
+                            requests.exceptions.ConnectTimeout(),
+                            self.response(200)]
+        self.assertEqual(self.http.post('http://foo/', data='x').status_code, 200)
+        self.assertEqual(sleep.call_args_list, [mock.call(0.01), mock.call(0.02)])
+        stats = self.http.get_stats()['foo']
+        self.assertEqual((stats['requests'], stats['errors'], stats['retries']),
+                         (3, 2, 2))
+
+    @mock.patch('time.sleep')
+    @mock.patch('requests.Session.post')
+    def test_retries_exhausted(self, post, sleep):
+        post.side_effect = self.connect_failure()
+        self.assertRaises(requests.exceptions.ConnectionError, lambda :
+                self.http.post('http://foo/', data='x'))
+        self.assertEqual(post.call_count, 3)
+
+    @mock.patch('time.sleep')
+    @mock.patch('requests.Session.post')
+    def test_no_retry_on_timeout(self, post, sleep):
+        post.side_effect = requests.exceptions.Timeout()
+        self.assertRaises(requests.exceptions.Timeout, lambda :
+                self.http.post('http://foo/', data='x'))
+        self.assertEqual(post.call_count, 1)
+        self.assertEqual(self.http.get_stats()['foo']['errors'], 1)
+
+    @mock.patch('time.sleep')
+    @mock.patch('requests.Session.post')
+    def test_no_retry_after_send(self, post, sleep):
+        # the connection dropped after the request was sent
+        post.side_effect = requests.exceptions.ConnectionError(
+                'Connection aborted.')
+        self.assertRaises(requests.exceptions.ConnectionError, lambda :
+                self.http.post('http://foo/', data='x'))
+        self.assertEqual(post.call_count, 1)
+
+    @mock.patch('time.time')
+    @mock.patch('requests.Session.get')
+    def test_stats(self, get, time):
+        time.side_effect = [100, 101, 200, 204]
+        get.side_effect = [self.response(200), self.response(503)]
+        self.http.get('http://foo/')
+        self.http.get('http://foo/')
+        self.assertEqual(self.http.get_stats(), {'foo': {'requests': 2,
+            'errors': 1, 'retries': 0, 'mean_time': 2.5, 'max_time': 4.0}})
+
+class JobStoreTests(TestCase):
+
+    def setUp(self):
+        self.api = API()
+        self.jobs = async.JobStore(max_jobs=3, ttl=10)
+
+    def wait_for(self, job_id):
+        # busyloop until the job is no longer running or 1s elapses
+        start = time.time()
+        while self.jobs.get(job_id)['state'] == 'running' and time.time() - start < 1:
+            time.sleep(0.001)
+        return self.jobs.get(job_id)
+
+    def test_complete(self):
+        job_id = self.jobs.start('add', self.api.operation, 10, 20, factor=2)
+        self.assertEqual(self.wait_for(job_id),
+            {'id': job_id, 'operation': 'add', 'state': 'complete', 'result': 60})
+
+    def test_timeout(self):
+        job_id = self.jobs.start('add', self.api.operation, 10, 20, stall=True)
+        self.assertEqual(self.wait_for(job_id)['state'], 'timeout')
+
+    def test_missing(self):
+        self.assertEqual(self.jobs.get('abc'), None)
+
+    def test_bounded(self):
+        job_ids = []
+        for i in range(5):
+            job_ids.append(self.jobs.start('add', self.api.operation, i, 0))
+            self.wait_for(job_ids[-1])
+        self.assertEqual(self.jobs.get(job_ids[0]), None)
+        self.assertEqual(self.jobs.get(job_ids[1]), None)
+        self.assertEqual(self.jobs.get(job_ids[4])['result'], 4)
+
+    @mock.patch('time.time')
+    def test_full_of_running_jobs(self, time_time):
+        time_time.return_value = 1000
+        job_ids = [ self.jobs.start('op', mock.Mock(max_time=5)) for i in range(3) ]
+        self.assertRaises(async.JobStoreFull, lambda :
+                self.jobs.start('op', mock.Mock(max_time=5)))
+        # running jobs are never discarded
+        self.assertEqual([ self.jobs.get(id)['state'] for id in job_ids ],
+                         ['running'] * 3)
+        # once a job is past its deadline, it can be discarded
+        time_time.return_value = 1006
+        new_id = self.jobs.start('op', mock.Mock(max_time=5))
+        self.assertEqual(self.jobs.get(job_ids[0]), None)
+        self.assertEqual(self.jobs.get(new_id)['state'], 'running')
+
+    @mock.patch('time.time')
+    def test_expiry(self, time_time):
+        time_time.return_value = 1000
+        job_id = self.jobs.start('add', mock.Mock(max_time=5))
+        time_time.return_value = 1004
+        self.assertEqual(self.jobs.get(job_id)['state'], 'running')
+        time_time.return_value = 1006
+        self.assertEqual(self.jobs.get(job_id)['state'], 'timeout')
+        time_time.return_value = 1017
+        # the ttl has passed since the job timed out
+        self.assertEqual(self.jobs.get(job_id), None)
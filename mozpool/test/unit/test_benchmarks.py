@@ -0,0 +1,43 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import os
+import mock
+from mozpool.test import benchmarks
+from mozpool.test.util import DirMixin, TestCase
+
+class Tests(DirMixin, benchmarks.BenchmarkMixin, TestCase):
+
+    def setUp(self):
+        super(Tests, self).setUp()
+        patcher = mock.patch.dict(benchmarks.results, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_measure(self):
+        calls = []
+        result = self.measure('op', lambda: calls.append('fn'), number=3,
+                              repeat=2, setup=lambda: calls.append('setup'),
+                              size=10, kind='x')
+        self.assertEqual(calls, ['setup', 'fn', 'fn', 'fn'] * 2)
+        self.assertEqual(benchmarks.results, {'op(kind=x,size=10)': result})
+        self.assertEqual((result['number'], result['repeat']), (3, 2))
+        self.assertTrue(result['min'] <= result['median'] <= result['mean'] or
+                        result['min'] <= result['mean'] <= result['median'])
+
+    def test_write_load_results(self):
+        filename = os.path.join(self.tempdir, 'results.json')
+        results = {'op': {'min': 1.5}}
+        benchmarks.write_results(filename, results)
+        self.assertEqual(benchmarks.load_results(filename), results)
+
+    def test_compare(self):
+        baseline = {'a': {'min': 1.0}, 'b': {'min': 1.0}, 'c': {'min': 1.0}}
+        results = {'a': {'min': 1.2}, 'b': {'min': 1.5}, 'd': {'min': 1.0}}
+        self.assertEqual(benchmarks.compare(baseline, results, 0.25), [
+            ('a', 1.0, 1.2, 1.2, False),
+            ('b', 1.0, 1.5, 1.5, True),
+        ])
@@ -0,0 +1,65 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import time
+import datetime
+import threading
+import mock
+from mozpool import clock
+from mozpool.test.util import TestCase
+
+class Tests(TestCase):
+
+    def test_simulated_clock(self):
+        clk = clock.SimulatedClock(start=1000)
+        self.assertEqual(clk.time(), 1000)
+        clk.advance(10)
+        clk.sleep(5)
+        self.assertEqual(clk.time(), 1015)
+        clk.set(2000)
+        self.assertEqual(clk.now(), datetime.datetime.fromtimestamp(2000))
+        self.assertEqual(clk.utcnow(), datetime.datetime.utcfromtimestamp(2000))
+        self.assertRaises(ValueError, lambda: clk.set(1999))
+        self.assertRaises(ValueError, lambda: clk.advance(-1))
+
+    def test_simulated_wait(self):
+        clk = clock.SimulatedClock(start=0)
+        event = threading.Event()
+        self.assertFalse(clk.wait(event, 10))
+        self.assertEqual(clk.time(), 10)
+        event.set()
+        self.assertTrue(clk.wait(event, 10))
+        self.assertEqual(clk.time(), 10)
+
+    def test_concurrent_sleepers(self):
+        clk = clock.SimulatedClock(start=0)
+        threads = [ threading.Thread(target=clk.sleep, args=(seconds,))
+                    for seconds in (10, 5) ]
+        with clk.hold():
+            for thd in threads:
+                thd.start()
+            # wait (in real time) for both threads to start sleeping
+            for _ in range(1000):
+                if clk.pending() == [5, 10]:
+                    break
+                time.sleep(0.001)
+            self.assertEqual(clk.pending(), [5, 10])
+            self.assertEqual(clk.time(), 0)
+        for thd in threads:
+            thd.join(1)
+        # the clock moved to each deadline in turn, rather than by the sum of
+        # the sleeps
+        self.assertEqual(clk.time(), 10)
+        self.assertEqual(clk.pending(), [])
+
+    def test_current(self):
+        clk = clock.SimulatedClock(start=5000)
+        with mock.patch.object(clock, 'current', clk):
+            clock.sleep(100)
+            self.assertEqual(clock.time(), 5100)
+            self.assertEqual(clock.now(), datetime.datetime.fromtimestamp(5100))
+            self.assertEqual(clock.utcnow(), datetime.datetime.utcfromtimestamp(5100))
+        self.assertNotEqual(clock.time(), 5100)
@@ -0,0 +1,98 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import threading
+import mock
+from mozpool import config, eventbus
+from mozpool.test.util import ConfigMixin, PatchMixin, TestCase
+
+class Tests(ConfigMixin, PatchMixin, TestCase):
+
+    auto_patch = [
+        ('requests_post', 'mozpool.async.AsyncRequests.post'),
+    ]
+
+    def setUp(self):
+        super(Tests, self).setUp()
+        config.set('server', 'fqdn', 'server')
+        self.bus = eventbus.EventBus()
+        self.driver = mock.Mock()
+
+    def send_and_wait(self, *args):
+        done = threading.Event()
+        results = []
+        def callback(status_code):
+            results.append(status_code)
+            done.set()
+        self.bus.send(*(args + (callback,)))
+        done.wait(1)
+        return results
+
+    def test_remote(self):
+        self.bus.register('device', self.driver)
+        callback = mock.Mock()
+        self.bus.send('device', 'other', 'dev1', 'please_image', {'image': 'img1'},
+                      callback)
+        self.requests_post.start.assert_called_with(mock.ANY,
+                'http://other/api/device/dev1/event/please_image/',
+                data='{"image": "img1"}')
+        # the callback gets the status code
+        result = mock.Mock()
+        result.status_code = 404
+        self.requests_post.start.call_args[0][0](result)
+        callback.assert_called_with(404)
+        self.driver.handle_event.assert_not_called()
+
+    def test_local_unregistered(self):
+        # without a registered driver, even local events go over HTTP
+        self.bus.send('request', 'server', 10, 'lifeguard_finished', {}, mock.Mock())
+        self.requests_post.start.assert_called_with(mock.ANY,
+                'http://server/api/request/10/event/lifeguard_finished/',
+                data='{}')
+
+    def test_local(self):
+        self.bus.register('request', self.driver)
+        self.assertEqual(self.send_and_wait('request', 'server', 10,
+                'lifeguard_finished', {'imaging_result': 'complete'}), [200])
+        self.driver.handle_event.assert_called_with(10, 'lifeguard_finished',
+                {'imaging_result': 'complete'})
+        self.requests_post.start.assert_not_called()
+
+    def test_local_failure(self):
+        self.bus.register('device', self.driver)
+        self.driver.handle_event.side_effect = RuntimeError('oh noes')
+        self.assertEqual(self.send_and_wait('device', 'server', 'dev1',
+                'please_power_cycle', {}), [500])
+
+    def test_slow_handler(self):
+        # a slow handler for one machine does not delay events for another,
+        # but does delay later events for the same machine
+        self.bus.register('device', self.driver)
+        release = threading.Event()
+        delivered = []
+        def handle_event(name, event, body):
+            if event == 'slow':
+                release.wait(5)
+            delivered.append((name, event))
+        self.driver.handle_event.side_effect = handle_event
+        self.bus.send('device', 'server', 'dev1', 'slow', {}, mock.Mock())
+        dev1_done = threading.Event()
+        self.bus.send('device', 'server', 'dev1', 'fast', {},
+                      lambda status_code: dev1_done.set())
+        self.assertEqual(self.send_and_wait('device', 'server', 'dev2', 'fast', {}),
+                         [200])
+        self.assertEqual(delivered, [('dev2', 'fast')])
+        release.set()
+        dev1_done.wait(1)
+        self.assertEqual(delivered, [('dev2', 'fast'), ('dev1', 'slow'),
+                                     ('dev1', 'fast')])
+
+    def test_unregister(self):
+        self.bus.register('device', self.driver)
+        self.assertTrue(self.bus.is_local('device', 'server'))
+        self.assertFalse(self.bus.is_local('device', 'other'))
+        self.bus.unregister('device')
+        self.assertFalse(self.bus.is_local('device', 'server'))
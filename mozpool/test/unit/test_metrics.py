@@ -0,0 +1,63 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+from mozpool import metrics
+from mozpool.test.util import TestCase
+
+class Tests(TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_counter(self):
+        c = self.registry.register(metrics.Counter('c_total', 'A counter'))
+        c.inc()
+        c.inc(2)
+        self.assertEqual(c.value, 3)
+        self.assertEqual(self.registry.render(),
+            '# HELP c_total A counter\n'
+            '# TYPE c_total counter\n'
+            'c_total 3\n')
+
+    def test_labels(self):
+        c = self.registry.register(metrics.Counter('c_total', 'A counter',
+                                                   ('type', 'state')))
+        c.labels('device', 'ready').inc()
+        c.labels('device', 'ready').inc()
+        c.labels('request', 'say "hi"').inc()
+        self.assertRaises(ValueError, lambda: c.labels('device'))
+        self.assertEqual(self.registry.render().split('\n')[2:4], [
+            'c_total{type="device",state="ready"} 2',
+            'c_total{type="request",state="say \\"hi\\""} 1'])
+
+    def test_gauge(self):
+        g = self.registry.register(metrics.Gauge('g', 'A gauge', ('state',)))
+        g.labels('ready').set(5)
+        g.labels('ready').dec()
+        g.labels('failed').inc()
+        self.assertIn('g{state="ready"} 4\n', self.registry.render())
+        g.clear()
+        self.assertEqual(self.registry.render(),
+                         '# HELP g A gauge\n# TYPE g gauge\n')
+
+    def test_histogram(self):
+        h = self.registry.register(metrics.Histogram('h_seconds', 'A histogram',
+                                                     buckets=(1, 0.5)))
+        for value in 0.1, 0.5, 0.7, 3:
+            h.observe(value)
+        self.assertEqual(self.registry.render().split('\n')[2:], [
+            'h_seconds_bucket{le="0.5"} 2',
+            'h_seconds_bucket{le="1"} 3',
+            'h_seconds_bucket{le="+Inf"} 4',
+            'h_seconds_sum 4.3',
+            'h_seconds_count 4',
+            ''])
+
+    def test_register_existing(self):
+        c = self.registry.register(metrics.Counter('c_total', 'A counter'))
+        self.assertTrue(self.registry.register(metrics.Counter('c_total', 'A counter')) is c)
+        self.assertRaises(ValueError, lambda:
+                self.registry.register(metrics.Gauge('c_total', 'A gauge')))
@@ -0,0 +1,91 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import os
+import imp
+import time
+import mock
+import requests
+from mozpool.test.util import TestCase
+
+# the client is a separate distribution, not importable from the mozpool tree
+mozpoolclient = imp.load_source('mozpoolclient_under_test',
+        os.path.join(os.path.dirname(__file__), '..', '..', '..',
+                     'mozpoolclient', 'mozpoolclient', 'mozpoolclient.py'))
+
+class Tests(TestCase):
+
+    def setUp(self):
+        self.handler = mozpoolclient.MozpoolHandler('http://a/api',
+                                                    log_obj=mock.Mock())
+
+    def response(self, status_code, location=None):
+        r = mock.Mock()
+        r.status_code = status_code
+        r.headers = {'location': location} if location else {}
+        r.text = '{}'
+        return r
+
+    def urls(self, request):
+        return [ call[0][1] for call in request.call_args_list ]
+
+    @mock.patch('requests.Session.request')
+    def test_redirect_remembered(self, request):
+        request.side_effect = [
+            self.response(302, 'http://b/api/device/dev1/status/'),
+            self.response(200),
+            self.response(200),
+            self.response(200),
+        ]
+        self.handler.url_get('http://a/api/device/dev1/status/')
+        # later requests about the same device go directly to its server..
+        self.handler.url_get('http://a/api/device/dev1/log/')
+        # ..but not those about other devices
+        self.handler.url_get('http://a/api/device/dev2/status/')
+        self.assertEqual(self.urls(request), [
+            'http://a/api/device/dev1/status/',
+            'http://b/api/device/dev1/status/',
+            'http://b/api/device/dev1/log/',
+            'http://a/api/device/dev2/status/',
+        ])
+
+    @mock.patch('time.sleep')
+    @mock.patch('requests.Session.request')
+    def test_redirect_forgotten_on_error(self, request, sleep):
+        request.side_effect = [
+            self.response(302, 'http://b/api/device/dev1/status/'),
+            self.response(200),
+            requests.exceptions.ConnectionError(),
+            self.response(200),
+        ]
+        self.handler.url_get('http://a/api/device/dev1/status/')
+        self.handler.url_get('http://a/api/device/dev1/log/')
+        self.assertEqual(self.urls(request)[2:], [
+            'http://b/api/device/dev1/log/',
+            'http://a/api/device/dev1/log/',
+        ])
+        self.assertEqual(sleep.call_count, 1)
+
+    def test_concurrently_order(self):
+        def method(x):
+            if x == 1:
+                # finish after the failure for 2
+                time.sleep(0.05)
+            if x in (1, 2):
+                raise ValueError(x)
+            return x * 10
+        results = self.handler.concurrently(method, [ (x,) for x in range(4) ],
+                                            return_exceptions=True)
+        self.assertEqual(results[0::3], [0, 30])
+        self.assertEqual([ e.args for e in results[1:3] ], [(1,), (2,)])
+        # the first exception in argument order is raised, not the first to
+        # occur
+        try:
+            self.handler.concurrently(method, [ {'x': x} for x in range(4) ])
+        except ValueError as e:
+            self.assertEqual(e.args, (1,))
+        else:
+            self.fail('no exception raised')
@@ -26,6 +26,9 @@ class StateMachineSubclass(statemachine.StateMachine):
     def write_counters(self, counters):
         self._counters = counters.copy()
 
+    def write_transition(self, old_state, new_state):
+        self._transitions.append((old_state, new_state))
+
 
 @StateMachineSubclass.state_class
 class state1(statemachine.State):
@@ -44,6 +47,9 @@ class state1(statemachine.State):
     def on_goto2_class(self, args):
         self.machine.goto_state(state2)
 
+    def on_reenter(self, args):
+        self.machine.goto_state(state1)
+
     def on_inc(self, args):
         self.machine.increment_counter('x')
 
@@ -81,6 +87,7 @@ class Tests(TestCase):
     def setUp(self):
         self.db = mock.Mock(name='db')
         self.machine = StateMachineSubclass('test', 'machine', self.db)
+        self.machine._transitions = []
 
     def test_event(self):
         state1.called_on_poke = False
@@ -110,6 +117,29 @@ class Tests(TestCase):
         self.assertEqual(self.machine._state_name, 'state2')
         self.assertEqual(self.machine._state_timeout_dur, 20)
 
+    def test_state_transition_notifies(self):
+        with StateMachineSubclass.changeNotifier.watch('machine') as watch:
+            # other machine classes have their own notifier
+            with Namespace.StateMachineSubclass2.changeNotifier.watch('machine') as other:
+                self.machine.handle_event('goto2', {})
+                self.assertTrue(watch.changed)
+                self.assertFalse(other.changed)
+
+    def test_state_transition_recorded(self):
+        self.machine.handle_event('reenter', {})
+        self.assertEqual(self.machine._transitions, [])
+        self.machine.handle_event('goto2', {})
+        self.assertEqual(self.machine._transitions, [('state1', 'state2')])
+
+    def test_state_transition_record_fails(self):
+        # a failure to record the transition does not stop the transition
+        with mock.patch.object(self.machine, 'write_transition') as write_transition:
+            write_transition.side_effect = RuntimeError('database gone')
+            with mock.patch.object(state2, 'on_entry') as on_entry:
+                self.machine.handle_event('goto2', {})
+                on_entry.assert_called()
+        self.assertEqual(self.machine._state_name, 'state2')
+
     def test_increment_counter(self):
         self.machine.handle_event('inc', {})
         self.machine.handle_event('inc', {})
@@ -41,6 +41,51 @@ class Tests(TestCase):
         self.assertEqual(events,
             [ 'this locked', 'other started', 'unlocking this', 'other locked', 'other unlocked' ])
 
+    def test_ChangeNotifier_timeout(self):
+        cn = util.ChangeNotifier()
+        with cn.watch('one') as watch:
+            self.assertFalse(watch.wait(0.01))
+
+    def test_ChangeNotifier_already_changed(self):
+        cn = util.ChangeNotifier()
+        with cn.watch('one') as watch:
+            cn.notify('one')
+            # returns immediately, since the change happened before the wait
+            self.assertTrue(watch.wait(10))
+            watch.reset()
+            self.assertFalse(watch.wait(0.01))
+
+    def test_ChangeNotifier_other_thread(self):
+        cn = util.ChangeNotifier()
+        watch_two = cn.watch('two')
+        def other_thread():
+            cn.notify('two')
+            cn.notify('one')
+        with cn.watch('one') as watch:
+            thd = threading.Thread(target=other_thread)
+            thd.start()
+            self.assertTrue(watch.wait(10))
+            thd.join()
+        self.assertTrue(watch_two.changed)
+        watch_two.close()
+
+    def test_ChangeNotifier_forgets_names(self):
+        cn = util.ChangeNotifier()
+        cn.notify('unwatched')
+        with cn.watch('one') as watch1:
+            with cn.watch('one') as watch2:
+                cn.notify('one')
+            self.assertTrue(watch1.wait(10))
+            self.assertTrue(watch2.changed)
+        self.assertEqual(cn._watches, {})
+
+    def test_percentiles(self):
+        self.assertEqual(util.percentiles(range(1, 101)),
+            {'count': 100, 'p50': 50, 'p90': 90, 'p99': 99, 'max': 100})
+        self.assertEqual(util.percentiles([3]),
+            {'count': 1, 'p50': 3, 'p90': 3, 'p99': 3, 'max': 3})
+        self.assertEqual(util.percentiles([])['p50'], None)
+
         def test_from_json(self):
             self.assertEqual(util.from_json('{"a": "b"}'), {'a': 'b'})
             self.assertEqual(util.from_json('{"a"'), {})
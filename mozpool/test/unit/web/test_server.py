@@ -0,0 +1,57 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import sys
+import mock
+from mozpool import config
+from mozpool.web import server
+from mozpool.test.util import TestCase, ConfigMixin, PatchMixin
+
+class Tests(ConfigMixin, PatchMixin, TestCase):
+
+    auto_patch = [
+        ('WSGIServer', 'mozpool.web.server.WSGIServer'),
+    ]
+
+    def setUp(self):
+        super(Tests, self).setUp()
+        self.app = mock.Mock()
+        self.old_argv = sys.argv
+        sys.argv = ['mozpool-server']
+
+    def tearDown(self):
+        sys.argv = self.old_argv
+        super(Tests, self).tearDown()
+
+    def test_get_server_defaults(self):
+        server.get_server(self.app)
+        self.WSGIServer.assert_called_with(('0.0.0.0', 8080), mock.ANY,
+                numthreads=server.DEFAULT_THREADS, server_name='my_fqdn',
+                request_queue_size=server.DEFAULT_REQUEST_QUEUE_SIZE)
+
+    def test_get_server_config(self):
+        config.set('server', 'port', '8181')
+        config.set('server', 'threads', '5')
+        config.set('server', 'request_queue_size', '7')
+        server.get_server(self.app)
+        self.WSGIServer.assert_called_with(('0.0.0.0', 8181), mock.ANY,
+                numthreads=5, server_name='my_fqdn', request_queue_size=7)
+
+    def test_get_server_argv(self):
+        sys.argv = ['mozpool-server', '127.0.0.1:9000']
+        server.get_server(self.app)
+        self.WSGIServer.assert_called_with(('127.0.0.1', 9000), mock.ANY,
+                numthreads=mock.ANY, server_name=mock.ANY,
+                request_queue_size=mock.ANY)
+
+    def test_run_server_threaded(self):
+        server.run_server(self.app)
+        self.WSGIServer.return_value.start.assert_called_with()
+        self.assertFalse(self.app.run.called)
+
+    def test_run_server_simple(self):
+        config.set('server', 'mode', 'simple')
+        server.run_server(self.app)
+        self.app.run.assert_called_with()
+        self.assertFalse(self.WSGIServer.called)
@@ -15,6 +15,7 @@ import os
 import sys
 import mock
 import cStringIO
+import contextlib
 from paste.fixture import TestApp
 from sqlalchemy.sql import and_, select
 from mozpool import config, db
@@ -185,7 +186,8 @@ class DBMixin(DirMixin):
                     hardware_type_id=hardware_type_id)
 
     def add_request(self, server='server', assignee="slave", state="new", expires=None,
-                    device='any', image='b2g', boot_config='{}', no_assign=False):
+                    device='any', image='b2g', boot_config='{}', no_assign=False,
+                    environment=None, priority='normal'):
         if not expires:
             expires = datetime.datetime.now() + datetime.timedelta(hours=1)
         image_id = self.db.execute(select([model.images.c.id],
@@ -203,6 +205,8 @@ class DBMixin(DirMixin):
                         expires=expires,
                         image_id=image_id,
                         boot_config=boot_config,
+                        environment=environment,
+                        priority=priority,
                         state=state,
                         state_counters='{}')
         request_id = res.lastrowid
@@ -232,6 +236,20 @@ class DBMixin(DirMixin):
                 source=source,
                 ts=ts)
 
+    def add_state_transition(self, id, from_state, to_state, duration, ts,
+                machine_type='device', imaging_server_id=1,
+                hardware_type_id=None, image_id=None):
+        self.db.execute(model.state_transitions.insert(),
+                machine_type=machine_type,
+                machine_id=id,
+                from_state=from_state,
+                to_state=to_state,
+                duration=duration,
+                ts=ts,
+                imaging_server_id=imaging_server_id,
+                hardware_type_id=hardware_type_id,
+                image_id=image_id)
+
     def add_relay_board(self, relay_board, server="server", dn='.example.com',
                 state="offline", state_timeout=None, state_counters='{}'):
         id = self.db.execute(select([model.imaging_servers.c.id],
@@ -247,6 +265,21 @@ class DBMixin(DirMixin):
                     imaging_server_id=id)
         return res.lastrowid
 
+    # assertions
+
+    @contextlib.contextmanager
+    def assertQueryBudget(self, max_queries):
+        """
+        Context manager asserting that no more than MAX_QUERIES SQL statements
+        are executed by this thread within the context.  Use this to catch
+        accidental per-row queries in state transitions and API requests.
+        """
+        with self.db.pool.count_queries() as stats:
+            yield stats
+        if stats.count > max_queries:
+            self.fail("%d queries exceeds the budget of %d\n%s"
+                      % (stats.count, max_queries, stats.format()))
+
 
 class ScriptMixin(object):
     """
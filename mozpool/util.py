@@ -3,6 +3,7 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import json
+import time
 import threading
 from itertools import izip_longest
 
@@ -26,6 +27,85 @@ class LocksByName(object):
             lock = self._locks_by_name[name]
         lock.release()
 
+class ChangeNotifier(object):
+    """
+    Allows threads to wait for a change to a named object, and other threads to
+    announce such changes.  A waiter starts watching the name with `watch`
+    before reading the object, so that changes between reading the object and
+    waiting are not lost.  Only names that are being watched are tracked, so
+    the notifier does not grow with the number of names ever notified.
+    """
+
+    def __init__(self):
+        self._watches = {}
+        self._cond = threading.Condition()
+
+    def watch(self, name):
+        """
+        Start watching the given name, returning a ChangeWatch.  Use it as a
+        context manager, or call its `close` method when done.
+        """
+        return ChangeWatch(self, name)
+
+    def notify(self, name):
+        "Announce a change to the given name, waking any waiting threads"
+        with self._cond:
+            watches = self._watches.get(name)
+            if watches:
+                for watch in watches:
+                    watch.changed = True
+                self._cond.notifyAll()
+
+class ChangeWatch(object):
+    """
+    A single waiter's interest in changes to a name; see ChangeNotifier.
+    `changed` is true if the name has changed since the watch began or was
+    last reset.
+    """
+
+    def __init__(self, notifier, name):
+        self._notifier = notifier
+        self.name = name
+        self.changed = False
+        with notifier._cond:
+            notifier._watches.setdefault(name, set()).add(self)
+
+    def reset(self):
+        "Forget any changes seen so far"
+        with self._notifier._cond:
+            self.changed = False
+
+    def wait(self, timeout):
+        """
+        Wait until the name has changed since the watch began or was last
+        reset, or until TIMEOUT seconds have elapsed.  Returns true if it has
+        changed.
+        """
+        end = time.time() + timeout
+        with self._notifier._cond:
+            while not self.changed:
+                remaining = end - time.time()
+                if remaining <= 0:
+                    break
+                self._notifier._cond.wait(remaining)
+            return self.changed
+
+    def close(self):
+        "Stop watching"
+        notifier = self._notifier
+        with notifier._cond:
+            watches = notifier._watches.get(self.name)
+            if watches is not None:
+                watches.discard(self)
+                if not watches:
+                    del notifier._watches[self.name]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
 def from_json(s):
     """
     Converts JSON string 's' to an object but also handles empty/bad values.
@@ -43,3 +123,14 @@ def mac_with_dashes(mac):
     # From the itertools docs.
     return "-".join("%s%s" % i for i in izip_longest(fillvalue=None, *[iter(mac)]*2))
 
+def percentiles(values):
+    """
+    Summarize a list of numbers with its count, 50th, 90th, and 99th
+    percentiles (by nearest rank), and maximum.
+    """
+    values = sorted(values)
+    summary = {'count': len(values)}
+    for name, p in ('p50', 50), ('p90', 90), ('p99', 99):
+        summary[name] = values[max(0, -(-len(values) * p // 100) - 1)] if values else None
+    summary['max'] = values[-1] if values else None
+    return summary
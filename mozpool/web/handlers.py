@@ -5,21 +5,44 @@
 """Utilities common to all handlers."""
 
 import json
+import math
 import time
+import logging
 import threading
 import datetime
 import web.webapi
 import templeton
 import mozpool
-from mozpool import config
+import mozpool.lifeguard
+import mozpool.mozpool
+from mozpool import config, async, metrics
 from mozpool.db import exceptions
 
 nocontent = NoContent = web.webapi._status_code("204 No Content")
 
+logger = logging.getLogger('web.handlers')
+
 urls = (
   "/version/?", "mozpool_version",
+  "/health/?", "mozpool_health",
+  "/peers/?", "peer_stats",
+  "/job/([^/]+)/?", "job_status",
+  "/metrics/?", "metrics_export",
 )
 
+http_requests = metrics.counter('mozpool_http_requests_total',
+        'HTTP requests handled, by method and response status', ('method', 'status'))
+http_request_seconds = metrics.histogram('mozpool_http_request_seconds',
+        'Time taken to handle HTTP requests', ('method',))
+
+# these are updated from the database each time the metrics are exported
+machines = metrics.gauge('mozpool_machines',
+        'Devices and requests managed by this server, by state',
+        ('machine_type', 'state'))
+request_queue_length = metrics.gauge('mozpool_request_queue_length',
+        'Requests waiting for a device, by environment and image',
+        ('environment', 'image'))
+
 class DateTimeJSONEncoder(json.JSONEncoder):
     """Encodes datetime objects as ISO strings."""
     def default(self, o):
@@ -39,7 +62,7 @@ def deviceredirect(function):
         except exceptions.NotFound:
             raise web.notfound()
         if server != config.get('server', 'fqdn'):
-            raise web.found("http://%s%s" % (server, web.ctx.path))
+            raise web.found("http://%s%s" % (server, web.ctx.fullpath))
         # send an appropriate access-control header, if necessary
         origin = web.ctx.environ.get('HTTP_ORIGIN')
         if origin and origin.startswith('http://'):
@@ -63,7 +86,7 @@ def requestredirect(function):
         except exceptions.NotFound:
             raise web.notfound()
         if server != config.get('server', 'fqdn'):
-            raise web.found("http://%s%s" % (server, web.ctx.path))
+            raise web.found("http://%s%s" % (server, web.ctx.fullpath))
         return function(self, id, *args)
     return wrapped
 
@@ -78,10 +101,28 @@ def relayredirect(function):
         except exceptions.NotFound:
             raise web.notfound()
         if server != config.get('server', 'fqdn'):
-            raise web.found("http://%s%s" % (server, web.ctx.path))
+            raise web.found("http://%s%s" % (server, web.ctx.fullpath))
         return function(self, id, *args)
     return wrapped
 
+def record_request(handler):
+    """
+    web.py processor to record each request in the HTTP metrics.
+    """
+    started = time.time()
+    status = None
+    try:
+        return handler()
+    except web.HTTPError:
+        raise
+    except Exception:
+        status = '500'
+        raise
+    finally:
+        status = status or web.ctx.status.split(None, 1)[0]
+        http_requests.labels(web.ctx.method, status).inc()
+        http_request_seconds.labels(web.ctx.method).observe(time.time() - started)
+
 class Handler(object):
     """
     Parent class for all handler classes in Mozpool.  This makes 'self.db'
@@ -125,6 +166,60 @@ class InMemCacheMixin(object):
             return cls.cache_data
 
 
+class StateWaitMixin(object):
+    """
+    Mixin for handler classes that allow clients to block until a state
+    machine leaves a known state, rather than polling for its status.
+
+    Set `machine_cls` to the StateMachine subclass whose transitions should
+    wake waiters, and implement `read_state`.  This class provides
+    `wait_for_state_change`.
+
+    Transitions made in this process wake waiters immediately.  Transitions
+    made by other servers are detected by re-reading the state from the DB
+    every DB_POLL_INTERVAL seconds.
+    """
+
+    machine_cls = None
+    DEFAULT_WAIT = 30
+    MAX_WAIT = 120
+    DB_POLL_INTERVAL = 5
+
+    def read_state(self, machine_name):
+        raise NotImplementedError
+
+    def wait_for_state_change(self, machine_name):
+        """
+        Wait until the machine's state differs from the `state` query
+        parameter, or for `timeout` seconds, and return a dictionary with
+        the current state.  If no `state` is given, this returns immediately.
+        """
+        args, _ = templeton.handlers.get_request_parms()
+        known_state = args.get('state', [None])[0]
+        try:
+            timeout = float(args.get('timeout', [self.DEFAULT_WAIT])[0])
+        except ValueError:
+            raise web.badrequest()
+        # float() accepts 'nan' and 'inf'
+        if math.isnan(timeout) or math.isinf(timeout) or timeout < 0:
+            raise web.badrequest()
+        timeout = min(timeout, self.MAX_WAIT)
+
+        end = time.time() + timeout
+        with self.machine_cls.changeNotifier.watch(machine_name) as watch:
+            while True:
+                watch.reset()
+                try:
+                    state = self.read_state(machine_name)
+                except exceptions.NotFound:
+                    raise web.notfound()
+                remaining = end - time.time()
+                if state != known_state or remaining <= 0:
+                    break
+                watch.wait(min(remaining, self.DB_POLL_INTERVAL))
+        return {'state': state}
+
+
 class ConflictJSON(web.HTTPError):
     """`409 Conflict` error with JSON body."""
     def __init__(self, o):
@@ -135,8 +230,94 @@ class ConflictJSON(web.HTTPError):
         web.HTTPError.__init__(self, status, headers, body)
 
 
+class ServiceUnavailableJSON(web.HTTPError):
+    """`503 Service Unavailable` error with JSON body."""
+    def __init__(self, o):
+        status = "503 Service Unavailable"
+        body = json.dumps(o, cls=DateTimeJSONEncoder)
+        headers = {'Content-Length': len(body),
+                   'Content-Type': 'application/json; charset=utf-8'}
+        web.HTTPError.__init__(self, status, headers, body)
+
+
 class mozpool_version(Handler):
     """Get the mozpool version"""
     @templeton.handlers.json_response
     def GET(self):
         return dict(version=mozpool.version)
+
+class mozpool_health(Handler):
+    """
+    Check the health of this server: that the database is reachable and that
+    the state-machine drivers are running.  Returns 503 if anything is wrong,
+    for the benefit of load balancers and monitoring.
+    """
+    @templeton.handlers.json_response
+    def GET(self):
+        healthy = True
+        try:
+            self.db.execute("SELECT 1")
+            db_status = 'ok'
+        except Exception:
+            # the details may include connection information, so they are
+            # only logged
+            logger.exception("health check could not reach the database")
+            db_status = 'database unavailable'
+            healthy = False
+
+        drivers = {}
+        for name, driver in [('lifeguard', getattr(mozpool.lifeguard, 'driver', None)),
+                             ('mozpool', getattr(mozpool.mozpool, 'driver', None))]:
+            if driver is None:
+                continue
+            drivers[name] = 'ok' if driver.isAlive() else 'stopped'
+            if drivers[name] != 'ok':
+                healthy = False
+
+        rv = dict(status='ok' if healthy else 'failed',
+                  version=mozpool.version, db=db_status, drivers=drivers)
+        if not healthy:
+            raise ServiceUnavailableJSON(rv)
+        return rv
+
+class peer_stats(Handler):
+    """Get statistics for HTTP requests made from this server to others"""
+    @templeton.handlers.json_response
+    def GET(self):
+        return {'peers': async.http.get_stats()}
+
+class metrics_export(Handler):
+    """
+    Get this server's metrics, in the Prometheus text exposition format.
+    """
+    def GET(self):
+        try:
+            server_id = self.db.imaging_servers.get_id(config.get('server', 'fqdn'))
+        except exceptions.NotFound:
+            server_id = None
+        machines.clear()
+        if server_id is not None:
+            for machine_type, methods in [('device', self.db.devices),
+                                          ('request', self.db.requests)]:
+                for state, count in methods.count_by_state(server_id).iteritems():
+                    machines.labels(machine_type, state).set(count)
+
+        request_queue_length.clear()
+        driver = getattr(mozpool.mozpool, 'driver', None)
+        if driver is not None:
+            queue = driver.request_queue
+            for environment, image in queue.keys():
+                request_queue_length.labels(environment, image).set(
+                        len(queue.waiting((environment, image))))
+
+        web.header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        return metrics.registry.render().encode('utf-8')
+
+class job_status(Handler):
+    """Get the status of a job started by an asynchronous API call"""
+    @templeton.handlers.json_response
+    def GET(self, job_id):
+        job = async.jobs.get(job_id)
+        if not job:
+            raise web.notfound()
+        return job
@@ -15,11 +15,20 @@ from mozpool.web import handlers as web_handlers
 from mozpool.lifeguard import devicemachine, handlers as lifeguard_handlers
 from mozpool.bmm import handlers as bmm_handlers
 from mozpool.mozpool import requestmachine, handlers as mozpool_handlers
-from mozpool import config
+from mozpool import config, eventbus
 from mozpool.db import setup as db_setup
 
+try:
+    from cheroot.wsgi import Server as WSGIServer
+except ImportError:
+    from web.wsgiserver import CherryPyWSGIServer as WSGIServer
+
 templeton.middleware.patch_middleware()
 
+DEFAULT_PORT = 8080
+DEFAULT_THREADS = 30
+DEFAULT_REQUEST_QUEUE_SIZE = 50
+
 def get_app(db):
     # set some global config
     web.config.debug = False
@@ -33,7 +42,47 @@ def get_app(db):
         handlers.update(mod.__dict__)
 
     loaded_urls = templeton.handlers.load_urls(urls)
-    return web.application(loaded_urls, handlers)
+    app = web.application(loaded_urls, handlers)
+    app.add_processor(web_handlers.record_request)
+    return app
+
+def get_server(app):
+    """
+    Create a WSGI server for the app, with a pool of worker threads so that
+    slow requests do not block other clients.  The pool size and listen
+    queue length are taken from the [server] section of the config.
+    """
+    logger = logging.getLogger('server')
+    port = int(config.get('server', 'port') or DEFAULT_PORT)
+    if len(sys.argv) > 1:
+        # like app.run(), accept a port or address:port on the command line
+        port = sys.argv[1]
+    server_address = web.validaddr(str(port))
+    threads = int(config.get('server', 'threads') or DEFAULT_THREADS)
+    request_queue_size = int(config.get('server', 'request_queue_size')
+                             or DEFAULT_REQUEST_QUEUE_SIZE)
+
+    # wrap the app as app.run() does, so that the static UI files are served
+    func = web.httpserver.StaticMiddleware(app.wsgifunc())
+    func = web.httpserver.LogMiddleware(func)
+
+    logger.info('serving on http://%s:%d/ with %d threads' %
+                (server_address[0], server_address[1], threads))
+    return WSGIServer(server_address, func, numthreads=threads,
+                      server_name=config.get('server', 'fqdn'),
+                      request_queue_size=request_queue_size)
+
+def run_server(app):
+    if config.get('server', 'mode') == 'simple':
+        # web.py's built-in development server
+        app.run()
+        return
+
+    server = get_server(app)
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        server.stop()
 
 def main(run=True):
     # templeton uses $PWD/../html to serve /, so put PWD in a subdirectory of
@@ -70,9 +119,13 @@ def main(run=True):
     mozpool.mozpool.driver = requestmachine.MozpoolDriver(db)
     mozpool.mozpool.driver.start()
 
+    # deliver events between the drivers in-process, rather than via HTTP
+    eventbus.bus.register('device', mozpool.lifeguard.driver)
+    eventbus.bus.register('request', mozpool.mozpool.driver)
+
     app = get_app(db)
     if run:
-        app.run()
+        run_server(app)
 
 if __name__ == '__main__':
     main()
@@ -10,8 +10,11 @@ import getpass
 import re
 import requests
 import socket
-import sys
+import threading
 import time
+import urlparse
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
 
 try:
     import simplejson as json
@@ -56,8 +59,36 @@ def check_mozpool_status(status):
         import pprint
         raise MozpoolException('mozpool status not ok, code %s' % pprint.pformat(status))
 
+# the part of a URL path identifying an object whose requests may be
+# redirected to the imaging server managing it
+OBJECT_PATH_RE = re.compile(r'^/api/(device|request|relay)/[^/]+/')
+
 class MozpoolHandler:
-    def __init__(self, mozpool_api_url, log_obj=None):
+    """Client for the mozpool API at mozpool_api_url.
+
+    All requests are made over a single keep-alive session, with up to
+    pool_size connections to each server, so a handler can be shared by
+    several threads; see concurrently().  Mozpool redirects requests about a
+    device or request to the imaging server that manages it; those redirects
+    are remembered, so that later requests about the same object go directly
+    to the right server.
+    """
+
+    # number of retries, and the initial and maximum sleep between them
+    num_retries = 5
+    retry_sleep = 1
+    max_retry_sleep = 10
+
+    # maximum number of redirects followed for a single request
+    max_redirects = 5
+
+    # longest time a single call to a wait/ API blocks, and the initial and
+    # maximum intervals for polling servers without that API
+    wait_timeout = 60
+    poll_interval = 1
+    max_poll_interval = 30
+
+    def __init__(self, mozpool_api_url, log_obj=None, pool_size=10):
         self.mozpool_api_url = mozpool_api_url
         self.mozpool_timeout=10
         self.user = getpass.getuser()
@@ -67,38 +98,97 @@ class MozpoolHandler:
         else:
             import logging as log
             self.log_obj = log
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # (scheme://netloc, object path) -> scheme://netloc
+        self._redirects = {}
+        self._redirects_lock = threading.Lock()
 
     # Helper methods {{{2
-    def url_get(self, url, decode_json=True, **kwargs):
-        """Generic get output from a url method.
+    def _redirect_key(self, url):
+        parsed = urlparse.urlsplit(url)
+        mo = OBJECT_PATH_RE.match(parsed.path)
+        if not mo:
+            return None
+        return ('%s://%s' % (parsed.scheme, parsed.netloc), mo.group(0))
 
-        This could be moved to a generic url handler object.
-        """
-        self.log_obj.debug("Request GET %s..." % url)
+    def _redirected(self, url):
+        """Apply any remembered redirect to url."""
+        key = self._redirect_key(url)
+        with self._redirects_lock:
+            server = self._redirects.get(key)
+        if not server:
+            return url
+        return server + url[len(key[0]):]
+
+    def _remember_redirect(self, url, location):
+        key = self._redirect_key(url)
+        new_key = self._redirect_key(location)
+        # only remember redirects of the same object to another server
+        if key and new_key and key[1] == new_key[1]:
+            with self._redirects_lock:
+                self._redirects[key] = new_key[0]
+
+    def forget_redirects(self):
+        """Forget all remembered redirects."""
+        with self._redirects_lock:
+            self._redirects.clear()
+
+    def _send(self, method, url, **kwargs):
+        """Send a request, following redirects while keeping the method and
+        body, and remembering them for later requests."""
+        kwargs['allow_redirects'] = False
+        target = self._redirected(url)
+        for _ in range(self.max_redirects):
+            r = self.session.request(method, target, **kwargs)
+            if r.status_code not in (301, 302, 303, 307) or 'location' not in r.headers:
+                break
+            target = urlparse.urljoin(target, r.headers['location'])
+            self._remember_redirect(url, target)
+        return r
+
+    def _request(self, method, url, **kwargs):
+        """Send a request, retrying connection errors and timeouts with
+        exponential backoff."""
         if kwargs.get("timeout") is None:
             kwargs["timeout"] = self.mozpool_timeout
-        num_retries = 10
         try_num = 0
-        while try_num <= num_retries:
+        while True:
             try_num += 1
             try:
-                r = requests.get(url, **kwargs)
-                self.log_obj.debug("Status code: %s" % str(r.status_code))
-                if decode_json:
-                    j = self.decode_json(r.text)
-                    if j is not None:
-                        return (j, r.status_code)
-                    else:
-                        raise MozpoolException("Try %d: Can't decode json from %s!" % (try_num, url))
-                else:
-                    return (r.text, r.status_code)
+                return self._send(method, url, **kwargs)
             except requests.exceptions.RequestException, e:
-                raise MozpoolException("Try %d: Can't get %s: %s!" % (try_num, url, str(e)))
-            if try_num <= num_retries:
-                sleep_time = 2 * try_num
-                self.log_obj.info("Sleeping %d..." % sleep_time)
+                # the remembered server may be down; start over at the original
+                key = self._redirect_key(url)
+                with self._redirects_lock:
+                    self._redirects.pop(key, None)
+                if try_num > self.num_retries:
+                    raise MozpoolException("Try %d: Can't %s %s: %s!" % (try_num, method, url, str(e)))
+                sleep_time = min(self.max_retry_sleep, self.retry_sleep * 2 ** (try_num - 1))
+                self.log_obj.info("Try %d: Can't %s %s: %s; sleeping %d..." %
+                                  (try_num, method, url, str(e), sleep_time))
                 time.sleep(sleep_time)
 
+    def url_get(self, url, decode_json=True, **kwargs):
+        """Generic get output from a url method.
+
+        This could be moved to a generic url handler object.
+        """
+        self.log_obj.debug("Request GET %s..." % url)
+        r = self._request('GET', url, **kwargs)
+        self.log_obj.debug("Status code: %s" % str(r.status_code))
+        if decode_json:
+            j = self.decode_json(r.text)
+            if j is not None:
+                return (j, r.status_code)
+            else:
+                raise MozpoolException("Can't decode json from %s!" % url)
+        else:
+            return (r.text, r.status_code)
+
     def decode_json(self, contents):
         try:
             return json.loads(contents, encoding="ascii")
@@ -116,35 +206,60 @@ class MozpoolHandler:
         This could be moved to a generic url handler object.
         """
         self.log_obj.debug("Request POST %s..." % url)
-        if kwargs.get("timeout") is None:
-            kwargs["timeout"] = self.mozpool_timeout
-        num_retries = 10
         if good_statuses is None:
             good_statuses = [200, 201, 202, 204, 302]
-        try_num = 0
-        while try_num <= num_retries:
-            try_num += 1
-            try:
-                r = requests.post(url, data=data, **kwargs)
-                if r.status_code in good_statuses:
-                    self.log_obj.debug("Status code: %s" % str(r.status_code))
-                    if decode_json:
-                        j = self.decode_json(r.text)
-                        if j is not None:
-                            return (j, r.status_code)
-                        else:
-                            raise MozpoolException("Try %d: Can't decode json from %s!" % (try_num, url))
-                    else:
-                        return (r.text, r.status_code)
+        r = self._request('POST', url, data=data, **kwargs)
+        if r.status_code in good_statuses:
+            self.log_obj.debug("Status code: %s" % str(r.status_code))
+            if decode_json:
+                j = self.decode_json(r.text)
+                if j is not None:
+                    return (j, r.status_code)
                 else:
-                    self.log_obj.critical("Bad return status from %s: %d!" % (url, r.status_code))
-                    return (None, r.status_code)
-            except requests.exceptions.RequestException, e:
-                self.log_obj.exception("Try %d: Can't get %s: %s!" % (try_num, url, str(e)))
-            if try_num <= num_retries:
-                sleep_time = 2 * try_num
-                self.log_obj.info("Sleeping %d..." % sleep_time)
-                time.sleep(sleep_time)
+                    raise MozpoolException("Can't decode json from %s!" % url)
+            else:
+                return (r.text, r.status_code)
+        else:
+            self.log_obj.critical("Bad return status from %s: %d!" % (url, r.status_code))
+            return (None, r.status_code)
+
+    def concurrently(self, method, args_list, max_workers=None,
+                     return_exceptions=False):
+        """Call method (usually one of this handler's methods) once for each
+        item of args_list, in parallel threads sharing this handler's
+        connections, and return the results in the same order.  Each item is
+        a tuple of positional arguments, or a dictionary of keyword arguments.
+
+        If return_exceptions is true, a call that raises an exception has the
+        exception in its place in the results; otherwise the first exception
+        is raised once all of the calls are finished.
+
+        For example, to renew a list of requests:
+
+            handler.concurrently(handler.renew_request,
+                                 [ (url, 3600) for url in request_urls ])
+        """
+        args_list = list(args_list)
+        if not args_list:
+            return []
+        def call(args):
+            try:
+                if isinstance(args, dict):
+                    return (True, method(**args))
+                return (True, method(*args))
+            except Exception, e:
+                return (False, e)
+        pool = ThreadPool(min(max_workers or self.pool_size, len(args_list)))
+        try:
+            outcomes = pool.map(call, args_list)
+        finally:
+            pool.close()
+        results = []
+        for ok, result in outcomes:
+            if not ok and not return_exceptions:
+                raise result
+            results.append(result)
+        return results
 
     def partial_url_get(self, partial_url, **kwargs):
         return self.url_get(self.mozpool_api_url + partial_url, **kwargs)
@@ -180,7 +295,8 @@ class MozpoolHandler:
             raise MozpoolException("Invalid response from query_all_device_details()!")
 
     def request_device(self, device, image, duration=30*60, assignee=None,
-            pxe_config=None, b2gbase=None, environment='any', **kwargs):
+            pxe_config=None, b2gbase=None, environment='any', priority=None,
+            **kwargs):
         """ requests the given device. {id} may be "any" to let MozPool choose an
             unassigned device. The body must be a JSON object with at least the keys
             "requester", "duration", and "image". The value for "requester" takes an
@@ -194,6 +310,10 @@ class MozpoolHandler:
             present. The value of "b2gbase" must be a URL to a b2g build directory
             containing boot, system, and userdata tarballs.
 
+            "priority", if given, is the priority class of the request: "high",
+            "normal" (the default), or "low".  Higher-priority requests are
+            given devices first.
+
             If successful, returns 200 OK with a JSON object with the key "request".
             The value of "request" is an object detailing the request, with the keys
             "assigned_device" (which is blank if mozpool is still attempting to find
@@ -222,6 +342,8 @@ class MozpoolHandler:
         data = {'assignee': assignee, 'duration': duration, 'image': image, 'environment': environment}
         if pxe_config is not None:
             data['pxe_config'] = pxe_config
+        if priority is not None:
+            data['priority'] = priority
         data['b2gbase'] = b2gbase
         response, status = self.url_post(
                 "%s/api/device/%s/request/" % (self.mozpool_api_url, device),
@@ -310,3 +432,85 @@ class MozpoolHandler:
         response, status = self.url_get(request_url, **kwargs)
         check_mozpool_status(status)
         return response
+
+    # Waiting {{{2
+    def wait_for_request(self, request_url, states=('ready',), timeout=None):
+        """ waits until the request is in one of the given states, has failed
+            (its state starts with "failed_"), or has been closed or expired,
+            or until timeout seconds have passed, if given.
+
+            The request's wait/ API is used to learn of each state change as
+            soon as it happens.  If the server does not support it, the
+            request's status is polled, starting once a second and backing
+            off to every max_poll_interval seconds while it does not change.
+
+            Returns a dictionary with keys "state" (the final state),
+            "elapsed" (the seconds spent waiting), "timed_out" (true if the
+            timeout expired first), "history" (a list of [state, seconds]
+            pairs giving each state seen and when it was first seen), and
+            "calls" (the number of API calls made).
+        """
+        def done(state):
+            return (state in states or state in ('closed', 'expired')
+                    or state.startswith('failed_'))
+        return self._wait(request_url, 'status/', done, timeout)
+
+    def wait_for_device(self, device, states=('ready',), timeout=None):
+        """ waits until the device is in one of the given states, or in a
+            failed state, or until timeout seconds have passed.  This is
+            otherwise the same as wait_for_request, but polls the device's
+            state/ API when its wait/ API is not available.
+        """
+        def done(state):
+            return state in states or state.startswith('failed_')
+        return self._wait("%s/api/device/%s/" % (self.mozpool_api_url, device),
+                          'state/', done, timeout)
+
+    def _wait(self, object_url, poll_path, done, timeout):
+        start = time.time()
+        result = {'state': None, 'elapsed': 0, 'timed_out': False,
+                  'history': [], 'calls': 0}
+        use_wait = True
+        interval = self.poll_interval
+        while True:
+            if timeout is None:
+                remaining = self.wait_timeout
+            else:
+                remaining = max(0, timeout - (time.time() - start))
+            if use_wait:
+                url = "%swait/?timeout=%g" % (object_url, min(remaining, self.wait_timeout))
+                if result['state'] is not None:
+                    url += "&state=%s" % result['state']
+                body, status = self.url_get(url, decode_json=False,
+                        timeout=self.wait_timeout + self.mozpool_timeout)
+                result['calls'] += 1
+                if status == 404 and not result['history']:
+                    # an older server, without the wait/ API
+                    self.log_obj.debug("no wait/ API at %s; polling" % object_url)
+                    use_wait = False
+                    continue
+                check_mozpool_status(status)
+                state = self.decode_json(body)['state']
+            else:
+                response, status = self.url_get(object_url + poll_path)
+                result['calls'] += 1
+                check_mozpool_status(status)
+                state = response['state']
+
+            elapsed = time.time() - start
+            if state != result['state']:
+                result['history'].append([state, elapsed])
+                result['state'] = state
+                interval = self.poll_interval
+            elif not use_wait:
+                interval = min(interval * 2, self.max_poll_interval)
+            result['elapsed'] = elapsed
+
+            if done(state):
+                return result
+            if timeout is not None and elapsed >= timeout:
+                result['timed_out'] = True
+                return result
+            if not use_wait:
+                time.sleep(interval if timeout is None
+                           else min(interval, timeout - elapsed))
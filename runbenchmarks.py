@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# Any copyright is dedicated to the Public Domain.
+# http://creativecommons.org/publicdomain/zero/1.0/
+
+import os
+import sys
+import argparse
+import unittest
+import logging
+from mozpool.test import benchmarks
+
+def load_tests(loader, standard_tests, pattern):
+    suite = unittest.TestSuite()
+    bench_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'mozpool', 'test', 'benchmarks')
+    suite.addTests(loader.discover(bench_dir, 'bench_*.py',
+                   top_level_dir=os.path.dirname(os.path.abspath(__file__))))
+    return suite
+
+def report(args):
+    benchmarks.write_results(args.output)
+    print "results written to %s" % args.output
+    if not args.baseline:
+        for name, result in sorted(benchmarks.results.iteritems()):
+            print "%-70s %10.6fs" % (name, result['min'])
+        return True
+
+    rows = benchmarks.compare(benchmarks.load_results(args.baseline),
+                              benchmarks.results, args.tolerance)
+    for name, old, new, ratio, regressed in rows:
+        print "%-70s %10.6fs %10.6fs %6.2fx%s" % (name, old, new, ratio,
+                                                 '  REGRESSED' if regressed else '')
+    return not any(row[-1] for row in rows)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description='Run the benchmarks, with any arguments for unittest.')
+    parser.add_argument('--output', metavar='FILE', default='benchmarks.json',
+                        help='write the results to FILE (default %(default)s)')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='compare the results with those in FILE')
+    parser.add_argument('--tolerance', type=float,
+                        default=benchmarks.DEFAULT_TOLERANCE,
+                        help='fraction by which a benchmark may be slower than the '
+                             'baseline (default %(default)s)')
+    args, argv = parser.parse_known_args()
+
+    open("benchmarks.log", "w") # truncate the file
+    logging.basicConfig(level=logging.DEBUG, filename='benchmarks.log')
+
+    program = unittest.main(argv=sys.argv[:1] + argv, exit=False)
+    if not program.result.wasSuccessful():
+        sys.exit(1)
+    if not report(args):
+        sys.exit(2)
@@ -16,7 +16,7 @@ setup(name='mozpool',
       },
       install_requires=[
           'sqlalchemy',
-          'requests >= 1.0.0',
+          'requests >= 2.9.0',
           'distribute',
           'argparse',
           'mozdevice',
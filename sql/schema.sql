@@ -103,6 +103,7 @@ DROP TABLE IF EXISTS hardware_types;
 DROP TABLE IF EXISTS device_logs;
 DROP TABLE IF EXISTS request_logs;
 DROP TABLE IF EXISTS relay_boards;
+DROP TABLE IF EXISTS state_transitions;
 
 CREATE TABLE imaging_servers (
   id integer UNSIGNED not null primary key auto_increment,
@@ -197,6 +198,27 @@ CREATE TABLE request_logs (
 );
 CALL init_log_partitions('request_logs', 14, 1);
 
+CREATE TABLE state_transitions (
+    id bigint not null auto_increment,
+    ts timestamp not null,
+    -- 'device' or 'request', and the id of the device or request
+    machine_type varchar(32) not null,
+    machine_id bigint not null,
+    from_state varchar(32) not null,
+    to_state varchar(32) not null,
+    -- seconds spent in from_state, or NULL if that is not known
+    duration double,
+    -- attributes of the machine at the time of the transition; for devices,
+    -- the image is the one being installed, if any
+    imaging_server_id integer unsigned not null,
+    hardware_type_id integer unsigned,
+    image_id integer unsigned,
+    -- indices
+    index ts_idx (ts),
+    primary key pk (id, ts)
+);
+CALL init_log_partitions('state_transitions', 30, 1);
+
 CREATE TABLE devices (
   id integer UNSIGNED not null primary key auto_increment,
   -- short name (no dots)
@@ -257,7 +279,9 @@ CREATE TABLE requests (
   state_counters text not null,
   state_timeout datetime,
   -- constraining fields for the request
-  environment varchar(32) not null default 'any'
+  environment varchar(32) not null default 'any',
+  -- priority class (high, normal, or low)
+  priority varchar(32) not null default 'normal'
 );
 
 CREATE TABLE device_requests (
@@ -297,6 +321,7 @@ CREATE PROCEDURE dbcron()
 BEGIN
     CALL update_log_partitions('device_logs', 14, 1);
     CALL update_log_partitions('request_logs', 14, 1);
+    CALL update_log_partitions('state_transitions', 30, 1);
     -- drop old requests; this interval should be greater than the log retention interval
     DELETE from requests where expires < DATE_SUB(NOW(), INTERVAL 1 WEEK);
     -- optimize the request table, since things are often added and removed